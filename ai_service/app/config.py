@@ -1,30 +1,128 @@
 from dotenv import load_dotenv
 import os
+import hashlib
 import logging
-from typing import Optional
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
+def configure_logging(level: int = logging.INFO):
+    """Configure root logging; called once by the application entrypoint"""
+    # Guarded so repeated calls or reloads don't stack handlers
+    if not logging.getLogger().handlers:
+        logging.basicConfig(
+            level=level,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            force=False
+        )
+
+# .env lives at the service root, next to main.py
+_DOTENV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env')
+
+# Whether .env has been considered yet (loaded lazily, at most once)
+_LOADED = False
+
+# Snapshot of the environment taken once after .env is loaded
+_ENV_CACHE: Dict[str, Optional[str]] = {}
+
+def clear_env_cache():
+    """Re-snapshot the environment (for tests or after modifying os.environ)"""
+    _ENV_CACHE.clear()
+    _ENV_CACHE.update(os.environ.items())
+
+# Required environment variables, fixed for the lifetime of the process
+_REQUIRED_TUPLE = ('S3_BUCKET_NAME', 'UPSTASH_REDIS_REST_URL', 'UPSTASH_REDIS_REST_TOKEN', 'GOOGLE_API_KEY')
+_REQUIRED_SET = frozenset(_REQUIRED_TUPLE)
 
 def get_required_env_vars():
-    """Get list of required environment variables"""
-    # Updated to reflect current architecture: ChromaDB (local), local embeddings, Gemini LLM
-    return ['S3_BUCKET_NAME', 'UPSTASH_REDIS_REST_URL', 'UPSTASH_REDIS_REST_TOKEN', 'GOOGLE_API_KEY']
+    """Get tuple of required environment variables"""
+    return _REQUIRED_TUPLE
+
+def is_required_env_var(var_name: str) -> bool:
+    """Check whether an environment variable is required by the service"""
+    return var_name in _REQUIRED_SET
+
+def _fast_load(path: str) -> bool:
+    """
+    Load a plain KEY=VALUE .env file without python-dotenv.
+    
+    Args:
+        path: Path to the .env file
+    
+    Returns:
+        True if the file was loaded, False if it uses syntax this parser
+        doesn't handle (interpolation, escapes, export, inline comments)
+    """
+    values = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[:1] == b'#':
+                continue
+            if b'${' in line or b'\\' in line or b' #' in line or line.startswith(b'export '):
+                return False
+            key, sep, value = line.partition(b'=')
+            key = key.strip()
+            if not sep or not key:
+                return False
+            value = value.strip()
+            if len(value) >= 2 and value[:1] == value[-1:] and value[:1] in (b'"', b"'"):
+                value = value[1:-1]
+            values[key.decode()] = value.decode()
+    
+    for key, value in values.items():
+        os.environ.setdefault(key, value)
+    return True
+
+def _compiled_env_current(env_compiled) -> bool:
+    """
+    Check that app/env_compiled.py was generated from the current .env.
+    
+    Args:
+        env_compiled: The imported compiled module
+    
+    Returns:
+        True if its recorded hash matches .env (or there is no .env to compare)
+    """
+    if not os.path.exists(_DOTENV_PATH):
+        # Shipped without .env; the compiled values are all there is
+        return True
+    with open(_DOTENV_PATH, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return getattr(env_compiled, 'SOURCE_SHA256', None) == digest
+
+def _ensure_dotenv_loaded():
+    """Load .env once; variables already set in the environment take precedence"""
+    global _LOADED
+    if _LOADED:
+        return
+    # Always merged (without overriding) so optional settings that only live in .env are seen
+    if not os.getenv("SKIP_DOTENV"):
+        # Prefer the precompiled .env (scripts/compile_env.py) over parsing text
+        try:
+            from app import env_compiled
+        except ImportError:
+            env_compiled = None
+        if env_compiled is not None and _compiled_env_current(env_compiled):
+            os.environ.update({k: v for k, v in env_compiled.ENV.items() if k not in os.environ})
+        else:
+            if env_compiled is not None:
+                logger.warning("app/env_compiled.py is out of date with .env; loading .env instead "
+                               "(re-run scripts/compile_env.py)")
+            if not (os.path.exists(_DOTENV_PATH) and _fast_load(_DOTENV_PATH)):
+                load_dotenv(override=False)
+    _LOADED = True
+    clear_env_cache()
 
 def validate_environment():
     """Validate that all required environment variables are set"""
-    required_vars = get_required_env_vars()
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    _ensure_dotenv_loaded()
+    missing_vars = [var for var in _REQUIRED_TUPLE if not _ENV_CACHE.get(var)]
     
     if missing_vars:
-        logger.error(f"Missing required environment variables: {missing_vars}")
+        logger.error("Missing required environment variables: %s", missing_vars)
         return False, missing_vars
     
     logger.info("All required environment variables are set")
@@ -32,4 +130,125 @@ def validate_environment():
 
 def get_env_var(var_name: str):
     """Get environment variable with optional default"""
-    return os.getenv(var_name) 
\ No newline at end of file
+    _ensure_dotenv_loaded()
+    return _ENV_CACHE.get(var_name) 
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Typed snapshot of the service configuration, built once per process"""
+    s3_bucket: str
+    redis_url: str
+    redis_token: str
+    google_api_key: str
+    # Optional: only the components that use them validate these
+    mongo_uri: Optional[str] = None
+    mongo_db: Optional[str] = None
+    mongo_collection_name: Optional[str] = None
+    mongo_vector_index: Optional[str] = None
+    mongo_num_candidates: int = 10000
+    mongo_search_max_time_ms: int = 2500
+    mongo_states_collection: str = 'agent_states'
+    mongo_pool_size: int = 20
+    # Agent state cache: Upstash TCP endpoint, else the REST API, else a local Redis
+    upstash_redis_url: Optional[str] = None
+    redis_host: str = 'localhost'
+    redis_port: int = 6379
+    redis_db: int = 0
+    redis_pool_size: int = 20
+    redis_ttl: int = 3600 * 24
+    state_save_debounce_seconds: float = 0.15
+    voyage_api_key: Optional[str] = None
+    # Must match the dtype documents were ingested with and the Atlas index definition
+    voyage_dtype: str = 'float'
+    voyage_max_retries: int = 4
+    tavily_api_key: Optional[str] = None
+    aws_access_key_id: Optional[str] = None
+    aws_secret_access_key: Optional[str] = None
+    aws_region: str = 'us-east-1'
+    s3_max_pool_connections: int = 64
+    presign_cache_size: int = 10000
+    # Retrieval tuning
+    rag_bson_query_vector: bool = False
+    rag_hedge_delay_ms: float = 300
+    rag_hedge_budget: float = 0.05
+    rag_slide_counts_ttl_seconds: float = 300
+    rag_max_chunk_chars: int = 1500
+    embed_cache_size: int = 4096
+    embed_cache_ttl_seconds: float = 3600
+    embed_batch_max_tokens: int = 2048
+    embed_batch_wait_ms: float = 10
+    # In-process caches: near-duplicate query embeddings and the RAG tool's formatted results
+    rag_semantic_cache: bool = False
+    rag_semantic_cache_threshold: float = 0.97
+    rag_semantic_cache_size: int = 2048
+    rag_semantic_cache_ttl_seconds: float = 300
+    rag_tool_cache_size: int = 512
+    rag_tool_cache_ttl_seconds: float = 300
+    # Persistent Atlas retrieval cache (off unless RAG_CACHE_COLLECTION is set)
+    rag_cache_collection: Optional[str] = None
+    rag_cache_vector_index: str = 'rag_cache_vector_index'
+    rag_cache_threshold: float = 0.985
+    rag_cache_ttl_seconds: int = 86400
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Get the cached settings object (call get_settings.cache_clear() to rebuild).
+    
+    Raises:
+        RuntimeError: If any required environment variable is unset or empty
+    """
+    _ensure_dotenv_loaded()
+    # Same non-empty check as validate_environment
+    missing = [var for var in _REQUIRED_TUPLE if not _ENV_CACHE.get(var)]
+    if missing:
+        raise RuntimeError(f"Missing env: {missing}")
+    return Settings(
+        s3_bucket=_ENV_CACHE['S3_BUCKET_NAME'],
+        redis_url=_ENV_CACHE['UPSTASH_REDIS_REST_URL'],
+        redis_token=_ENV_CACHE['UPSTASH_REDIS_REST_TOKEN'],
+        google_api_key=_ENV_CACHE['GOOGLE_API_KEY'],
+        mongo_uri=_ENV_CACHE.get('MONGO_URI'),
+        mongo_db=_ENV_CACHE.get('MONGO_DB'),
+        mongo_collection_name=_ENV_CACHE.get('MONGO_COLLECTION_NAME'),
+        mongo_vector_index=_ENV_CACHE.get('MONGO_VECTOR_INDEX'),
+        mongo_num_candidates=int(_ENV_CACHE.get('MONGO_NUM_CANDIDATES') or 10000),
+        mongo_search_max_time_ms=int(_ENV_CACHE.get('MONGO_SEARCH_MAX_TIME_MS') or 2500),
+        mongo_states_collection=_ENV_CACHE.get('MONGO_STATES_COLLECTION') or 'agent_states',
+        mongo_pool_size=int(_ENV_CACHE.get('MONGO_POOL_SIZE') or 20),
+        upstash_redis_url=_ENV_CACHE.get('UPSTASH_REDIS_URL'),
+        redis_host=_ENV_CACHE.get('REDIS_HOST') or 'localhost',
+        redis_port=int(_ENV_CACHE.get('REDIS_PORT') or 6379),
+        redis_db=int(_ENV_CACHE.get('REDIS_DB') or 0),
+        redis_pool_size=int(_ENV_CACHE.get('REDIS_POOL_SIZE') or 20),
+        redis_ttl=int(_ENV_CACHE.get('REDIS_TTL') or 3600 * 24),
+        state_save_debounce_seconds=float(_ENV_CACHE.get('STATE_SAVE_DEBOUNCE_SECONDS') or 0.15),
+        voyage_api_key=_ENV_CACHE.get('VOYAGE_API_KEY'),
+        voyage_dtype=_ENV_CACHE.get('VOYAGE_DTYPE') or 'float',
+        voyage_max_retries=int(_ENV_CACHE.get('VOYAGE_MAX_RETRIES') or 4),
+        tavily_api_key=_ENV_CACHE.get('TAVILY_API_KEY'),
+        aws_access_key_id=_ENV_CACHE.get('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=_ENV_CACHE.get('AWS_SECRET_ACCESS_KEY'),
+        aws_region=_ENV_CACHE.get('AWS_REGION') or 'us-east-1',
+        s3_max_pool_connections=int(_ENV_CACHE.get('S3_MAX_POOL_CONNECTIONS') or 64),
+        presign_cache_size=int(_ENV_CACHE.get('PRESIGN_CACHE_SIZE') or 10000),
+        rag_bson_query_vector=_ENV_CACHE.get('RAG_BSON_QUERY_VECTOR') == '1',
+        rag_hedge_delay_ms=float(_ENV_CACHE.get('RAG_HEDGE_DELAY_MS') or 300),
+        rag_hedge_budget=float(_ENV_CACHE.get('RAG_HEDGE_BUDGET') or 0.05),
+        rag_slide_counts_ttl_seconds=float(_ENV_CACHE.get('RAG_SLIDE_COUNTS_TTL_SECONDS') or 300),
+        rag_max_chunk_chars=int(_ENV_CACHE.get('RAG_MAX_CHUNK_CHARS') or 1500),
+        embed_cache_size=int(_ENV_CACHE.get('EMBED_CACHE_SIZE') or 4096),
+        embed_cache_ttl_seconds=float(_ENV_CACHE.get('EMBED_CACHE_TTL_SECONDS') or 3600),
+        embed_batch_max_tokens=int(_ENV_CACHE.get('EMBED_BATCH_MAX_TOKENS') or 2048),
+        embed_batch_wait_ms=float(_ENV_CACHE.get('EMBED_BATCH_WAIT_MS') or 10),
+        rag_semantic_cache=_ENV_CACHE.get('RAG_SEMANTIC_CACHE') == '1',
+        rag_semantic_cache_threshold=float(_ENV_CACHE.get('RAG_SEMANTIC_CACHE_THRESHOLD') or 0.97),
+        rag_semantic_cache_size=int(_ENV_CACHE.get('RAG_SEMANTIC_CACHE_SIZE') or 2048),
+        rag_semantic_cache_ttl_seconds=float(_ENV_CACHE.get('RAG_SEMANTIC_CACHE_TTL_SECONDS') or 300),
+        rag_tool_cache_size=int(_ENV_CACHE.get('RAG_TOOL_CACHE_SIZE') or 512),
+        rag_tool_cache_ttl_seconds=float(_ENV_CACHE.get('RAG_TOOL_CACHE_TTL_SECONDS') or 300),
+        rag_cache_collection=_ENV_CACHE.get('RAG_CACHE_COLLECTION'),
+        rag_cache_vector_index=_ENV_CACHE.get('RAG_CACHE_VECTOR_INDEX') or 'rag_cache_vector_index',
+        rag_cache_threshold=float(_ENV_CACHE.get('RAG_CACHE_THRESHOLD') or 0.985),
+        rag_cache_ttl_seconds=int(_ENV_CACHE.get('RAG_CACHE_TTL_SECONDS') or 86400)
+    )
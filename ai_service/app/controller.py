@@ -1,18 +1,19 @@
 from fastapi import FastAPI, status, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import Optional
+import asyncio
 import logging
 import time
 from contextlib import asynccontextmanager
-from app.config import validate_environment
+from app.config import validate_environment, get_settings
 from app.pipeline.inbound.inbound_pipeline import process_pdf_pipeline, cleanup_inbound_connections
 from app.pipeline.manager.management_pipeline import delete_vectors_by_metadata, cleanup_management_connections
+from app.pipeline.outbound import cleanup_all
 from app.pipeline.outbound.outbound_pipeline import (
     OutboundRequest, 
     ChatResponseDTO,
-    SnapshotData,
-    process_outbound_pipeline,
-    cleanup_outbound_connections
+    process_outbound_pipeline
 )
 
 # Configure logging
@@ -23,19 +24,26 @@ async def lifespan(app: FastAPI):
     """Lifespan event handler for startup and shutdown"""
     # Startup
     logger.info("Application starting up...")
+    # Fail fast on missing configuration instead of mid-request
+    get_settings()
     yield
     # Shutdown
     logger.info("Application shutting down, cleaning up resources...")
-    cleanup_outbound_connections()
-    cleanup_inbound_connections()
-    cleanup_management_connections()
+    # Independent client closes, run concurrently
+    await asyncio.gather(
+        cleanup_all(),
+        asyncio.to_thread(cleanup_inbound_connections),
+        asyncio.to_thread(cleanup_management_connections)
+    )
     logger.info("Resource cleanup completed")
 
 app = FastAPI(
     title="PDF Processing Pipeline API",
     description="Microservice API for processing PDF files from S3, chunking them, embedding with Voyage AI, and storing in MongoDB",
     version="3.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # orjson renders response bodies (chat sources in particular) much faster than stdlib json
+    default_response_class=ORJSONResponse
 )
 
 class InboundRequest(BaseModel):
@@ -80,7 +88,7 @@ async def process_pdf(request: InboundRequest):
     Returns:
         Processing results and metrics
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     logger.info(f"Received processing request: course_id={request.course_id}, slide_id={request.slide_id}, s3_file_name={request.s3_file_name}")
     
     # Validate required environment variables
@@ -102,7 +110,7 @@ async def process_pdf(request: InboundRequest):
         )
         
         # Calculate total processing time
-        end_time = time.time()
+        end_time = time.perf_counter()
         processing_time_ms = int((end_time - start_time) * 1000)
         
         # Check if pipeline was successful
@@ -166,7 +174,7 @@ async def delete_vectors(request: ManagementRequest):
     Returns:
         Deletion results and metrics
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     logger.info(f"Received deletion request: course_id={request.course_id}, slide_id={request.slide_id}, s3_file_name={request.s3_file_name}")
     
     # Validate required environment variables
@@ -188,7 +196,7 @@ async def delete_vectors(request: ManagementRequest):
         )
         
         # Calculate total processing time
-        end_time = time.time()
+        end_time = time.perf_counter()
         processing_time_ms = int((end_time - start_time) * 1000)
         
         # Check if deletion was successful
@@ -11,7 +11,7 @@ import logging
 from app.pipeline.outbound.conversation_reader import (
     get_conversation_for_frontend,
     get_user_conversations,
-    ConversationReader
+    get_conversation_reader
 )
 
 logger = logging.getLogger(__name__)
@@ -97,12 +97,10 @@ async def sync_conversation_to_cache(request: ConversationRequest):
     This is optional but can improve performance for active conversations.
     """
     try:
-        reader = ConversationReader()
-        success = await reader.sync_mongodb_to_redis(
+        success = await get_conversation_reader().sync_mongodb_to_redis(
             user_id=request.userId,
             course_id=request.courseId
         )
-        reader.close()
         
         if success:
             return {"status": "success", "message": "Conversation synced to cache"}
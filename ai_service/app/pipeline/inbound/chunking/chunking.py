@@ -6,29 +6,30 @@ It then returns the chunks in a list of dictionaries.
 """
 
 import time
+from bisect import bisect_left, bisect_right
 import pymupdf4llm
-from io import BytesIO
 from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any
 import fitz  # PyMuPDF
 import re
 
+# How far past the previous chunk (beyond the chunk's own length) to look for the
+# next one; splitters only drop blank lines and whitespace between chunks
+_FIND_WINDOW_SLACK = 1024
+
 
 # Helper Functions
-def convert_pdf_to_markdown(file_stream: BytesIO) -> tuple[str, dict]:
+def convert_pdf_to_markdown(pdf_bytes: bytes) -> tuple[str, dict]:
     """
-    Converts PDF from BytesIO to Markdown using PyMuPDF4LLM.
+    Converts PDF bytes to Markdown using PyMuPDF4LLM.
     Preserves all header levels for recursive chunking.
     Returns markdown content and metadata.
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     print(f"Starting PDF to Markdown conversion with PyMuPDF4LLM...")
     
-    # Reset stream position
-    file_stream.seek(0)
-    
-    # Create PyMuPDF Document from stream
-    doc = fitz.open(stream=file_stream, filetype="pdf")
+    # Create PyMuPDF Document straight from the downloaded bytes
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     
     # Convert PDF to markdown using the document object
     markdown_result = pymupdf4llm.to_markdown(doc, page_chunks=True, write_images=False)
@@ -71,7 +72,7 @@ def convert_pdf_to_markdown(file_stream: BytesIO) -> tuple[str, dict]:
     
     doc.close()
     
-    total_time = time.time() - start_time
+    total_time = time.perf_counter() - start_time
     print(f"PDF to Markdown conversion completed in {total_time:.3f}s")
     print(f"Generated {len(markdown_content):,} characters")
     print(f"Document has {metadata['total_pages']} pages")
@@ -95,28 +96,24 @@ def count_words(text: str) -> int:
     return len(text.split())
 
 
-def get_page_numbers(char_start: int, char_end: int, page_markers: dict, total_pages: int) -> tuple[int, int]:
+def get_page_numbers(char_start: int, char_end: int, marker_positions: List[int],
+                     marker_pages: List[int], total_pages: int) -> tuple[int, int]:
     """
     Determines which pages a chunk spans based on character positions.
+    
+    marker_positions are the ascending page_markers positions and marker_pages
+    their page numbers (built once per document), so both lookups are bisects.
     """
-    if not page_markers:
+    if not marker_positions:
         return 1, 1
     
-    page_start = 1
-    page_end = total_pages
+    # Start page: last marker at or before char_start
+    i = bisect_right(marker_positions, char_start)
+    page_start = marker_pages[i - 1] if i else 1
     
-    # Find start page
-    for pos, page in sorted(page_markers.items()):
-        if char_start < pos:
-            break
-        page_start = page
-    
-    # Find end page
-    for pos, page in sorted(page_markers.items()):
-        if char_end <= pos:
-            page_end = page - 1
-            break
-        page_end = page
+    # End page: the page before the first marker at or after char_end
+    j = bisect_left(marker_positions, char_end)
+    page_end = marker_pages[j] - 1 if j < len(marker_positions) else marker_pages[-1]
     
     return page_start, max(page_start, page_end)
 
@@ -265,12 +262,22 @@ def process_chunks_langchain(markdown_text: str, metadata: dict, course_id: str,
     # Track character position in original text
     char_position = 0
     
+    # page_markers is built in ascending position order
+    page_markers = metadata.get('page_markers', {})
+    marker_positions = list(page_markers)
+    marker_pages = list(page_markers.values())
+    total_pages = metadata.get('total_pages', 1)
+    
     for i, doc in enumerate(md_docs):
         chunk_text = doc.page_content
         word_count = count_words(chunk_text)
         
-        # Find chunk position in original text
-        chunk_start = markdown_text.find(chunk_text, char_position)
+        # Find chunk position in original text. Chunks come in document order, so
+        # search a bounded window after the previous one; a miss (the splitter
+        # can rejoin lines) then costs O(chunk) instead of a scan to the end
+        chunk_start = markdown_text.find(
+            chunk_text, char_position, char_position + len(chunk_text) + _FIND_WINDOW_SLACK
+        )
         if chunk_start == -1:
             chunk_start = char_position  # Fallback
         chunk_end = chunk_start + len(chunk_text)
@@ -278,8 +285,7 @@ def process_chunks_langchain(markdown_text: str, metadata: dict, course_id: str,
         # Get page numbers
         page_start, page_end = get_page_numbers(
             chunk_start, chunk_end, 
-            metadata.get('page_markers', {}), 
-            metadata.get('total_pages', 1)
+            marker_positions, marker_pages, total_pages
         )
         
         if word_count <= max_words:
@@ -353,16 +359,20 @@ def process_chunks_langchain(markdown_text: str, metadata: dict, course_id: str,
             for sibling_idx, sub_text in enumerate(sub_docs):
                 sub_word_count = count_words(sub_text)
                 
-                # Calculate position in original document
-                chunk_start = parent_start + text.find(sub_text, local_pos)
+                # Calculate position in original document (bounded like above;
+                # on a miss continue from the previous sub-chunk instead of
+                # landing one character before the parent)
+                sub_start = text.find(sub_text, local_pos, local_pos + len(sub_text) + _FIND_WINDOW_SLACK)
+                if sub_start == -1:
+                    sub_start = local_pos
+                chunk_start = parent_start + sub_start
                 chunk_end = chunk_start + len(sub_text)
                 local_pos = chunk_end - parent_start
                 
                 # Get page numbers
                 page_start, page_end = get_page_numbers(
                     chunk_start, chunk_end,
-                    metadata.get('page_markers', {}),
-                    metadata.get('total_pages', 1)
+                    marker_positions, marker_pages, total_pages
                 )
                 
                 chunk_data = {
@@ -407,28 +417,25 @@ def process_chunks_langchain(markdown_text: str, metadata: dict, course_id: str,
     print("\nBuilding header hierarchy with titles...")
     header_map = build_header_hierarchy_with_titles(processed_chunks, markdown_text)
     
-    # Update chunks with header hierarchy indices and titles
-    for chunk in processed_chunks:
-        chunk_idx = chunk['chunk_index']
-        if chunk_idx in header_map:
-            chunk['headers_hierarchy'] = header_map[chunk_idx]['parent_indices']
-            chunk['headers_hierarchy_titles'] = header_map[chunk_idx]['parent_titles']
-            if header_map[chunk_idx]['is_header']:
-                chunk['is_header'] = True
-                if header_map[chunk_idx]['level']:
-                    chunk['header_level'] = header_map[chunk_idx]['level']
-                if header_map[chunk_idx]['header_text']:
-                    chunk['header_text'] = header_map[chunk_idx]['header_text']
-    
-    print(f"\nLangChain chunking completed")
-    print(f"Total chunks created: {len(processed_chunks)}")
-    
-    # Count by split level
+    # Update chunks with header hierarchy indices and titles, counting split
+    # levels for the summary in the same pass
     split_counts = {}
     for chunk in processed_chunks:
+        header_info = header_map.get(chunk['chunk_index'])
+        if header_info:
+            chunk['headers_hierarchy'] = header_info['parent_indices']
+            chunk['headers_hierarchy_titles'] = header_info['parent_titles']
+            if header_info['is_header']:
+                chunk['is_header'] = True
+                if header_info['level']:
+                    chunk['header_level'] = header_info['level']
+                if header_info['header_text']:
+                    chunk['header_text'] = header_info['header_text']
         level = chunk["split_level"]
         split_counts[level] = split_counts.get(level, 0) + 1
     
+    print(f"\nLangChain chunking completed")
+    print(f"Total chunks created: {len(processed_chunks)}")
     print(f"Chunks by split level: {split_counts}")
     
     return processed_chunks
@@ -480,28 +487,25 @@ def validate_sibling_contiguity(chunks: List[Dict[str, Any]]) -> None:
 
 # Main Function
 def chunk_pdf(course_id: str, slide_id: str, s3_file_name: str, 
-              file_stream: BytesIO, max_words: int = 350) -> List[Dict[str, Any]]:
+              pdf_bytes: bytes, max_words: int = 350) -> List[Dict[str, Any]]:
     """
-    Main function that takes PDF BytesIO input and returns list of chunks.
+    Main function that takes PDF bytes and returns list of chunks.
     
     Args:
         course_id: The course ID for the chunks
         slide_id: The slide ID for the chunks
         s3_file_name: The S3 file name/path
-        file_stream: BytesIO containing the PDF data
+        pdf_bytes: The PDF file contents
         max_words: Maximum words per chunk (default 350)
     
     Returns:
         List of chunks with specified format
     """
-    start_time = time.time()
-    
-    # Ensure file_stream is at the beginning
-    file_stream.seek(0)
+    start_time = time.perf_counter()
     
     # Step 1: Convert PDF to Markdown
     print("Converting PDF to Markdown...")
-    markdown_content, metadata = convert_pdf_to_markdown(file_stream)
+    markdown_content, metadata = convert_pdf_to_markdown(pdf_bytes)
     
     # Step 2: Process chunks with LangChain splitters
     print("Processing chunks with LangChain...")
@@ -514,7 +518,7 @@ def chunk_pdf(course_id: str, slide_id: str, s3_file_name: str,
         max_words
     )
     
-    total_time = time.time() - start_time
+    total_time = time.perf_counter() - start_time
     print(f"\nTotal processing time: {total_time:.3f}s")
     print(f"Processed {len(chunks)} chunks")
     
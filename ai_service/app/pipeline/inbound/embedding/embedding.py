@@ -4,44 +4,118 @@ Takes the output from chunking.py and adds embeddings to each chunk.
 Includes MongoDB vector index storage functionality.
 """
 
-import os
-from typing import List, Dict, Any, Optional
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Any, Optional, Callable
 import voyageai
 from pymongo import MongoClient, InsertOne
 from pymongo.errors import BulkWriteError
-from dotenv import load_dotenv
 import time
 
-# Load environment variables only if not already loaded
-if not os.getenv('MONGO_URI'):
-    load_dotenv()
+from app.config import get_settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Global connections - initialized once and reused across pipeline runs
+_mongo_client: Optional[MongoClient] = None
 
 
 def get_mongo_client() -> MongoClient:
-    """Initialize and return MongoDB client."""
-    mongo_uri = os.getenv('MONGO_URI')
-    if not mongo_uri:
-        raise ValueError("MONGO_URI not found in .env file")
-    return MongoClient(mongo_uri)
+    """Get or create MongoDB client (singleton)."""
+    global _mongo_client
+    if _mongo_client is None:
+        mongo_uri = get_settings().mongo_uri
+        if not mongo_uri:
+            raise ValueError("MONGO_URI not found in .env file")
+        _mongo_client = MongoClient(mongo_uri)
+        logger.info("MongoDB client initialized (embedding)")
+    return _mongo_client
+
+
+def cleanup_embedding_connections():
+    """Clean up connections on shutdown."""
+    global _mongo_client
+    
+    if _mongo_client:
+        _mongo_client.close()
+        _mongo_client = None
+    
+    logger.info("Embedding connections cleaned up")
+
+
+def _chunk_id(chunk: Dict[str, Any]) -> str:
+    """Return the stored document id of a chunk: {course_id}:{slide_id}:{chunk_index}."""
+    return f"{chunk['course_id']}:{chunk['slide_id']}:{chunk['chunk_index']}"
 
 
-def embed_chunks(chunks: List[Dict[str, Any]], api_key: str = None) -> List[Dict[str, Any]]:
+def _write_batch(collection, batch_ops: List[InsertOne], batch_ids: List[str], batch_start: int) -> Dict[str, Any]:
+    """
+    Execute a single unordered bulk_write and summarize the outcome.
+    
+    Args:
+        collection: Target MongoDB collection
+        batch_ops: Insert operations for this batch
+        batch_ids: Document ids of batch_ops, in the same order
+        batch_start: Offset of the batch within the full operation list
+    
+    Returns:
+        Dictionary with inserted/duplicates counts, the ids actually inserted
+        and an optional error entry
+    """
+    outcome = {"inserted": 0, "duplicates": 0, "inserted_ids": [], "error": None}
+    try:
+        result = collection.bulk_write(batch_ops, ordered=False)
+        outcome["inserted"] = result.inserted_count
+        outcome["inserted_ids"] = list(batch_ids)
+    except BulkWriteError as e:
+        # Count successful inserts from partial results
+        if hasattr(e, 'details') and e.details:
+            outcome["inserted"] = e.details.get('nInserted', 0)
+            # Count duplicate key errors
+            write_errors = e.details.get('writeErrors', [])
+            for error in write_errors:
+                if error.get('code') == 11000:  # Duplicate key error
+                    outcome["duplicates"] += 1
+            # Unordered: every operation without a write error was inserted
+            failed = {error.get('index') for error in write_errors}
+            outcome["inserted_ids"] = [doc_id for i, doc_id in enumerate(batch_ids) if i not in failed]
+        
+        outcome["error"] = {
+            "batch_start": batch_start,
+            "batch_end": batch_start + len(batch_ops),
+            "error": str(e)
+        }
+    return outcome
+
+
+def embed_chunks(chunks: List[Dict[str, Any]], api_key: str = None, max_workers: int = 5,
+                 on_batch: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None) -> List[Dict[str, Any]]:
     """
     Embeds all text fields in chunks using Voyage 3.5-lite with 512 dimensions.
     
     Args:
         chunks: List of chunk dictionaries from chunking.py, each containing a "text" field
         api_key: Optional Voyage API key (defaults to VOYAGE_API_KEY from environment)
+        max_workers: Maximum number of batches embedded concurrently
+        on_batch: Optional callback called with (offset, chunks) as soon as a batch
+            is embedded, possibly from a worker thread
     
     Returns:
         List of chunks with updated "embedding" fields
     """
     # Initialize Voyage client
-    api_key = api_key or os.getenv('VOYAGE_API_KEY')
+    settings = get_settings()
+    api_key = api_key or settings.voyage_api_key
     if not api_key:
         raise ValueError("VOYAGE_API_KEY not found. Set it in .env or pass directly")
     
-    client = voyageai.Client(api_key=api_key)
+    # Retries transient Voyage errors (rate limits, timeouts, 5xx); the SDK backs
+    # off exponentially with jitter, so concurrent uploads don't retry in lockstep
+    client = voyageai.Client(api_key=api_key, max_retries=settings.voyage_max_retries)
+    # Quantized VOYAGE_DTYPE values shrink stored vectors; queries must use the
+    # same dtype and the Atlas index must match
+    dtype = settings.voyage_dtype
     model = "voyage-3.5-lite"
     dimensions = 512
     batch_size = 1000
@@ -49,44 +123,54 @@ def embed_chunks(chunks: List[Dict[str, Any]], api_key: str = None) -> List[Dict
     # Extract texts from chunks
     texts = [chunk["text"] for chunk in chunks]
     
-    # Process in batches if needed
-    embeddings = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        
+    def embed_batch(start: int) -> None:
         result = client.embed(
-            texts=batch,
+            texts=texts[start:start + batch_size],
             model=model,
             input_type="document",
-            output_dimension=dimensions
+            output_dimension=dimensions,
+            output_dtype=dtype
         )
-        
-        embeddings.extend(result.embeddings)
+        # Write each embedding into its own chunk by position, so batches can
+        # finish in any order without an intermediate flattened list
+        for offset, embedding in enumerate(result.embeddings):
+            chunks[start + offset]["embedding"] = embedding
+        if on_batch is not None:
+            on_batch(start, chunks[start:start + batch_size])
     
-    # Update chunks with embeddings
-    for i, chunk in enumerate(chunks):
-        chunk["embedding"] = embeddings[i]
+    # Batches are independent network-bound requests, so send them concurrently
+    batch_starts = range(0, len(texts), batch_size)
+    if len(batch_starts) <= 1 or max_workers <= 1:
+        for i in batch_starts:
+            embed_batch(i)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batch_starts))) as executor:
+            # Consume the results so a failed batch raises here
+            list(executor.map(embed_batch, batch_starts))
     
     return chunks
 
 
 def save_to_mongodb(chunks: List[Dict[str, Any]], 
                    mongo_client: Optional[MongoClient] = None,
-                   batch_size: int = 100) -> Dict[str, Any]:
+                   batch_size: int = 100,
+                   max_workers: int = 6) -> Dict[str, Any]:
     """
     Save chunks with embeddings to MongoDB with vector index.
     
     Args:
         chunks: List of chunk dictionaries with embeddings
-        mongo_client: Optional MongoClient instance (creates new if not provided)
+        mongo_client: Optional MongoClient instance (uses the shared client if not provided)
         batch_size: Number of documents to insert/update in each batch
+        max_workers: Maximum number of batches written concurrently
     
     Returns:
         Dictionary with save statistics
     """
     # Get MongoDB configuration
-    db_name = os.getenv('MONGO_DB')
-    collection_name = os.getenv('MONGO_COLLECTION_NAME')
+    settings = get_settings()
+    db_name = settings.mongo_db
+    collection_name = settings.mongo_collection_name
     
     if not db_name or not collection_name:
         raise ValueError("MONGO_DB and MONGO_COLLECTION_NAME must be set in .env")
@@ -101,10 +185,12 @@ def save_to_mongodb(chunks: List[Dict[str, Any]],
     
     # Prepare bulk operations
     operations = []
+    doc_ids = []
     
     for chunk in chunks:
         # Use the provided identifier format: {course_id}:{slide_id}:{chunk_index}
-        doc_id = f"{chunk['course_id']}:{chunk['slide_id']}:{chunk['chunk_index']}"
+        doc_id = _chunk_id(chunk)
+        doc_ids.append(doc_id)
         
         # Prepare document for MongoDB
         document = {
@@ -146,57 +232,140 @@ def save_to_mongodb(chunks: List[Dict[str, Any]],
         "total_chunks": len(chunks),
         "inserted": 0,
         "errors": [],
-        "duplicates": 0
+        "duplicates": 0,
+        "inserted_ids": []
     }
     
-    for i in range(0, len(operations), batch_size):
-        batch_ops = operations[i:i + batch_size]
-        
-        try:
-            result = collection.bulk_write(batch_ops, ordered=False)
-            stats["inserted"] += result.inserted_count
-        except BulkWriteError as e:
-            # Count successful inserts from partial results
-            if hasattr(e, 'details') and e.details:
-                stats["inserted"] += e.details.get('nInserted', 0)
-                # Count duplicate key errors
-                write_errors = e.details.get('writeErrors', [])
-                for error in write_errors:
-                    if error.get('code') == 11000:  # Duplicate key error
-                        stats["duplicates"] += 1
-            
-            stats["errors"].append({
-                "batch_start": i,
-                "batch_end": min(i + batch_size, len(operations)),
-                "error": str(e)
-            })
+    # Batches are independent unordered inserts, so write them concurrently
+    # (MongoClient is thread-safe and pools connections per worker)
+    batch_starts = range(0, len(operations), batch_size)
+    if len(batch_starts) <= 1 or max_workers <= 1:
+        outcomes = [_write_batch(collection, operations[i:i + batch_size], doc_ids[i:i + batch_size], i) for i in batch_starts]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batch_starts))) as executor:
+            outcomes = list(executor.map(
+                lambda i: _write_batch(collection, operations[i:i + batch_size], doc_ids[i:i + batch_size], i),
+                batch_starts
+            ))
+    
+    # Results come back in batch order, so errors stay ordered by batch_start
+    for outcome in outcomes:
+        stats["inserted"] += outcome["inserted"]
+        stats["duplicates"] += outcome["duplicates"]
+        stats["inserted_ids"].extend(outcome["inserted_ids"])
+        if outcome["error"]:
+            stats["errors"].append(outcome["error"])
     
     return stats
 
 
+def _rollback_saves(pending_saves: List[tuple], since: float,
+                    mongo_client: Optional[MongoClient] = None) -> None:
+    """
+    Delete the chunks this upload inserted, once its in-flight writes have landed.
+    
+    Only ids a batch reported as inserted are deleted, so chunks stored by an
+    earlier upload of the same slide (which made this run's inserts fail as
+    duplicates) are kept. A batch whose write raised reports nothing; its ids
+    are deleted only where updated_at shows this run wrote them.
+    
+    Args:
+        pending_saves: (offset, chunks, future) per submitted batch
+        since: time.time() taken before any document of this upload was built
+        mongo_client: Optional MongoClient instance (uses the shared client if not provided)
+    """
+    if not pending_saves:
+        return
+    wait([future for _, _, future in pending_saves])
+    
+    inserted_ids, unknown_ids = [], []
+    for _, batch, future in pending_saves:
+        if future.exception() is None:
+            inserted_ids.extend(future.result()["inserted_ids"])
+        else:
+            unknown_ids.extend(_chunk_id(chunk) for chunk in batch)
+    
+    conditions = []
+    if inserted_ids:
+        conditions.append({"_id": {"$in": inserted_ids}})
+    if unknown_ids:
+        conditions.append({"_id": {"$in": unknown_ids}, "updated_at": {"$gte": since}})
+    if not conditions:
+        return
+    
+    try:
+        settings = get_settings()
+        if mongo_client is None:
+            mongo_client = get_mongo_client()
+        collection = mongo_client[settings.mongo_db][settings.mongo_collection_name]
+        deleted = collection.delete_many({"$or": conditions}).deleted_count
+        logger.warning(f"Upload failed; deleted {deleted} chunks it had already saved")
+    except Exception as e:
+        logger.error(f"Upload failed and its saved chunks could not be deleted: {e}")
+
+
 def embed_and_save(chunks: List[Dict[str, Any]], 
                    api_key: str = None,
                    mongo_client: Optional[MongoClient] = None) -> Dict[str, Any]:
     """
     Convenience function to embed chunks and save to MongoDB in one operation.
     
+    Each embedding batch is written as soon as it is embedded, so MongoDB
+    writes overlap with the remaining Voyage requests. If a batch fails to
+    embed or save, the chunks this call already inserted are deleted again
+    before the error is raised, so a failed upload leaves nothing searchable
+    and chunks from earlier uploads are left alone.
+    
     Args:
         chunks: List of chunk dictionaries from chunking.py
         api_key: Optional Voyage API key
         mongo_client: Optional MongoClient instance
     
     Returns:
-        Dictionary with operation statistics
+        Dictionary with operation statistics (save_time is the time spent
+        waiting for writes after the last batch was embedded)
     """
-    # Embed chunks
-    start_time = time.time()
-    chunks_with_embeddings = embed_chunks(chunks, api_key)
-    embedding_time = time.time() - start_time
-    
-    # Save to MongoDB
-    start_time = time.time()
-    save_stats = save_to_mongodb(chunks_with_embeddings, mongo_client)
-    save_time = time.time() - start_time
+    # (offset, chunks, future) per embedded batch; list.append is atomic across threads
+    pending_saves = []
+    # Documents written by this call have updated_at at or after this
+    run_started = time.time()
+    
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="embedding_save_") as writer:
+        try:
+            # Embed chunks, handing each finished batch to the writer
+            start_time = time.perf_counter()
+            chunks_with_embeddings = embed_chunks(
+                chunks, api_key,
+                # One writer thread per batch; the embed workers already run concurrently
+                on_batch=lambda offset, batch: pending_saves.append(
+                    (offset, batch, writer.submit(save_to_mongodb, batch, mongo_client, max_workers=1))
+                )
+            )
+            embedding_time = time.perf_counter() - start_time
+            
+            # Wait for the remaining writes and merge their statistics in batch order
+            start_time = time.perf_counter()
+            save_stats = {
+                "total_chunks": len(chunks_with_embeddings),
+                "inserted": 0,
+                "errors": [],
+                "duplicates": 0
+            }
+            for offset, _, future in sorted(pending_saves, key=lambda item: item[0]):
+                batch_stats = future.result()
+                save_stats["inserted"] += batch_stats["inserted"]
+                save_stats["duplicates"] += batch_stats["duplicates"]
+                for error in batch_stats["errors"]:
+                    # Batch positions are relative to the embedding batch
+                    save_stats["errors"].append({
+                        **error,
+                        "batch_start": error["batch_start"] + offset,
+                        "batch_end": error["batch_end"] + offset
+                    })
+            save_time = time.perf_counter() - start_time
+        except Exception:
+            _rollback_saves(pending_saves, run_started, mongo_client)
+            raise
     
     # Return combined statistics
     return {
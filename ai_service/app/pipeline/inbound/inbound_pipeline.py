@@ -3,28 +3,27 @@ Inbound pipeline for processing PDFs: download from S3, chunk, embed, and save t
 Uses the new chunking.py and embedding.py modules.
 """
 
-import os
 import time
-import boto3
 import asyncio
 import logging
-from io import BytesIO
 from typing import Optional, Dict, Any
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Import our modules
+from app.config import get_settings
+from app.utils.s3_utils import get_s3_client
 from app.pipeline.inbound.chunking.chunking import chunk_pdf
-from app.pipeline.inbound.embedding.embedding import embed_and_save, get_mongo_client
+from app.pipeline.inbound.embedding.embedding import (
+    embed_and_save, get_mongo_client, cleanup_embedding_connections
+)
+from app.pipeline.outbound import rag_cache
+from app.pipeline.outbound.rag_retrieval import invalidate_course_caches
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Global thread pool for async operations
@@ -39,7 +38,7 @@ def get_thread_pool() -> ThreadPoolExecutor:
     return _thread_pool
 
 
-def download_pdf_from_s3_sync(s3_file_path: str) -> Optional[BytesIO]:
+def download_pdf_from_s3_sync(s3_file_path: str) -> Optional[bytes]:
     """
     Download PDF from S3 synchronously.
     
@@ -47,35 +46,29 @@ def download_pdf_from_s3_sync(s3_file_path: str) -> Optional[BytesIO]:
         s3_file_path: S3 path in format "path/to/file.pdf" (without bucket)
     
     Returns:
-        BytesIO containing the PDF data, or None if failed
+        The PDF data, or None if failed
     """
     try:
-        bucket_name = os.getenv("S3_BUCKET_NAME")
+        bucket_name = get_settings().s3_bucket
         if not bucket_name:
             logger.error("S3_BUCKET_NAME environment variable not set")
             return None
         
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
+        # Shared, pooled S3 client (built once per process)
+        s3_client = get_s3_client()
         
-        # Download file
-        file_stream = BytesIO()
-        s3_client.download_fileobj(bucket_name, s3_file_path, file_stream)
-        file_stream.seek(0)
+        # Read the object body straight into bytes; fitz opens them without another copy
+        pdf_bytes = s3_client.get_object(Bucket=bucket_name, Key=s3_file_path)['Body'].read()
         
         logger.info(f"Successfully downloaded {s3_file_path} from S3 bucket {bucket_name}")
-        return file_stream
+        return pdf_bytes
         
     except Exception as e:
         logger.error(f"Failed to download {s3_file_path} from S3: {str(e)}")
         return None
 
 
-async def download_pdf_from_s3(s3_file_path: str) -> Optional[BytesIO]:
+async def download_pdf_from_s3(s3_file_path: str) -> Optional[bytes]:
     """
     Download PDF from S3 asynchronously.
     
@@ -83,10 +76,10 @@ async def download_pdf_from_s3(s3_file_path: str) -> Optional[BytesIO]:
         s3_file_path: S3 path in format "path/to/file.pdf" (without bucket)
     
     Returns:
-        BytesIO containing the PDF data, or None if failed
+        The PDF data, or None if failed
     """
     thread_pool = get_thread_pool()
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     return await loop.run_in_executor(thread_pool, download_pdf_from_s3_sync, s3_file_path)
 
 
@@ -102,13 +95,13 @@ def process_pdf_sync(course_id: str, slide_id: str, s3_file_path: str) -> Dict[s
     Returns:
         Dictionary with processing results and statistics
     """
-    pipeline_start = time.time()
+    pipeline_start = time.perf_counter()
     logger.info(f"Starting PDF processing pipeline for: {s3_file_path}")
     
     # Step 1: Download PDF from S3
-    step_start = time.time()
-    file_stream = download_pdf_from_s3_sync(s3_file_path)
-    if file_stream is None:
+    step_start = time.perf_counter()
+    pdf_bytes = download_pdf_from_s3_sync(s3_file_path)
+    if pdf_bytes is None:
         return {
             "success": False,
             "error": "Failed to download PDF from S3",
@@ -116,21 +109,21 @@ def process_pdf_sync(course_id: str, slide_id: str, s3_file_path: str) -> Dict[s
             "slide_id": slide_id,
             "s3_file_path": s3_file_path
         }
-    download_time = time.time() - step_start
-    file_size_mb = len(file_stream.getvalue()) / (1024 * 1024)
+    download_time = time.perf_counter() - step_start
+    file_size_mb = len(pdf_bytes) / (1024 * 1024)
     logger.info(f"Downloaded {file_size_mb:.2f} MB in {download_time:.2f}s")
     
     # Step 2: Chunk the PDF
-    step_start = time.time()
+    step_start = time.perf_counter()
     try:
         chunks = chunk_pdf(
             course_id=course_id,
             slide_id=slide_id,
             s3_file_name=s3_file_path,
-            file_stream=file_stream,
+            pdf_bytes=pdf_bytes,
             max_words=350
         )
-        chunking_time = time.time() - step_start
+        chunking_time = time.perf_counter() - step_start
         logger.info(f"Created {len(chunks)} chunks in {chunking_time:.2f}s")
     except Exception as e:
         logger.error(f"Failed to chunk PDF: {str(e)}")
@@ -143,11 +136,11 @@ def process_pdf_sync(course_id: str, slide_id: str, s3_file_path: str) -> Dict[s
         }
     
     # Step 3: Embed chunks and save to MongoDB
-    step_start = time.time()
+    step_start = time.perf_counter()
     try:
         # Use the combined embed_and_save function
         result = embed_and_save(chunks)
-        embed_save_time = time.time() - step_start
+        embed_save_time = time.perf_counter() - step_start
         
         logger.info(f"Embedded and saved {result['save_stats']['inserted']} chunks in {embed_save_time:.2f}s")
         if result['save_stats'].get('duplicates', 0) > 0:
@@ -164,8 +157,17 @@ def process_pdf_sync(course_id: str, slide_id: str, s3_file_path: str) -> Dict[s
             "chunks_created": len(chunks)
         }
     
+    # Cached retrieval results for this course predate the new chunks; the
+    # upload itself succeeded, so a failed invalidation is only logged.
+    # In-process caches are dropped by process_pdf_pipeline on the event loop.
+    try:
+        if rag_cache.is_enabled():
+            rag_cache.invalidate_course(get_mongo_client(), course_id, slide_id)
+    except Exception as e:
+        logger.error(f"Failed to invalidate retrieval caches for course {course_id}: {str(e)}")
+    
     # Calculate total time
-    total_time = time.time() - pipeline_start
+    total_time = time.perf_counter() - pipeline_start
     
     # Return success result
     return {
@@ -208,14 +210,24 @@ async def process_pdf_pipeline(course_id: str, slide_id: str, s3_file_path: str)
     """
     # Run the synchronous version in thread pool
     thread_pool = get_thread_pool()
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
         thread_pool,
         process_pdf_sync,
         course_id,
         slide_id,
         s3_file_path
     )
+    
+    # The in-process retrieval caches are owned by the event loop, so they are
+    # invalidated here rather than from the worker thread
+    if result.get("success"):
+        try:
+            invalidate_course_caches(course_id)
+        except Exception as e:
+            logger.error(f"Failed to invalidate retrieval caches for course {course_id}: {str(e)}")
+    
+    return result
 
 
 def cleanup_connections():
@@ -226,6 +238,8 @@ def cleanup_connections():
         _thread_pool.shutdown(wait=True)
         _thread_pool = None
     
+    cleanup_embedding_connections()
+    
     logger.info("Inbound pipeline connections cleaned up")
 
 
@@ -1,6 +1,5 @@
 # Deletion functionality - delete documents from MongoDB based on metadata filters
 
-import os
 import logging
 import time
 import asyncio
@@ -9,6 +8,10 @@ from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
 from dotenv import load_dotenv
 
+from app.config import get_settings
+from app.pipeline.outbound import rag_cache
+from app.pipeline.outbound.rag_retrieval import invalidate_course_caches
+
 # Load environment variables
 load_dotenv()
 
@@ -32,7 +35,7 @@ def get_mongo_client() -> MongoClient:
     """Get or create MongoDB client (singleton)"""
     global _mongo_client
     if _mongo_client is None:
-        mongo_uri = os.getenv('MONGO_URI')
+        mongo_uri = get_settings().mongo_uri
         if not mongo_uri:
             raise ValueError("MONGO_URI not found in .env file")
         _mongo_client = MongoClient(mongo_uri)
@@ -40,44 +43,6 @@ def get_mongo_client() -> MongoClient:
     return _mongo_client
 
 
-def count_documents_sync(course_id: str, slide_id: str, s3_file_name: str) -> int:
-    """
-    Count documents in MongoDB based on metadata filters
-    
-    Args:
-        course_id: Course identifier to filter by
-        slide_id: Slide identifier to filter by
-        s3_file_name: S3 file name to filter by
-    
-    Returns:
-        Number of documents matching the criteria
-    """
-    # Get MongoDB configuration
-    db_name = os.getenv('MONGO_DB')
-    collection_name = os.getenv('MONGO_COLLECTION_NAME')
-    
-    if not db_name or not collection_name:
-        raise ValueError("MONGO_DB and MONGO_COLLECTION_NAME must be set in .env")
-    
-    # Get client and collection
-    client = get_mongo_client()
-    db = client[db_name]
-    collection = db[collection_name]
-    
-    # Build filter
-    filter_query = {}
-    if course_id:
-        filter_query["course_id"] = course_id
-    if slide_id:
-        filter_query["slide_id"] = slide_id
-    if s3_file_name:
-        filter_query["s3_file_name"] = s3_file_name
-    
-    # Count documents
-    count = collection.count_documents(filter_query)
-    return count
-
-
 def delete_documents_sync(course_id: str, slide_id: str, s3_file_name: str) -> Dict[str, any]:
     """
     Delete documents from MongoDB based on metadata filters
@@ -91,8 +56,9 @@ def delete_documents_sync(course_id: str, slide_id: str, s3_file_name: str) -> D
         Dictionary with deletion results
     """
     # Get MongoDB configuration
-    db_name = os.getenv('MONGO_DB')
-    collection_name = os.getenv('MONGO_COLLECTION_NAME')
+    settings = get_settings()
+    db_name = settings.mongo_db
+    collection_name = settings.mongo_collection_name
     
     if not db_name or not collection_name:
         raise ValueError("MONGO_DB and MONGO_COLLECTION_NAME must be set in .env")
@@ -114,6 +80,15 @@ def delete_documents_sync(course_id: str, slide_id: str, s3_file_name: str) -> D
     # Delete documents
     result = collection.delete_many(filter_query)
     
+    # Cached retrieval results may reference the deleted chunks; the delete
+    # itself succeeded, so a failed invalidation is only logged. In-process
+    # caches are dropped by delete_vectors_by_metadata on the event loop.
+    if result.deleted_count:
+        try:
+            rag_cache.invalidate_course(client, course_id, slide_id)
+        except Exception as e:
+            logger.error(f"Failed to invalidate retrieval caches for course {course_id}: {str(e)}")
+    
     return {
         "deleted_count": result.deleted_count,
         "acknowledged": result.acknowledged
@@ -133,24 +108,35 @@ async def delete_vectors_by_metadata(course_id: str, slide_id: str, s3_file_name
         dict: Deletion results with success status
     """
     logger.info(f"Starting document deletion for: course_id={course_id}, slide_id={slide_id}, s3_file_name={s3_file_name}")
-    deletion_start_time = time.time()
+    deletion_start_time = time.perf_counter()
     
     try:
-        # Count documents first (run in thread pool)
+        # Delete documents (run in thread pool); delete_many reports how many
+        # matched, so no separate count round-trip is needed
         thread_pool = get_thread_pool()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         
-        documents_to_delete = await loop.run_in_executor(
-            thread_pool, 
-            count_documents_sync, 
-            course_id, 
-            slide_id, 
+        delete_result = await loop.run_in_executor(
+            thread_pool,
+            delete_documents_sync,
+            course_id,
+            slide_id,
             s3_file_name
         )
         
-        logger.info(f"Found {documents_to_delete} documents matching deletion criteria")
+        # The in-process retrieval caches are owned by the event loop, so they
+        # are invalidated here rather than from the worker thread
+        if delete_result["deleted_count"]:
+            try:
+                invalidate_course_caches(course_id or None)
+            except Exception as e:
+                logger.error(f"Failed to invalidate retrieval caches for course {course_id}: {str(e)}")
+        
+        # Calculate processing time
+        deletion_end_time = time.perf_counter()
+        processing_time_ms = int((deletion_end_time - deletion_start_time) * 1000)
         
-        if documents_to_delete == 0:
+        if delete_result["acknowledged"] and delete_result["deleted_count"] == 0:
             logger.info("No documents found matching the specified criteria")
             return {
                 "success": True,
@@ -159,22 +145,9 @@ async def delete_vectors_by_metadata(course_id: str, slide_id: str, s3_file_name
                 "slide_id": slide_id,
                 "s3_file_name": s3_file_name,
                 "vectors_deleted": 0,
-                "processing_time_ms": int((time.time() - deletion_start_time) * 1000)
+                "processing_time_ms": processing_time_ms
             }
         
-        # Delete documents (run in thread pool)
-        delete_result = await loop.run_in_executor(
-            thread_pool,
-            delete_documents_sync,
-            course_id,
-            slide_id,
-            s3_file_name
-        )
-        
-        # Calculate processing time
-        deletion_end_time = time.time()
-        processing_time_ms = int((deletion_end_time - deletion_start_time) * 1000)
-        
         if delete_result["acknowledged"]:
             logger.info(f"Successfully deleted {delete_result['deleted_count']} documents in {processing_time_ms}ms")
             return {
@@ -190,7 +163,7 @@ async def delete_vectors_by_metadata(course_id: str, slide_id: str, s3_file_name
             raise Exception("MongoDB delete operation was not acknowledged")
         
     except Exception as e:
-        processing_time_ms = int((time.time() - deletion_start_time) * 1000)
+        processing_time_ms = int((time.perf_counter() - deletion_start_time) * 1000)
         logger.error(f"Failed to delete documents: {str(e)}")
         return {
             "success": False, 
@@ -1,53 +1,92 @@
 """
 Outbound pipeline module for processing user queries with intelligent agent.
+
+Symbols are resolved lazily (PEP 562) so importing one submodule does not
+pull in the LLM, Redis and MongoDB clients of the others.
 """
 
-from .outbound_pipeline import (
-    OutboundRequest,
-    ChatResponseDTO,
-    RagSource,
-    WebSource,
-    process_outbound_pipeline,
-    cleanup_outbound_connections
-)
-
-from .agent import (
-    SearchType,
-    process_agent_query,
-    cleanup_agent_connections
-)
-
-from .rag_retrieval import (
-    retrieve_similar_chunks_async,
-    cleanup_rag_connections
-)
-
-from .agent_state import (
-    AgentStateManager,
-    cleanup_agent_state_connections
-)
-
-__all__ = [
+import asyncio
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Exported symbol -> submodule that defines it
+_LAZY = {
     # Pipeline functions
-    "process_outbound_pipeline",
-    "cleanup_outbound_connections",
-    
+    "process_outbound_pipeline": "outbound_pipeline",
+
     # Models
-    "OutboundRequest",
-    "ChatResponseDTO",
-    "RagSource",
-    "WebSource",
-    "SearchType",
-    
+    "OutboundRequest": "outbound_pipeline",
+    "ChatResponseDTO": "outbound_pipeline",
+    "RagSource": "outbound_pipeline",
+    "WebSource": "outbound_pipeline",
+    "SearchType": "agent",
+
     # Agent functions
-    "process_agent_query",
-    "cleanup_agent_connections",
-    
+    "process_agent_query": "agent",
+    "cleanup_agent_connections": "agent",
+
     # RAG functions
-    "retrieve_similar_chunks_async",
-    "cleanup_rag_connections",
-    
+    "retrieve_similar_chunks_async": "rag_retrieval",
+    "cleanup_rag_connections": "rag_retrieval",
+
     # State management
-    "AgentStateManager",
-    "cleanup_agent_state_connections"
-] 
\ No newline at end of file
+    "AgentStateManager": "agent_state",
+    "cleanup_agent_state_connections": "agent_state",
+}
+
+# Exports follow _LAZY so dir() and star-imports share one source of truth
+__all__ = tuple(_LAZY) + ("cleanup_all",)
+
+
+async def cleanup_all():
+    """
+    Close every outbound connection concurrently.
+
+    Pending state saves are flushed first. Then the async clients are closed
+    on the event loop, alongside the blocking client closes running in worker
+    threads, so shutdown takes as long as the slowest close.
+    Agent cleanup also closes the agent state clients.
+    """
+    from .agent import cleanup_agent_connections
+    from .agent_state import close_redis_client, flush_pending_saves
+    from .conversation_reader import cleanup_conversation_reader
+    from .rag_retrieval import cleanup_rag_connections, close_embedding_batcher, close_mongo_client
+
+    # Coalesced state saves must land before their clients are closed
+    try:
+        await flush_pending_saves()
+    except Exception as e:
+        logger.error(f"Error flushing pending state saves: {e}")
+
+    # gather starts these in order and each async close takes its client before
+    # its first await, so the thread cleanups below cannot drop one unclosed
+    closes = {
+        "agent state Redis client": close_redis_client(),
+        "embedding batcher": close_embedding_batcher(),
+        "RAG MongoDB client": close_mongo_client(),
+        "agent connections": asyncio.to_thread(cleanup_agent_connections),
+        "RAG connections": asyncio.to_thread(cleanup_rag_connections),
+        "conversation reader": asyncio.to_thread(cleanup_conversation_reader),
+    }
+    results = await asyncio.gather(*closes.values(), return_exceptions=True)
+    for name, result in zip(closes, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error closing {name}: {result}")
+    logger.info("Outbound pipeline connections cleaned up")
+
+
+def __getattr__(name):
+    """Import the defining submodule on first access and cache the symbol."""
+    module_name = _LAZY.get(name)
+    if not module_name:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{module_name}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return __all__
@@ -3,13 +3,14 @@ Intelligent agent for handling queries with RAG search, web search, or direct LL
 Uses LangGraph for orchestration and manages conversation state.
 """
 
-import os
-import json
+import asyncio
+import orjson
 import logging
 import uuid
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Annotated, TypedDict, Optional, List, Dict, Any
+from functools import lru_cache
+from typing import Annotated, TypedDict, Optional, List, Dict, Any, Tuple
 
 # LangChain/LangGraph imports
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
@@ -21,20 +22,16 @@ from langchain_core.runnables import RunnableConfig
 from pydantic import BaseModel, Field
 
 # Local imports
-from app.pipeline.outbound.agent_state import AgentStateManager
+from app.config import get_settings
+from app.pipeline.outbound.agent_state import get_state_manager
 from app.pipeline.outbound.agent_tools import (
     rag_search_tool,
     web_search_tool,
-    create_retrieve_previous_sources_tool
+    create_retrieve_previous_sources_tool,
+    cap_source_text
 )
-from dotenv import load_dotenv
-
-# Load environment variables
-if not os.getenv('OPENAI_API_KEY'):
-    load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -93,6 +90,8 @@ class GraphState(TypedDict):
     snapshot: Optional[Dict[str, Any]]
     rag_sources: List[Dict[str, Any]]
     web_sources: List[Dict[str, Any]]
+    rag_source_ids: List[str]
+    web_source_ids: List[str]
     image_sources: List[Dict[str, Any]]
     final_response: Optional[str]
     sources_map: Optional[Dict[str, Dict[str, Any]]]
@@ -100,30 +99,145 @@ class GraphState(TypedDict):
     web_counter: int
 
 
+@lru_cache(maxsize=1)
+def get_llm() -> ChatGoogleGenerativeAI:
+    """
+    Get the shared Gemini 2.5 Flash chat model.
+    
+    The model holds the Gemini client and its connection pool, so one
+    instance is reused by every request instead of being rebuilt per query.
+    """
+    google_api_key = get_settings().google_api_key
+    if not google_api_key:
+        raise ValueError("GOOGLE_API_KEY not found in environment")
+    
+    logger.info("Gemini chat model initialized")
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        google_api_key=google_api_key,
+        temperature=0.3,
+        max_output_tokens=4096,
+        convert_system_message_to_human=True  # Gemini doesn't support system messages directly
+    )
+
+
+@lru_cache(maxsize=256)
+def _system_prompt(search_type: SearchType, course_id: str, slides_priority: Tuple[str, ...], has_snapshot: bool) -> str:
+    """
+    Build the system prompt for a search type and context.
+    
+    Cached because the agent node sends it on every step of the tool loop and
+    the same course/slides/search type combinations repeat across requests.
+    """
+    base_prompt = f"""You are an intelligent assistant helping students with course materials.
+Course ID: {course_id}"""
+    
+    if slides_priority:
+        base_prompt += f"\nPriority slides: {', '.join(slides_priority)}"
+    
+    # Add image information if snapshot is available
+    if has_snapshot:
+        base_prompt += """\n\nIMPORTANT: The user has provided a snapshot of course material with their question. 
+The image has been included in your message for direct analysis.
+
+CITATION RULES FOR IMAGES:
+- You MUST cite [^Page] whenever you reference ANY information from the snapshot
+- Place [^Page] immediately after mentioning content from the image
+- Examples:
+  - "The diagram shows three components [^Page]..."
+  - "According to the formula on the slide [^Page]..."
+  - "The image contains a flowchart [^Page] that illustrates..."
+- ALWAYS cite [^Page] when discussing what you see in the image"""
+    
+    if search_type == SearchType.DEFAULT:
+        return base_prompt + """
+            
+Answer the user's question based on your general knowledge. Be helpful and informative.
+
+Available tools:
+- retrieve_previous_sources: Access full source content from previous tool calls
+
+IMPORTANT: To save context, tool message content is truncated in the conversation history. 
+You can see which tools were called, but to access the full source content, use retrieve_previous_sources with the tool message IDs."""
+    
+    elif search_type == SearchType.RAG:
+        return base_prompt + """
+            
+You MUST use the rag_search_tool to find relevant information from the course materials.
+Steps:
+1. Analyze if the question requires information from course materials or can be answered from conversation history
+2. If new information is needed, create an optimized search query for vector search
+3. Call rag_search_tool with the query
+4. Answer based ONLY on the retrieved information
+5. Cite sources using [^n] format where n is the source number. For multiple sources, use [^n][^m] format where n and m are the source numbers.
+6. Place citations inline, not at the end
+7. If a snapshot was provided, cite it as [^Page] whenever you reference it
+
+IMPORTANT: To save context, tool message content is truncated in the conversation history.
+- You can see which tools were called and how many sources were retrieved
+- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
+- Each tool call has unique source IDs that continue from previous calls (1-10, then 11-20, etc.)"""
+    
+    elif search_type == SearchType.WEB:
+        return base_prompt + """
+            
+You MUST use the web_search_tool to find current information from the internet.
+Steps:
+1. Create an effective web search query
+2. Call web_search_tool with the query
+3. Answer based on the web results
+4. Cite sources using {^n} format where n is the source number. For multiple sources, use {^n}{^m} format where n and m are the source numbers.
+5. Place citations inline, not at the end
+6. If a snapshot was provided, cite it as [^Page] whenever you reference it
+
+IMPORTANT: To save context, tool message content is truncated in the conversation history.
+- You can see which tools were called and how many sources were retrieved
+- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
+- Each tool call has unique source IDs that continue from previous calls (1-5, then 6-10, etc.)"""
+    
+    else:  # RAG_WEB
+        return base_prompt + """
+            
+You have access to both course materials (rag_search_tool) and web search (web_search_tool).
+Steps:
+1. Determine what information is needed
+2. Use rag_search_tool for course-specific information
+3. Use web_search_tool for current events or supplementary information
+4. Synthesize information from both sources
+5. Cite RAG sources using [^n] and web sources using {^n}. For multiple sources, use [^n][^m] and {^n}{^m} respectively.
+6. Place citations inline, not at the end
+7. If a snapshot was provided, cite it as [^Page] whenever you reference it
+
+IMPORTANT: To save context, tool message content is truncated in the conversation history.
+- You can see which tools were called and how many sources were retrieved
+- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
+- Each tool call maintains unique source IDs (RAG: 1-10, then 11-20; Web: 1-5, then 6-10, etc.)"""
+
+
+def _for_model(message):
+    """The message as the model should see it: RAG tool results get their chunk text capped."""
+    if isinstance(message, ToolMessage) and message.name == "rag_search_tool" and isinstance(message.content, str):
+        capped = cap_source_text(message.content)
+        if capped is not message.content:
+            return message.model_copy(update={"content": capped})
+    return message
+
+
 class OutboundAgent:
     """Main agent class for handling queries with different search types."""
     
     def __init__(self):
-        # Initialize Gemini 2.5 Flash
-        google_api_key = os.getenv("GOOGLE_API_KEY")
-        if not google_api_key:
-            raise ValueError("GOOGLE_API_KEY not found in environment")
-        
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=google_api_key,
-            temperature=0.3,
-            max_output_tokens=4096,
-            convert_system_message_to_human=True  # Gemini doesn't support system messages directly
-        )
+        # Shared Gemini 2.5 Flash model
+        self.llm = get_llm()
         
         # Initialize state manager
-        self.state_manager = AgentStateManager()
+        self.state_manager = get_state_manager()
         
         # Initialize with no specific user/course context
         self.user_id = None
         self.course_id = None
         self.retrieve_previous_sources_tool = None
+        self.llm_with_tools = self.llm
     
     def _get_tools_for_search_type(self, search_type: SearchType) -> List:
         """Get the appropriate tools based on search type."""
@@ -147,9 +261,13 @@ class OutboundAgent:
         base_tool_node = ToolNode(tools)
         
         async def custom_tool_node(state: GraphState, config: RunnableConfig) -> Dict[str, Any]:
-            # Get current counters from state
+            # Get current counters and the sources collected so far from state
             rag_counter = state.get("rag_counter", 0)
             web_counter = state.get("web_counter", 0)
+            rag_sources = list(state.get("rag_sources", []))
+            web_sources = list(state.get("web_sources", []))
+            rag_source_ids = list(state.get("rag_source_ids", []))
+            web_source_ids = list(state.get("web_source_ids", []))
             
             # Execute the tools normally
             result = await base_tool_node.ainvoke(state, config)
@@ -160,14 +278,27 @@ class OutboundAgent:
                 if isinstance(msg, ToolMessage):
                     try:
                         if msg.content and isinstance(msg.content, str):
-                            tool_result = json.loads(msg.content)
+                            tool_result = orjson.loads(msg.content)
+                            
+                            # Source messages need a stable ID to be referenced when saved
+                            if not msg.id:
+                                msg.id = str(uuid.uuid4())
                             
-                            # Renumber RAG sources
+                            # Renumber RAG sources and collect them for the response in the same pass
                             if msg.name == "rag_search_tool" and tool_result.get("success"):
                                 results = tool_result.get("results", [])
                                 for source in results:
                                     rag_counter += 1
                                     source["id"] = str(rag_counter)
+                                    rag_sources.append({
+                                        "id": source["id"],
+                                        "slide": source["slide"],
+                                        "s3file": source["s3file"],
+                                        "start": source["start"],
+                                        "end": source["end"],
+                                        "text": source["text"]
+                                    })
+                                rag_source_ids.append(msg.id)
                                 logger.info(f"Renumbered RAG sources: {len(results)} sources, IDs {rag_counter - len(results) + 1} to {rag_counter}")
                             
                             # Renumber Web sources
@@ -176,19 +307,30 @@ class OutboundAgent:
                                 for source in results:
                                     web_counter += 1
                                     source["id"] = str(web_counter)
+                                    web_sources.append({
+                                        "id": source["id"],
+                                        "title": source["title"],
+                                        "url": source["url"],
+                                        "text": source["text"]
+                                    })
+                                web_source_ids.append(msg.id)
                                 logger.info(f"Renumbered Web sources: {len(results)} sources, IDs {web_counter - len(results) + 1} to {web_counter}")
                             
                             # Update the tool message content with renumbered sources
-                            msg.content = json.dumps(tool_result)
+                            msg.content = orjson.dumps(tool_result).decode()
                             
                     except Exception as e:
                         logger.error(f"Error processing tool result for renumbering: {e}")
             
-            # Return updated messages and counters
+            # Return updated messages, counters and sources
             return {
                 "messages": messages,
                 "rag_counter": rag_counter,
-                "web_counter": web_counter
+                "web_counter": web_counter,
+                "rag_sources": rag_sources,
+                "web_sources": web_sources,
+                "rag_source_ids": rag_source_ids,
+                "web_source_ids": web_source_ids
             }
         
         return custom_tool_node
@@ -210,6 +352,9 @@ class OutboundAgent:
         # Get tools based on search type to restrict what can be executed
         allowed_tools = self._get_tools_for_search_type(search_type)
         
+        # Bind tools once per graph; converting tool schemas on every agent step is wasted work
+        self.llm_with_tools = self.llm.bind_tools(allowed_tools) if allowed_tools else self.llm
+        
         # Create custom tool node with state awareness
         workflow.add_node("tools", self._create_custom_tool_node(allowed_tools))
         workflow.add_node("format_response", self._format_response_node)
@@ -239,21 +384,12 @@ class OutboundAgent:
         slides_priority = state.get("slides_priority", [])
         snapshot = state.get("snapshot")
         
-        # Get appropriate tools
-        tools = self._get_tools_for_search_type(search_type)
-        
         # Build system prompt based on search type
         system_prompt = self._build_system_prompt(search_type, course_id, slides_priority, has_snapshot=bool(snapshot))
         
-        # Bind tools to LLM
-        if tools:
-            llm_with_tools = self.llm.bind_tools(tools)
-        else:
-            llm_with_tools = self.llm
-        
-        # Invoke LLM
-        messages_with_system = [SystemMessage(content=system_prompt)] + messages
-        response = await llm_with_tools.ainvoke(messages_with_system)
+        # Invoke LLM (tools were bound when the graph was built)
+        messages_with_system = [SystemMessage(content=system_prompt)] + [_for_model(msg) for msg in messages]
+        response = await self.llm_with_tools.ainvoke(messages_with_system)
         
         # Extract sources from tool calls if any
         if hasattr(response, "tool_calls") and response.tool_calls:
@@ -269,97 +405,16 @@ class OutboundAgent:
     
     def _build_system_prompt(self, search_type: SearchType, course_id: str, slides_priority: List[str], has_snapshot: bool = False) -> str:
         """Build the system prompt based on search type and context."""
-        base_prompt = f"""You are an intelligent assistant helping students with course materials.
-Course ID: {course_id}"""
-        
-        if slides_priority:
-            base_prompt += f"\nPriority slides: {', '.join(slides_priority)}"
-        
-        # Add image information if snapshot is available
-        if has_snapshot:
-            base_prompt += """\n\nIMPORTANT: The user has provided a snapshot of course material with their question. 
-The image has been included in your message for direct analysis.
-
-CITATION RULES FOR IMAGES:
-- You MUST cite [^Page] whenever you reference ANY information from the snapshot
-- Place [^Page] immediately after mentioning content from the image
-- Examples:
-  - "The diagram shows three components [^Page]..."
-  - "According to the formula on the slide [^Page]..."
-  - "The image contains a flowchart [^Page] that illustrates..."
-- ALWAYS cite [^Page] when discussing what you see in the image"""
-        
-        if search_type == SearchType.DEFAULT:
-            return base_prompt + """
-            
-Answer the user's question based on your general knowledge. Be helpful and informative.
-
-Available tools:
-- retrieve_previous_sources: Access full source content from previous tool calls
-
-IMPORTANT: To save context, tool message content is truncated in the conversation history. 
-You can see which tools were called, but to access the full source content, use retrieve_previous_sources with the tool message IDs."""
-        
-        elif search_type == SearchType.RAG:
-            return base_prompt + """
-            
-You MUST use the rag_search_tool to find relevant information from the course materials.
-Steps:
-1. Analyze if the question requires information from course materials or can be answered from conversation history
-2. If new information is needed, create an optimized search query for vector search
-3. Call rag_search_tool with the query
-4. Answer based ONLY on the retrieved information
-5. Cite sources using [^n] format where n is the source number. For multiple sources, use [^n][^m] format where n and m are the source numbers.
-6. Place citations inline, not at the end
-7. If a snapshot was provided, cite it as [^Page] whenever you reference it
-
-IMPORTANT: To save context, tool message content is truncated in the conversation history.
-- You can see which tools were called and how many sources were retrieved
-- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
-- Each tool call has unique source IDs that continue from previous calls (1-10, then 11-20, etc.)"""
-        
-        elif search_type == SearchType.WEB:
-            return base_prompt + """
-            
-You MUST use the web_search_tool to find current information from the internet.
-Steps:
-1. Create an effective web search query
-2. Call web_search_tool with the query
-3. Answer based on the web results
-4. Cite sources using {^n} format where n is the source number. For multiple sources, use {^n}{^m} format where n and m are the source numbers.
-5. Place citations inline, not at the end
-6. If a snapshot was provided, cite it as [^Page] whenever you reference it
-
-IMPORTANT: To save context, tool message content is truncated in the conversation history.
-- You can see which tools were called and how many sources were retrieved
-- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
-- Each tool call has unique source IDs that continue from previous calls (1-5, then 6-10, etc.)"""
-        
-        else:  # RAG_WEB
-            return base_prompt + """
-            
-You have access to both course materials (rag_search_tool) and web search (web_search_tool).
-Steps:
-1. Determine what information is needed
-2. Use rag_search_tool for course-specific information
-3. Use web_search_tool for current events or supplementary information
-4. Synthesize information from both sources
-5. Cite RAG sources using [^n] and web sources using {^n}. For multiple sources, use [^n][^m] and {^n}{^m} respectively.
-6. Place citations inline, not at the end
-7. If a snapshot was provided, cite it as [^Page] whenever you reference it
-
-IMPORTANT: To save context, tool message content is truncated in the conversation history.
-- You can see which tools were called and how many sources were retrieved
-- To access the full source content from previous queries, use retrieve_previous_sources with the tool message IDs
-- Each tool call maintains unique source IDs (RAG: 1-10, then 11-20; Web: 1-5, then 6-10, etc.)"""
+        return _system_prompt(search_type, course_id, tuple(slides_priority), has_snapshot)
     
     async def _format_response_node(self, state: GraphState, config: RunnableConfig) -> Dict[str, Any]:
         """Format the final response with sources."""
         messages = state["messages"]
-        rag_source_ids = []
-        web_source_ids = []
-        rag_sources = []
-        web_sources = []
+        # Sources were collected (and renumbered) by the tool node as they came in
+        rag_source_ids = state.get("rag_source_ids", [])
+        web_source_ids = state.get("web_source_ids", [])
+        rag_sources = state.get("rag_sources", [])
+        web_sources = state.get("web_sources", [])
         image_sources = []
         
         # Extract the final AI message
@@ -371,71 +426,6 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
                 final_ai_msg_index = i
                 break
         
-        # Find the last human message before the final AI message
-        last_human_msg_index = -1
-        for i in range(final_ai_msg_index - 1, -1, -1):
-            if isinstance(messages[i], HumanMessage):
-                last_human_msg_index = i
-                break
-        
-        # Only process tool messages between the last human message and final AI message
-        # This ensures we only get sources from the current query
-        start_index = last_human_msg_index if last_human_msg_index >= 0 else 0
-        
-        # Collect IDs and sources from tool messages
-        for i in range(start_index, len(messages)):
-            msg = messages[i]
-            if isinstance(msg, ToolMessage):
-                try:
-                    # Handle different content types
-                    if not msg.content:
-                        logger.warning(f"Empty content for tool message: {msg.name}")
-                        continue
-                    
-                    tool_result = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
-                    
-                    # Ensure the tool message has an ID
-                    if not hasattr(msg, 'id') or not msg.id:
-                        msg.id = str(uuid.uuid4())
-                    
-                    # Process RAG sources (already have unique IDs from custom tool node)
-                    if msg.name == "rag_search_tool" and tool_result.get("success"):
-                        rag_source_ids.append(msg.id)
-                        logger.info(f"Added RAG source tool message ID: {msg.id}")
-                        
-                        # Extract sources - they already have unique IDs
-                        for source in tool_result.get("results", []):
-                            rag_sources.append(RagSource(
-                                id=source["id"],  # Already unique from custom tool node
-                                slide=source["slide"],
-                                s3file=source["s3file"],
-                                start=source["start"],
-                                end=source["end"],
-                                text=source["text"]
-                            ))
-                    
-                    # Process Web sources (already have unique IDs from custom tool node)
-                    elif msg.name == "web_search_tool" and tool_result.get("success"):
-                        web_source_ids.append(msg.id)
-                        logger.info(f"Added web source tool message ID: {msg.id}")
-                        
-                        # Extract sources - they already have unique IDs
-                        for source in tool_result.get("results", []):
-                            web_sources.append(WebSource(
-                                id=source["id"],  # Already unique from custom tool node
-                                title=source["title"],
-                                url=source["url"],
-                                text=source["text"]
-                            ))
-                    
-                            
-                except json.JSONDecodeError as e:
-                    logger.error(f"JSON decode error for tool {getattr(msg, 'name', 'unknown')}: {e}")
-                    logger.error(f"Content type: {type(msg.content)}, Content: {msg.content[:200] if msg.content else 'None'}")
-                except Exception as e:
-                    logger.error(f"Error processing tool message {getattr(msg, 'name', 'unknown')}: {e}")
-                    logger.error(f"Full error details: ", exc_info=True)
-        
         # Find the final AI message and assign it an ID if it doesn't have one
         message_id = None
         if final_ai_msg_index >= 0:
@@ -449,14 +439,14 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
         # Check if snapshot was provided and add as image source
         if state.get("snapshot"):
             snapshot = state["snapshot"]
-            image_sources.append(ImageSource(
-                id="page",
-                type="current",
-                message_id=None,
-                timestamp=datetime.now(timezone.utc).isoformat(),
-                slide_id=snapshot.get("slide_id"),
-                page_number=snapshot.get("page_number")
-            ))
+            image_sources.append({
+                "id": "page",
+                "type": "current",
+                "message_id": None,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "slide_id": snapshot.get("slide_id"),
+                "page_number": snapshot.get("page_number")
+            })
         
         # Store source message IDs in the state for later saving with the AI message
         sources_data = None
@@ -478,9 +468,9 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
         
         return {
             "final_response": final_message,
-            "rag_sources": [s.model_dump() for s in rag_sources],
-            "web_sources": [s.model_dump() for s in web_sources],
-            "image_sources": [s.model_dump() for s in image_sources],
+            "rag_sources": rag_sources,
+            "web_sources": web_sources,
+            "image_sources": image_sources,
             "sources_map": sources_data
         }
     
@@ -507,6 +497,12 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
         Returns:
             AgentResponse with the answer and sources
         """
+        # Load the conversation history (Redis, possibly MongoDB) while the
+        # snapshot URL is signed and the graph is built; none depend on it
+        history_task = asyncio.create_task(
+            self.state_manager.get_conversation_history(user_id, course_id)
+        )
+        
         try:
             # Process snapshot
             snapshot_data = None
@@ -529,7 +525,7 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
             self.graph = self._build_graph(user_id, course_id, search_type, snapshot_data).compile()
             
             # Get conversation history (will be stripped of images)
-            history = await self.state_manager.get_conversation_history(user_id, course_id)
+            history = await history_task
             
             # Note: We no longer save images in state manager since they're in S3
             # The snapshot data contains the S3 reference instead
@@ -555,6 +551,8 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
                 "snapshot": snapshot_data,
                 "rag_sources": [],
                 "web_sources": [],
+                "rag_source_ids": [],
+                "web_source_ids": [],
                 "image_sources": [],
                 "final_response": None,
                 "sources_map": None,
@@ -577,12 +575,12 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
                 final_state.get("sources_map")
             )
             
-            # Build response with actual sources
+            # Build response with actual sources (validated from the dicts in one pass)
             return AgentResponse(
                 response=final_state.get("final_response", ""),
-                rag_sources=[RagSource(**s) for s in final_state.get("rag_sources", [])],
-                web_sources=[WebSource(**s) for s in final_state.get("web_sources", [])],
-                image_sources=[ImageSource(**s) for s in final_state.get("image_sources", [])]
+                rag_sources=final_state.get("rag_sources", []),
+                web_sources=final_state.get("web_sources", []),
+                image_sources=final_state.get("image_sources", [])
             )
             
         except Exception as e:
@@ -593,6 +591,12 @@ IMPORTANT: To save context, tool message content is truncated in the conversatio
                 web_sources=[],
                 image_sources=[]
             )
+        finally:
+            # Don't leave the history load running, or its error unretrieved, on failure
+            if not history_task.done():
+                history_task.cancel()
+            elif not history_task.cancelled():
+                history_task.exception()
 
 
 # Async wrapper for the agent
@@ -637,4 +641,5 @@ def cleanup_agent_connections():
     """Clean up agent connections."""
     from app.pipeline.outbound.agent_state import cleanup_agent_state_connections
     cleanup_agent_state_connections()
+    get_llm.cache_clear()
     logger.info("Agent connections cleaned up")
\ No newline at end of file
@@ -3,97 +3,300 @@ Agent state management system using Redis (primary) and MongoDB (backup).
 Handles conversation history and state persistence for the outbound agent.
 """
 
-import os
-import json
+import asyncio
+import hashlib
 import logging
+import orjson
+import weakref
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timezone
-import redis
+import redis.asyncio as aioredis
 from pymongo import MongoClient
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
-from dotenv import load_dotenv
 
-# Load environment variables
-if not os.getenv('MONGO_URI'):
-    load_dotenv()
+from app.config import get_settings
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Configuration (Mongo/Redis names, cache TTL, save debounce) comes from get_settings()
+_MAX_MESSAGES = 100  # Messages kept per thread
+
+# Redis key prefixes (history is a JSON object {"messages": [...]}, the format the backend reads)
+_REDIS_PREFIX = "agent_state:"
+_REDIS_SOURCES_PREFIX = "agent_sources:"
+_REDIS_IMAGES_PREFIX = "agent_images:"
+_REDIS_EMPTY_PREFIX = "agent_state_empty:"  # Short-lived marker for threads with no history
+_EMPTY_MARKER_TTL = 60
+
+# orjson options for cached payloads (non-str keys can appear in tool metadata)
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _dumps(obj: Any) -> str:
+    """Serialize to a JSON string (Redis clients here work with text)."""
+    return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode()
+
+
+_loads = orjson.loads
+
+# Strong references to fire-and-forget writes so they aren't garbage collected
+_background_tasks: set = set()
+
+
+def _run_in_background(coro, description: str) -> None:
+    """Schedule a non-critical write and log its failure instead of raising."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    
+    def _done(t: asyncio.Task) -> None:
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Background {description} failed: {t.exception()}")
+    
+    task.add_done_callback(_done)
+
 # Global connections
 _mongo_client: Optional[MongoClient] = None
-_redis_client: Optional[redis.Redis] = None
+_redis_client: Optional[Any] = None
 
 
 def get_mongo_client() -> MongoClient:
     """Get or create MongoDB client (singleton)."""
     global _mongo_client
     if _mongo_client is None:
-        mongo_uri = os.getenv('MONGO_URI')
+        mongo_uri = get_settings().mongo_uri
         if not mongo_uri:
             raise ValueError("MONGO_URI not found in .env file")
-        _mongo_client = MongoClient(mongo_uri)
+        _mongo_client = MongoClient(
+            mongo_uri,
+            maxPoolSize=get_settings().mongo_pool_size,
+            minPoolSize=2,
+            compressors="zstd,snappy,zlib",  # Negotiated; unavailable codecs are skipped
+            zlibCompressionLevel=6,
+            retryWrites=True,
+            w="majority",
+            readPreference="primaryPreferred",
+            serverSelectionTimeoutMS=3000,
+            socketTimeoutMS=5000
+        )
         logger.info("MongoDB client initialized for agent state")
     return _mongo_client
 
 
-def get_redis_client() -> redis.Redis:
-    """Get or create Redis client (singleton)."""
+def get_redis_client():
+    """
+    Get or create the async Redis client (singleton).
+    
+    Prefers Upstash's native TCP endpoint (UPSTASH_REDIS_URL, rediss://) over
+    the REST API, falling back to a local Redis when neither is configured.
+    """
     global _redis_client
     if _redis_client is None:
-        redis_url = os.getenv('UPSTASH_REDIS_REST_URL')
-        redis_token = os.getenv('UPSTASH_REDIS_REST_TOKEN')
+        settings = get_settings()
+        tcp_url = settings.upstash_redis_url
+        redis_url = settings.redis_url
+        redis_token = settings.redis_token
+        pool_size = settings.redis_pool_size
         
-        if redis_url and redis_token:
-            # Use Upstash Redis if available
-            from upstash_redis import Redis
-            _redis_client = Redis(url=redis_url, token=redis_token)
+        if tcp_url:
+            # Pooled keepalive TCP connections: no per-command HTTP request
+            _redis_client = aioredis.from_url(
+                tcp_url,
+                decode_responses=True,
+                socket_keepalive=True,
+                health_check_interval=30,
+                max_connections=pool_size
+            )
+            logger.info("Upstash Redis TCP client initialized for agent state")
+        elif redis_url and redis_token:
+            # Upstash REST API (async client reuses its HTTP session)
+            from upstash_redis.asyncio import Redis
+            _redis_client = Redis(url=redis_url, token=redis_token, rest_retries=1)
             logger.info("Upstash Redis client initialized for agent state")
         else:
             # Fallback to local Redis
-            redis_host = os.getenv('REDIS_HOST', 'localhost')
-            redis_port = int(os.getenv('REDIS_PORT', '6379'))
-            redis_db = int(os.getenv('REDIS_DB', '0'))
-            _redis_client = redis.Redis(
-                host=redis_host, 
-                port=redis_port, 
-                db=redis_db, 
-                decode_responses=True
+            pool = aioredis.ConnectionPool(
+                host=settings.redis_host,
+                port=settings.redis_port,
+                db=settings.redis_db,
+                decode_responses=True,
+                max_connections=pool_size,
+                socket_keepalive=True,
+                health_check_interval=30
             )
+            _redis_client = aioredis.Redis(connection_pool=pool)
             logger.info("Local Redis client initialized for agent state")
     return _redis_client
 
 
-def serialize_message(message: BaseMessage, sources: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """Convert a LangChain message to a serializable dictionary."""
+async def _execute(pipe) -> List[Any]:
+    """Execute a Redis pipeline (redis-py uses execute(), Upstash uses exec())."""
+    if hasattr(pipe, "exec"):
+        return await pipe.exec()
+    return await pipe.execute()
+
+
+@lru_cache(maxsize=64)
+def _tool_called_summary(tool_name: str) -> str:
+    """Generic (cached per tool) summary for tool content that can't be parsed."""
+    return _dumps({
+        "tool": tool_name,
+        "message": "Tool called. Use retrieve_previous_sources to access full content."
+    })
+
+
+def _summarize_tool_content(raw: Any, tool_name: str) -> str:
+    """Replace full tool output with a short summary to save context."""
+    if not raw or not isinstance(raw, str):
+        return _tool_called_summary(tool_name)
+    try:
+        content = _loads(raw)
+        if content.get("success"):
+            result_count = len(content.get("results", []))
+            return _dumps({
+                "success": True,
+                "tool": tool_name,
+                "result_count": result_count,
+                "message": f"Retrieved {result_count} sources. Use retrieve_previous_sources to access full content."
+            })
+        return _dumps({
+            "success": False,
+            "tool": tool_name,
+            "error": content.get("error", "Unknown error")
+        })
+    except (ValueError, AttributeError, TypeError):
+        # Not a JSON object; just provide basic info
+        return _tool_called_summary(tool_name)
+
+
+# Read a cached history and refresh its TTL in one round-trip.
+# Returns nil on a cache miss and an empty string for a known-empty thread.
+_GET_TOUCH_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return v
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then return '' end
+return false
+"""
+_get_touch_script = None
+
+
+async def _get_touch(client, key: str, empty_key: str, ttl: int) -> Optional[str]:
+    """
+    Return the cached value and bump the key's TTL if it exists.
+    Returns "" when the thread is marked empty and None on a cache miss.
+    """
+    global _get_touch_script
+    if hasattr(client, "register_script"):
+        # redis-py: EVALSHA with automatic script loading
+        if _get_touch_script is None:
+            _get_touch_script = client.register_script(_GET_TOUCH_LUA)
+        return await _get_touch_script(keys=[key, empty_key], args=[ttl])
+    # Upstash REST has no script objects; plain EVAL
+    return await client.eval(_GET_TOUCH_LUA, keys=[key, empty_key], args=[ttl])
+
+
+# Replace a cached history only if it still matches the version the caller read.
+# Returns -1 when the key is gone, 0 when another writer changed it, 1 when replaced.
+_COMPARE_SET_LUA = """
+redis.call('DEL', KEYS[2])
+local v = redis.call('GET', KEYS[1])
+if not v then return -1 end
+if redis.sha1hex(v) ~= ARGV[1] then return 0 end
+redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+_compare_set_script = None
+
+# Attempts to extend a cached history before dropping it for a refill from MongoDB
+_APPEND_ATTEMPTS = 3
+
+
+async def _compare_set(client, key: str, empty_key: str, expected: str, ttl: int, value: str) -> int:
+    """
+    Set key to value if its current content still matches expected, clearing the empty marker.
+    Returns -1 when the key does not exist, 0 on a conflicting write and 1 on success.
+    """
+    global _compare_set_script
+    args = [hashlib.sha1(expected.encode("utf-8")).hexdigest(), ttl, value]
+    if hasattr(client, "register_script"):
+        if _compare_set_script is None:
+            _compare_set_script = client.register_script(_COMPARE_SET_LUA)
+        return int(await _compare_set_script(keys=[key, empty_key], args=args))
+    return int(await client.eval(_COMPARE_SET_LUA, keys=[key, empty_key], args=args))
+
+
+# Message fields that are usually empty and omitted from storage when they are
+_OPTIONAL_FIELDS = ("additional_kwargs", "response_metadata", "name", "tool_calls", "tool_call_id")
+
+# Stored type name per message class (other classes are resolved and cached on first use)
+_TYPE_NAME: Dict[type, str] = {
+    HumanMessage: "human",
+    AIMessage: "ai",
+    SystemMessage: "system",
+    ToolMessage: "tool",
+}
+
+
+def _type_name(cls: type) -> str:
+    name = _TYPE_NAME.get(cls)
+    if name is None:
+        name = _TYPE_NAME[cls] = cls.__name__.lower().replace("message", "")
+    return name
+
+
+def _serialize_fields(message: BaseMessage, content: Any) -> Dict[str, Any]:
+    """Fields shared by every serialized message."""
+    result = {
+        "type": _type_name(type(message)),
+        "content": content,
+        "id": message.id,
+    }
+    
+    # Optional fields are only stored when set; deserialize_message defaults them
+    for field in _OPTIONAL_FIELDS:
+        value = getattr(message, field, None)
+        if value:
+            result[field] = value
+    return result
+
+
+def _serialize_default(message: BaseMessage, sources: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return _serialize_fields(message, message.content)
+
+
+def _serialize_human(message: BaseMessage, sources: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     content = message.content
     
     # Strip image content from HumanMessage for storage efficiency
-    if isinstance(message, HumanMessage) and isinstance(content, list):
-        # Remove image_url entries from multimodal content
-        filtered_content = []
-        for item in content:
-            if isinstance(item, dict) and item.get("type") == "text":
-                filtered_content.append(item)
+    if isinstance(content, list):
+        if all(isinstance(item, dict) and item.get("type") == "text" for item in content):
+            # Text-only content (the common case): nothing to strip, reuse the list
+            filtered_content = content
+        else:
+            # Remove image_url entries from multimodal content
+            filtered_content = [
+                item for item in content
+                if isinstance(item, dict) and item.get("type") == "text"
+            ]
         # If only one text item remains, extract just the text
         if len(filtered_content) == 1:
             content = filtered_content[0]["text"]
         else:
             content = filtered_content if filtered_content else ""
     
-    result = {
-        "type": message.__class__.__name__.lower().replace("message", ""),
-        "content": content,
-        "additional_kwargs": getattr(message, "additional_kwargs", {}),
-        "response_metadata": getattr(message, "response_metadata", {}),
-        "id": getattr(message, "id", None),
-        "name": getattr(message, "name", None),
-        "tool_calls": getattr(message, "tool_calls", []),
-        "tool_call_id": getattr(message, "tool_call_id", None),
-    }
+    return _serialize_fields(message, content)
+
+
+def _serialize_ai(message: BaseMessage, sources: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    result = _serialize_fields(message, message.content)
     
-    # Add source references for AI messages if provided
-    if isinstance(message, AIMessage) and sources:
+    # Add source references if provided
+    if sources:
         # Extract just the source IDs from the sources dict
         result["rag_source_ids"] = sources.get("rag_source_ids", [])
         result["web_source_ids"] = sources.get("web_source_ids", [])
@@ -109,74 +312,168 @@ def serialize_message(message: BaseMessage, sources: Optional[Dict[str, Any]] =
     return result
 
 
+# Serializer per message class; subclasses resolve through the MRO once and are cached
+_SERIALIZERS = {
+    HumanMessage: _serialize_human,
+    AIMessage: _serialize_ai,
+}
+
+
+def _serializer_for(cls: type):
+    serializer = _SERIALIZERS.get(cls)
+    if serializer is None:
+        serializer = next(
+            (_SERIALIZERS[base] for base in cls.__mro__[1:] if base in _SERIALIZERS),
+            _serialize_default
+        )
+        _SERIALIZERS[cls] = serializer
+    return serializer
+
+
+def serialize_message(message: BaseMessage, sources: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Convert a LangChain message to a serializable dictionary."""
+    return _serializer_for(type(message))(message, sources)
+
+
+def _serialize_messages(
+    messages: List[BaseMessage],
+    sources_map: Optional[Dict[str, Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    """Serialize messages in one pass, attaching sources by message ID."""
+    serialized = []
+    for msg in messages:
+        msg_id = getattr(msg, "id", None)
+        sources = sources_map.get(msg_id) if sources_map and msg_id else None
+        serialized.append(serialize_message(msg, sources))
+    return serialized
+
+
+def _deserialize_human(data: Dict[str, Any]) -> BaseMessage:
+    return HumanMessage(
+        content=data.get("content", ""),
+        additional_kwargs=data.get("additional_kwargs", {}),
+        id=data.get("id"),
+        name=data.get("name")
+    )
+
+
+def _deserialize_ai(data: Dict[str, Any]) -> BaseMessage:
+    return AIMessage(
+        content=data.get("content", ""),
+        additional_kwargs=data.get("additional_kwargs", {}),
+        response_metadata=data.get("response_metadata", {}),
+        id=data.get("id"),
+        name=data.get("name"),
+        tool_calls=data.get("tool_calls", [])
+    )
+
+
+def _deserialize_system(data: Dict[str, Any]) -> BaseMessage:
+    return SystemMessage(
+        content=data.get("content", ""),
+        additional_kwargs=data.get("additional_kwargs", {}),
+        id=data.get("id"),
+        name=data.get("name")
+    )
+
+
+def _deserialize_tool(data: Dict[str, Any]) -> BaseMessage:
+    return ToolMessage(
+        content=data.get("content", ""),
+        tool_call_id=data.get("tool_call_id", ""),
+        additional_kwargs=data.get("additional_kwargs", {}),
+        id=data.get("id"),
+        name=data.get("name")
+    )
+
+
+def _deserialize_default(data: Dict[str, Any]) -> BaseMessage:
+    # Unknown types default to HumanMessage
+    return HumanMessage(content=data.get("content", ""))
+
+
+_DESERIALIZERS = {
+    "human": _deserialize_human,
+    "ai": _deserialize_ai,
+    "system": _deserialize_system,
+    "tool": _deserialize_tool,
+}
+
+
 def deserialize_message(data: Dict[str, Any]) -> BaseMessage:
     """Convert a dictionary back to a LangChain message."""
-    msg_type = data.get("type", "human")
-    content = data.get("content", "")
-    
-    if msg_type == "human":
-        return HumanMessage(
-            content=content,
-            additional_kwargs=data.get("additional_kwargs", {}),
-            id=data.get("id"),
-            name=data.get("name")
-        )
-    elif msg_type == "ai":
-        return AIMessage(
-            content=content,
-            additional_kwargs=data.get("additional_kwargs", {}),
-            response_metadata=data.get("response_metadata", {}),
-            id=data.get("id"),
-            name=data.get("name"),
-            tool_calls=data.get("tool_calls", [])
-        )
-    elif msg_type == "system":
-        return SystemMessage(
-            content=content,
-            additional_kwargs=data.get("additional_kwargs", {}),
-            id=data.get("id"),
-            name=data.get("name")
-        )
-    elif msg_type == "tool":
-        return ToolMessage(
-            content=content,
-            tool_call_id=data.get("tool_call_id", ""),
-            additional_kwargs=data.get("additional_kwargs", {}),
-            id=data.get("id"),
-            name=data.get("name")
-        )
-    else:
-        # Default to HumanMessage
-        return HumanMessage(content=content)
+    return _DESERIALIZERS.get(data.get("type", "human"), _deserialize_default)(data)
 
 
 class AgentStateManager:
     """Manages agent state with Redis as primary and MongoDB as backup."""
     
     def __init__(self):
+        settings = get_settings()
         self.mongo_client = get_mongo_client()
         self.redis_client = get_redis_client()
         
-        # Get database and collection names from env
-        db_name = os.getenv('MONGO_DB')
-        collection_name = os.getenv('MONGO_STATES_COLLECTION', 'agent_states')
-        
-        if not db_name:
+        if not settings.mongo_db:
             raise ValueError("MONGO_DB must be set in .env")
         
-        self.mongo_db = self.mongo_client[db_name]
-        self.mongo_collection = self.mongo_db[collection_name]
+        self.mongo_db = self.mongo_client[settings.mongo_db]
+        self.mongo_collection = self.mongo_db[settings.mongo_states_collection]
+        self.redis_ttl = settings.redis_ttl  # Applies to history, sources and images keys
+        self.save_debounce_seconds = settings.state_save_debounce_seconds  # Full-save coalescing window
         
-        # Redis key prefixes
-        self.redis_prefix = "agent_state:"
-        self.redis_sources_prefix = "agent_sources:"
-        self.redis_images_prefix = "agent_images:"
-        self.redis_ttl = 3600 * 24  # 24 hours TTL for Redis cache
+        # Coalesced full saves: latest pending payload with its waiting callers, and a debounce timer, per thread
+        self._pending_saves: Dict[str, tuple] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        self._save_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
+    def _find_messages(self, thread_id: str, cond: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Return only the thread's messages matching an aggregation condition on "$$m".
+        Filtering happens server-side so the full history never crosses the wire.
+        """
+        docs = list(self.mongo_collection.aggregate([
+            {"$match": {"thread_id": thread_id}},
+            {"$limit": 1},
+            {"$project": {
+                "_id": 0,
+                "messages": {"$filter": {"input": "$messages", "as": "m", "cond": cond}}
+            }}
+        ]))
+        return (docs[0].get("messages") or []) if docs else []
+    
+    def _find_sources(self, thread_id: str, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Look up the sources embedded in the thread's messages (only messages that have them)."""
+        return {
+            msg["id"]: msg["sources"]
+            for msg in self._find_messages(
+                thread_id,
+                {"$and": [
+                    {"$in": ["$$m.id", message_ids]},
+                    {"$ne": [{"$type": "$$m.sources"}, "missing"]}
+                ]}
+            )
+        }
     
     def get_thread_id(self, user_id: str, course_id: str) -> str:
         """Generate thread ID from user and course IDs."""
         return f"{user_id}:{course_id}"
     
+    async def _cache_messages(self, thread_id: str, serialized_messages: List[Dict[str, Any]]) -> None:
+        """
+        Replace the cached history for a thread in one pipelined round-trip.
+        An empty history is cached as a short-lived empty marker instead.
+        """
+        redis_key = f"{_REDIS_PREFIX}{thread_id}"
+        empty_key = f"{_REDIS_EMPTY_PREFIX}{thread_id}"
+        pipe = self.redis_client.pipeline()
+        if serialized_messages:
+            pipe.delete(empty_key)
+            pipe.setex(redis_key, self.redis_ttl, _dumps({"messages": serialized_messages}))
+        else:
+            pipe.delete(redis_key)
+            pipe.setex(empty_key, _EMPTY_MARKER_TTL, "1")
+        await _execute(pipe)
+    
     async def get_conversation_history(
         self, 
         user_id: str, 
@@ -196,46 +493,46 @@ class AgentStateManager:
             List of LangChain messages (with truncated tool content)
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_key = f"{self.redis_prefix}{thread_id}"
+        redis_key = f"{_REDIS_PREFIX}{thread_id}"
         
         try:
             # Try Redis first
-            cached_data = self.redis_client.get(redis_key)
+            cached_data = await _get_touch(
+                self.redis_client, redis_key, f"{_REDIS_EMPTY_PREFIX}{thread_id}", self.redis_ttl
+            )
             if cached_data:
                 logger.info(f"Retrieved state from Redis for thread: {thread_id}")
-                state_data = json.loads(cached_data)
-                messages_data = state_data.get("messages", [])[-limit:]
+                messages_data = _loads(cached_data).get("messages", [])[-limit:]
                 # Process messages and truncate tool content
                 processed_messages = self._process_messages_for_history(messages_data)
                 return [deserialize_message(msg) for msg in processed_messages]
+            if cached_data is not None:
+                # Recently confirmed empty; skip MongoDB
+                return []
         except Exception as e:
             logger.warning(f"Error reading from Redis: {e}")
         
         # Fallback to MongoDB
         try:
-            doc = self.mongo_collection.find_one(
+            doc = await asyncio.to_thread(
+                self.mongo_collection.find_one,
                 {"thread_id": thread_id},
                 {"messages": {"$slice": -limit}}
             )
             
-            if doc and "messages" in doc:
+            messages_data = doc.get("messages") if doc else None
+            
+            # Cache in Redis for next time (cache original, not processed; empty becomes a marker)
+            try:
+                await self._cache_messages(thread_id, messages_data or [])
+            except Exception as e:
+                logger.warning(f"Error caching to Redis: {e}")
+            
+            if messages_data:
                 logger.info(f"Retrieved state from MongoDB for thread: {thread_id}")
-                messages_data = doc["messages"]
                 # Process messages and truncate tool content
                 processed_messages = self._process_messages_for_history(messages_data)
-                messages = [deserialize_message(msg) for msg in processed_messages]
-                
-                # Cache in Redis for next time (cache original, not processed)
-                try:
-                    self.redis_client.setex(
-                        redis_key,
-                        self.redis_ttl,
-                        json.dumps({"messages": messages_data})
-                    )
-                except Exception as e:
-                    logger.warning(f"Error caching to Redis: {e}")
-                
-                return messages
+                return [deserialize_message(msg) for msg in processed_messages]
             else:
                 logger.info(f"No conversation history found for thread: {thread_id}")
                 return []
@@ -256,47 +553,15 @@ class AgentStateManager:
         """
         processed = []
         for msg in messages_data:
-            if msg.get("type") == "tool":
-                # Create a copy to avoid modifying the original
-                truncated_msg = msg.copy()
-                # Replace content with a summary
-                tool_name = msg.get("name", "unknown")
-                
-                # Try to extract basic info from content
-                try:
-                    if msg.get("content") and isinstance(msg["content"], str):
-                        content = json.loads(msg["content"])
-                        if content.get("success"):
-                            result_count = len(content.get("results", []))
-                            truncated_msg["content"] = json.dumps({
-                                "success": True,
-                                "tool": tool_name,
-                                "result_count": result_count,
-                                "message": f"Retrieved {result_count} sources. Use retrieve_previous_sources to access full content."
-                            })
-                        else:
-                            truncated_msg["content"] = json.dumps({
-                                "success": False,
-                                "tool": tool_name,
-                                "error": content.get("error", "Unknown error")
-                            })
-                    else:
-                        truncated_msg["content"] = json.dumps({
-                            "tool": tool_name,
-                            "message": "Tool called. Use retrieve_previous_sources to access full content."
-                        })
-                except:
-                    # If parsing fails, just provide basic info
-                    truncated_msg["content"] = json.dumps({
-                        "tool": tool_name,
-                        "message": "Tool called. Use retrieve_previous_sources to access full content."
-                    })
-                
-                processed.append(truncated_msg)
-            else:
+            if msg.get("type") != "tool":
                 # Keep other messages as-is
                 processed.append(msg)
-        
+                continue
+            # Shallow copy with the content replaced by a summary
+            processed.append({
+                **msg,
+                "content": _summarize_tool_content(msg.get("content"), msg.get("name", "unknown"))
+            })
         return processed
     
     async def save_messages(
@@ -328,6 +593,12 @@ class AgentStateManager:
         """
         Save messages to both Redis and MongoDB with optional sources.
         
+        A save for an idle thread is written right away. Saves arriving while
+        a write for the same thread is pending or in flight are coalesced
+        into one write of the latest state after a short window. Each call
+        returns once the write covering it has landed; call flush() to force
+        pending writes early.
+        
         Args:
             user_id: User identifier
             course_id: Course identifier
@@ -335,24 +606,100 @@ class AgentStateManager:
             sources_map: Optional map of message_id to sources
             
         Returns:
-            Success status
+            Success status of the write that stored this (or a newer) state
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_key = f"{self.redis_prefix}{thread_id}"
         
         # Serialize messages with sources
-        serialized_messages = []
-        for msg in messages:
-            msg_id = getattr(msg, "id", None)
-            sources = sources_map.get(msg_id) if sources_map and msg_id else None
-            serialized_messages.append(serialize_message(msg, sources))
+        serialized_messages = _serialize_messages(messages, sources_map)
+        
+        # Nothing pending or being written for this thread: write now, with no debounce delay
+        written = asyncio.get_running_loop().create_future()
+        pending = self._pending_saves.get(thread_id)
+        lock = self._save_locks.get(thread_id)
+        if pending is None and thread_id not in self._flush_tasks and not (lock and lock.locked()):
+            self._pending_saves[thread_id] = ((user_id, course_id, serialized_messages), [written])
+            return await self._write_pending(thread_id)
+        
+        # Newer saves replace the pending payload and wait on the same write; one timer per thread
+        waiters = pending[1] if pending else []
+        waiters.append(written)
+        self._pending_saves[thread_id] = ((user_id, course_id, serialized_messages), waiters)
+        if thread_id not in self._flush_tasks:
+            self._flush_tasks[thread_id] = asyncio.create_task(self._flush_after(thread_id))
+        return await written
+    
+    async def _flush_after(self, thread_id: str) -> None:
+        """Wait out the debounce window, then write the latest pending save."""
+        await asyncio.sleep(self.save_debounce_seconds)
+        # Unregister before writing so saves arriving mid-write get a new timer
+        self._flush_tasks.pop(thread_id, None)
+        await self._write_pending(thread_id)
+    
+    async def _write_pending(self, thread_id: str) -> bool:
+        """Write the pending save for a thread, serialized with any in-flight write."""
+        lock = self._save_locks.get(thread_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._save_locks[thread_id] = lock
+        async with lock:
+            entry = self._pending_saves.pop(thread_id, None)
+            if entry is None:
+                return True
+            payload, waiters = entry
+            try:
+                success = await self._persist_serialized(*payload)
+            except Exception as e:
+                logger.error(f"Error writing coalesced save for thread {thread_id}: {e}")
+                success = False
+            # Every save coalesced into this write gets its outcome
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(success)
+            return success
+    
+    async def flush(self, thread_id: Optional[str] = None) -> bool:
+        """
+        Write coalesced saves now and wait for in-flight ones.
+        
+        Args:
+            thread_id: Thread to flush (all pending threads if omitted)
+            
+        Returns:
+            Success status
+        """
+        thread_ids = [thread_id] if thread_id else list(self._pending_saves)
+        success = True
+        for tid in thread_ids:
+            success = await self._write_pending(tid) and success
+        return success
+    
+    async def _persist_serialized(
+        self,
+        user_id: str,
+        course_id: str,
+        serialized_messages: List[Dict[str, Any]]
+    ) -> bool:
+        """
+        Replace the stored conversation with already-serialized messages.
+        
+        Args:
+            user_id: User identifier
+            course_id: Course identifier
+            serialized_messages: Message dicts as produced by serialize_message
+            
+        Returns:
+            Success status
+        """
+        thread_id = self.get_thread_id(user_id, course_id)
+        now = datetime.now(timezone.utc).isoformat()
         
         state_data = {
             "thread_id": thread_id,
             "user_id": user_id,
             "course_id": course_id,
             "messages": serialized_messages,
-            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": now,
             "message_count": len(serialized_messages)
         }
         
@@ -360,11 +707,12 @@ class AgentStateManager:
         
         # Save to MongoDB
         try:
-            self.mongo_collection.update_one(
+            await asyncio.to_thread(
+                self.mongo_collection.update_one,
                 {"thread_id": thread_id},
                 {
                     "$set": state_data,
-                    "$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()}
+                    "$setOnInsert": {"created_at": now}
                 },
                 upsert=True
             )
@@ -375,11 +723,7 @@ class AgentStateManager:
         
         # Save to Redis
         try:
-            self.redis_client.setex(
-                redis_key,
-                self.redis_ttl,
-                json.dumps({"messages": serialized_messages})
-            )
+            await self._cache_messages(thread_id, serialized_messages)
             logger.info(f"Saved state to Redis for thread: {thread_id}")
         except Exception as e:
             logger.warning(f"Error saving to Redis: {e}")
@@ -407,59 +751,77 @@ class AgentStateManager:
             Success status
         """
         thread_id = self.get_thread_id(user_id, course_id)
+        redis_key = f"{_REDIS_PREFIX}{thread_id}"
         
-        # Get the existing document with all source information preserved
-        doc = self.mongo_collection.find_one({"thread_id": thread_id})
-        
-        if doc and "messages" in doc:
-            # Create a map of existing message sources by ID
-            existing_sources = {}
-            for msg_data in doc["messages"]:
-                msg_id = msg_data.get("id")
-                if msg_id and msg_data.get("type") == "ai":
-                    # Preserve any existing source IDs and image source
-                    if any([msg_data.get("rag_source_ids"), 
-                           msg_data.get("web_source_ids"), 
-                           msg_data.get("image_source")]):
-                        existing_sources[msg_id] = {
-                            "rag_source_ids": msg_data.get("rag_source_ids", []),
-                            "web_source_ids": msg_data.get("web_source_ids", [])
-                        }
-                        # Preserve image source data if it exists
-                        if msg_data.get("image_source"):
-                            existing_sources[msg_id]["s3key"] = msg_data["image_source"].get("s3key")
-                            existing_sources[msg_id]["slide_id"] = msg_data["image_source"].get("slide_id")
-                            existing_sources[msg_id]["page_number"] = msg_data["image_source"].get("page_number")
-            
-            # Merge existing sources with new sources
-            if sources_map:
-                existing_sources.update(sources_map)
-            
-            # Get existing raw message data (not deserialized) to preserve all fields
-            existing_messages_data = doc.get("messages", [])
-            
-            # Serialize new messages
-            new_messages_serialized = []
-            for msg in new_messages:
-                msg_id = getattr(msg, "id", None)
-                sources = sources_map.get(msg_id) if sources_map and msg_id else None
-                new_messages_serialized.append(serialize_message(msg, sources))
-            
-            # Combine existing and new messages
-            all_messages_data = existing_messages_data + new_messages_serialized
-            
-            # Keep only last 100 messages to prevent unbounded growth
-            if len(all_messages_data) > 100:
-                all_messages_data = all_messages_data[-100:]
-            
-            # Now we need to deserialize for save_messages_with_sources
-            all_messages = [deserialize_message(msg) for msg in all_messages_data]
-            
-            # Save all messages with all sources preserved
-            return await self.save_messages_with_sources(user_id, course_id, all_messages, existing_sources)
-        else:
-            # No existing messages, just save the new ones
-            return await self.save_messages_with_sources(user_id, course_id, new_messages, sources_map)
+        # A coalesced full save must land before appending on top of it
+        await self.flush(thread_id)
+        
+        # Serialize only the new messages; existing ones (and their sources) are untouched
+        new_messages_serialized = _serialize_messages(new_messages, sources_map)
+        
+        if not new_messages_serialized:
+            return True
+        
+        now = datetime.now(timezone.utc).isoformat()
+        success = True
+        
+        # Append in MongoDB with a pipeline update so message_count follows the trimmed array.
+        # $literal keeps message content that starts with "$" from being read as an expression.
+        try:
+            await asyncio.to_thread(
+                self.mongo_collection.update_one,
+                {"thread_id": thread_id},
+                [
+                    {"$set": {
+                        "messages": {"$slice": [
+                            {"$concatArrays": [
+                                {"$ifNull": ["$messages", []]},
+                                {"$literal": new_messages_serialized}
+                            ]},
+                            -_MAX_MESSAGES
+                        ]},
+                        "updated_at": now,
+                        "user_id": {"$ifNull": ["$user_id", {"$literal": user_id}]},
+                        "course_id": {"$ifNull": ["$course_id", {"$literal": course_id}]},
+                        "created_at": {"$ifNull": ["$created_at", now]}
+                    }},
+                    {"$set": {"message_count": {"$size": "$messages"}}}
+                ],
+                upsert=True
+            )
+            logger.info(f"Appended {len(new_messages_serialized)} messages in MongoDB for thread: {thread_id}")
+        except Exception as e:
+            logger.error(f"Error appending to MongoDB: {e}")
+            success = False
+        
+        # Extend the cached history only if it exists; a missing one is refilled from MongoDB on read.
+        # The write is a compare-and-set so concurrent appends cannot drop each other's messages.
+        empty_key = f"{_REDIS_EMPTY_PREFIX}{thread_id}"
+        try:
+            for _ in range(_APPEND_ATTEMPTS):
+                cached_data = await self.redis_client.get(redis_key)
+                if not cached_data:
+                    await self.redis_client.delete(empty_key)
+                    break
+                cached_messages = _loads(cached_data).get("messages", []) + new_messages_serialized
+                result = await _compare_set(
+                    self.redis_client, redis_key, empty_key, cached_data, self.redis_ttl,
+                    _dumps({"messages": cached_messages[-_MAX_MESSAGES:]})
+                )
+                if result != 0:
+                    break
+            else:
+                # Still contended; drop the copy so the next read refills from MongoDB
+                await self.redis_client.delete(redis_key)
+        except Exception as e:
+            logger.warning(f"Error appending to Redis: {e}")
+            # A stale copy would hide the appended messages until it expires
+            try:
+                await self.redis_client.delete(redis_key)
+            except Exception:
+                pass
+        
+        return success
     
     async def clear_conversation(self, user_id: str, course_id: str) -> bool:
         """
@@ -473,25 +835,28 @@ class AgentStateManager:
             Success status
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_key = f"{self.redis_prefix}{thread_id}"
-        redis_sources_key = f"{self.redis_sources_prefix}{thread_id}"
-        redis_images_key = f"{self.redis_images_prefix}{thread_id}"
+        redis_key = f"{_REDIS_PREFIX}{thread_id}"
+        redis_sources_key = f"{_REDIS_SOURCES_PREFIX}{thread_id}"
+        redis_images_key = f"{_REDIS_IMAGES_PREFIX}{thread_id}"
+        
+        # Don't let a coalesced save land after the clear
+        await self.flush(thread_id)
         
         success = True
         
         # Clear from MongoDB
         try:
-            self.mongo_collection.delete_one({"thread_id": thread_id})
+            await asyncio.to_thread(self.mongo_collection.delete_one, {"thread_id": thread_id})
             logger.info(f"Cleared state from MongoDB for thread: {thread_id}")
         except Exception as e:
             logger.error(f"Error clearing from MongoDB: {e}")
             success = False
         
-        # Clear from Redis
+        # Clear from Redis (single multi-key DEL)
         try:
-            self.redis_client.delete(redis_key)
-            self.redis_client.delete(redis_sources_key)
-            self.redis_client.delete(redis_images_key)
+            await self.redis_client.delete(
+                redis_key, redis_sources_key, redis_images_key, f"{_REDIS_EMPTY_PREFIX}{thread_id}"
+            )
             logger.info(f"Cleared state, sources, and images from Redis for thread: {thread_id}")
         except Exception as e:
             logger.warning(f"Error clearing from Redis: {e}")
@@ -508,6 +873,7 @@ class AgentStateManager:
     ) -> bool:
         """
         Save sources for a specific message to both MongoDB and Redis.
+        The MongoDB backup write runs in the background; failures are logged.
         
         Args:
             user_id: User identifier
@@ -520,7 +886,7 @@ class AgentStateManager:
             Success status
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_sources_key = f"{self.redis_sources_prefix}{thread_id}"
+        redis_sources_key = f"{_REDIS_SOURCES_PREFIX}{thread_id}"
         
         sources_data = {
             "message_id": message_id,
@@ -529,44 +895,33 @@ class AgentStateManager:
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        success = True
-        
-        # Save to MongoDB - update the message with its sources
-        try:
-            # Find the AI message with this ID and add sources to it
-            self.mongo_collection.update_one(
-                {
-                    "thread_id": thread_id,
-                    "messages.id": message_id
-                },
-                {
-                    "$set": {
-                        "messages.$.sources": sources_data
-                    }
-                }
-            )
-            logger.info(f"Saved sources to MongoDB for message {message_id} in thread {thread_id}")
-        except Exception as e:
-            logger.error(f"Error saving sources to MongoDB: {e}")
-            success = False
-        
-        # Save to Redis as cache
+        # Save to Redis as cache (read path checks Redis first)
         try:
-            # Store in Redis hash with message_id as field
-            self.redis_client.hset(
-                redis_sources_key,
-                message_id,
-                json.dumps(sources_data)
-            )
-            # Set expiration
-            self.redis_client.expire(redis_sources_key, self.redis_ttl)
+            # Store in Redis hash with message_id as field and set expiration
+            pipe = self.redis_client.pipeline()
+            pipe.hset(redis_sources_key, message_id, _dumps(sources_data))
+            pipe.expire(redis_sources_key, self.redis_ttl)
+            await _execute(pipe)
             
             logger.info(f"Cached sources in Redis for message {message_id}")
         except Exception as e:
             logger.warning(f"Error caching sources in Redis: {e}")
             # Don't fail if Redis cache fails
-            
-        return success
+        
+        # Save to MongoDB in the background - embedded in the AI message, where the backend reads it
+        _run_in_background(
+            asyncio.to_thread(
+                self.mongo_collection.update_one,
+                {
+                    "thread_id": thread_id,
+                    "messages.id": message_id
+                },
+                {"$set": {"messages.$.sources": sources_data}}
+            ),
+            f"sources save to MongoDB for message {message_id} in thread {thread_id}"
+        )
+        
+        return True
     
     async def get_sources_for_messages(
         self,
@@ -586,17 +941,20 @@ class AgentStateManager:
             Dictionary mapping message_id to sources
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_sources_key = f"{self.redis_sources_prefix}{thread_id}"
+        redis_sources_key = f"{_REDIS_SOURCES_PREFIX}{thread_id}"
         
         sources_by_message = {}
         missing_ids = []
         
-        # Try Redis first
+        if not message_ids:
+            return sources_by_message
+        
+        # Try Redis first (one HMGET for all ids)
         try:
-            for message_id in message_ids:
-                sources_data = self.redis_client.hget(redis_sources_key, message_id)
+            cached = await self.redis_client.hmget(redis_sources_key, *message_ids)
+            for message_id, sources_data in zip(message_ids, cached):
                 if sources_data:
-                    sources_by_message[message_id] = json.loads(sources_data)
+                    sources_by_message[message_id] = _loads(sources_data)
                 else:
                     missing_ids.append(message_id)
             
@@ -609,29 +967,22 @@ class AgentStateManager:
         # If we have missing IDs, try MongoDB
         if missing_ids:
             try:
-                # Get the document with messages
-                doc = self.mongo_collection.find_one(
-                    {"thread_id": thread_id},
-                    {"messages": 1}
-                )
+                refill = await asyncio.to_thread(self._find_sources, thread_id, missing_ids)
                 
-                if doc and "messages" in doc:
-                    # Look for messages with sources
-                    for msg in doc["messages"]:
-                        if msg.get("id") in missing_ids and "sources" in msg:
-                            sources_by_message[msg["id"]] = msg["sources"]
-                            
-                            # Cache in Redis for next time
-                            try:
-                                self.redis_client.hset(
-                                    redis_sources_key,
-                                    msg["id"],
-                                    json.dumps(msg["sources"])
-                                )
-                            except Exception as e:
-                                logger.warning(f"Error caching to Redis: {e}")
+                if refill:
+                    sources_by_message.update(refill)
                     
-                    logger.info(f"Retrieved {len(sources_by_message) - len(missing_ids)} additional sources from MongoDB")
+                    # Cache in Redis for next time (one pipelined round-trip)
+                    try:
+                        pipe = self.redis_client.pipeline()
+                        for message_id, sources in refill.items():
+                            pipe.hset(redis_sources_key, message_id, _dumps(sources))
+                        pipe.expire(redis_sources_key, self.redis_ttl)
+                        await _execute(pipe)
+                    except Exception as e:
+                        logger.warning(f"Error caching to Redis: {e}")
+                    
+                    logger.info(f"Retrieved {len(refill)} additional sources from MongoDB")
                     
             except Exception as e:
                 logger.error(f"Error retrieving from MongoDB: {e}")
@@ -655,17 +1006,17 @@ class AgentStateManager:
             List of all sources in chronological order
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_sources_key = f"{self.redis_sources_prefix}{thread_id}"
+        redis_sources_key = f"{_REDIS_SOURCES_PREFIX}{thread_id}"
         
         all_sources = []
         
         try:
             # Get all sources from Redis
-            sources_data = self.redis_client.hgetall(redis_sources_key)
+            sources_data = await self.redis_client.hgetall(redis_sources_key)
             
             # Convert and sort by timestamp
             for message_id, data in sources_data.items():
-                source_info = json.loads(data)
+                source_info = _loads(data)
                 source_info["message_id"] = message_id
                 all_sources.append(source_info)
             
@@ -699,27 +1050,35 @@ class AgentStateManager:
         thread_id = self.get_thread_id(user_id, course_id)
         tool_messages = {}
         
+        # Drop duplicate and empty ids; nothing to look up means no round-trip
+        wanted_ids = list(dict.fromkeys(message_id for message_id in tool_message_ids if message_id))
+        if not wanted_ids:
+            return tool_messages
+        
         try:
-            # Get from MongoDB (tool messages are only fully stored there)
-            doc = self.mongo_collection.find_one(
-                {"thread_id": thread_id},
-                {"messages": 1}
+            # Get from MongoDB in one filtered aggregation (tool messages are only fully stored there)
+            matched = await asyncio.to_thread(
+                self._find_messages,
+                thread_id,
+                {"$and": [
+                    {"$eq": ["$$m.type", "tool"]},
+                    {"$in": ["$$m.id", wanted_ids]}
+                ]}
             )
             
-            if doc and "messages" in doc:
-                # Find requested tool messages
-                for msg in doc["messages"]:
-                    if msg.get("type") == "tool" and msg.get("id") in tool_message_ids:
-                        try:
-                            # Parse the content
-                            content = json.loads(msg.get("content", "{}"))
-                            tool_messages[msg["id"]] = {
-                                "tool_name": msg.get("name"),
-                                "content": content,
-                                "tool_call_id": msg.get("tool_call_id")
-                            }
-                        except:
-                            logger.warning(f"Failed to parse tool message content for {msg.get('id')}")
+            if matched:
+                # Parse requested tool messages
+                for msg in matched:
+                    try:
+                        # Parse the content
+                        content = _loads(msg.get("content", "{}"))
+                        tool_messages[msg["id"]] = {
+                            "tool_name": msg.get("name"),
+                            "content": content,
+                            "tool_call_id": msg.get("tool_call_id")
+                        }
+                    except (ValueError, TypeError):
+                        logger.warning(f"Failed to parse tool message content for {msg.get('id')}")
                 
                 logger.info(f"Retrieved {len(tool_messages)} tool messages for thread {thread_id}")
             
@@ -748,23 +1107,21 @@ class AgentStateManager:
             Success status
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_images_key = f"{self.redis_images_prefix}{thread_id}"
+        redis_images_key = f"{_REDIS_IMAGES_PREFIX}{thread_id}"
         
-        image_data = {
-            "message_id": message_id,
-            "image": image,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
+        # Image payload and its small metadata live in separate fields so the
+        # (large) base64 string is stored as-is instead of escaped inside JSON.
+        # It stays base64 text: the Upstash REST transport and the
+        # decode_responses=True local client are not binary-safe.
+        image_meta = {"timestamp": datetime.now(timezone.utc).isoformat()}
         
         try:
-            # Store in Redis hash with message_id as field
-            self.redis_client.hset(
-                redis_images_key,
-                message_id,
-                json.dumps(image_data)
-            )
-            # Set expiration
-            self.redis_client.expire(redis_images_key, self.redis_ttl)
+            # Store in Redis hash with message_id-derived fields and set expiration
+            pipe = self.redis_client.pipeline()
+            pipe.hset(redis_images_key, f"{message_id}:data", image)
+            pipe.hset(redis_images_key, f"{message_id}:meta", _dumps(image_meta))
+            pipe.expire(redis_images_key, self.redis_ttl)
+            await _execute(pipe)
             
             logger.info(f"Saved image for message {message_id} in thread {thread_id}")
             return True
@@ -791,16 +1148,28 @@ class AgentStateManager:
             Dictionary mapping message_id to image data
         """
         thread_id = self.get_thread_id(user_id, course_id)
-        redis_images_key = f"{self.redis_images_prefix}{thread_id}"
+        redis_images_key = f"{_REDIS_IMAGES_PREFIX}{thread_id}"
         
         images_by_message = {}
         
         try:
-            # Get images from Redis
+            if not message_ids:
+                return images_by_message
+            
+            # Get payload and metadata for every message in a single HMGET
+            fields = []
             for message_id in message_ids:
-                image_data = self.redis_client.hget(redis_images_key, message_id)
-                if image_data:
-                    images_by_message[message_id] = json.loads(image_data)
+                fields.append(f"{message_id}:data")
+                fields.append(f"{message_id}:meta")
+            values = await self.redis_client.hmget(redis_images_key, *fields)
+            
+            for message_id, image, meta in zip(message_ids, values[::2], values[1::2]):
+                if image:
+                    images_by_message[message_id] = {
+                        "message_id": message_id,
+                        "image": image,
+                        "timestamp": _loads(meta).get("timestamp") if meta else None
+                    }
             
             logger.info(f"Retrieved images for {len(images_by_message)} messages")
             return images_by_message
@@ -810,14 +1179,88 @@ class AgentStateManager:
             return {}
 
 
+def create_states_collection() -> bool:
+    """
+    Create the states collection with zstd block compression (one-time setup).
+    
+    Run from scripts/setup_mongo.py rather than the request path, since it
+    needs DDL privileges. Without it, MongoDB creates the collection with
+    the server's default compressor on first write.
+    
+    Returns:
+        True if the collection was created, False if it already existed
+    """
+    settings = get_settings()
+    if not settings.mongo_db:
+        raise ValueError("MONGO_DB must be set in .env")
+    mongo_db = get_mongo_client()[settings.mongo_db]
+    collection_name = settings.mongo_states_collection
+    if mongo_db.list_collection_names(filter={"name": collection_name}):
+        return False
+    mongo_db.create_collection(
+        collection_name,
+        storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+    )
+    logger.info(f"Created {collection_name} collection with zstd compression")
+    return True
+
+
+def create_states_indexes() -> None:
+    """
+    Create the indexes every state query relies on (thread lookups, message updates).
+    
+    Run from scripts/setup_mongo.py alongside create_states_collection, so the
+    DDL never runs on the request path. Re-running it is a no-op.
+    
+    Raises:
+        Exception: If an index can't be built (e.g. duplicate thread_id documents
+            block the unique index)
+    """
+    settings = get_settings()
+    if not settings.mongo_db:
+        raise ValueError("MONGO_DB must be set in .env")
+    collection = get_mongo_client()[settings.mongo_db][settings.mongo_states_collection]
+    collection.create_index([("thread_id", 1)], unique=True)
+    collection.create_index([("thread_id", 1), ("messages.id", 1)])
+    logger.info("Agent state indexes ensured")
+
+
+@lru_cache(maxsize=1)
+def get_state_manager() -> AgentStateManager:
+    """Get the shared AgentStateManager (singleton)."""
+    return AgentStateManager()
+
+
+async def close_redis_client() -> None:
+    """Close the async Redis client's connections, if one was created."""
+    global _redis_client, _get_touch_script, _compare_set_script
+    client, _redis_client = _redis_client, None
+    _get_touch_script = _compare_set_script = None
+    if client is None:
+        return
+    close = getattr(client, "aclose", None) or getattr(client, "close", None)
+    if close:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+
+
+async def flush_pending_saves() -> None:
+    """Flush coalesced saves of the shared state manager, if one was created."""
+    if get_state_manager.cache_info().currsize:
+        await get_state_manager().flush()
+
+
 def cleanup_agent_state_connections():
     """Clean up database connections."""
-    global _mongo_client, _redis_client
+    global _mongo_client, _redis_client, _get_touch_script, _compare_set_script
     
     if _mongo_client:
         _mongo_client.close()
         _mongo_client = None
     
     _redis_client = None
+    _get_touch_script = _compare_set_script = None
+    get_state_manager.cache_clear()
     
     logger.info("Agent state connections cleaned up")
\ No newline at end of file
@@ -3,22 +3,146 @@ Agent tools for handling various operations including RAG search, web search,
 and source retrieval.
 """
 
-import os
+import time
+import orjson
+import asyncio
 import logging
-from typing import List, Dict, Any
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Tuple
 
 # LangChain imports
 from langchain_core.tools import tool
 from langchain_community.tools.tavily_search import TavilySearchResults
 
 # Local imports
+from app.config import get_settings
 from app.pipeline.outbound.agent_state import AgentStateManager
-from app.pipeline.outbound.rag_retrieval import retrieve_similar_chunks_async
+from app.pipeline.outbound.rag_retrieval import retrieve_similar_chunks_async, RetrievalTimeoutError, cache_epoch
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Metadata fields a RAG source is built from, fetched in one C-level call per hit
+_SOURCE_FIELDS = itemgetter("slideId", "s3_path", "pageStart", "pageEnd", "rawText")
 
+# Formatted RAG results keyed by (query, course_id, slides, limit); agents often repeat
+# sub-queries. Sized by RAG_TOOL_CACHE_SIZE and RAG_TOOL_CACHE_TTL_SECONDS.
+_rag_cache: "OrderedDict[Tuple, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+
+def _rag_cache_get(key: Tuple) -> Optional[List[Dict[str, Any]]]:
+    """Return a copy of the cached results for key, or None if missing or expired."""
+    entry = _rag_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, results = entry
+    if expires_at < time.monotonic():
+        del _rag_cache[key]
+        return None
+    _rag_cache.move_to_end(key)
+    # Callers annotate results in place, so never hand out the cached dicts
+    return [dict(result) for result in results]
+
+
+def _rag_cache_put(key: Tuple, results: List[Dict[str, Any]]) -> None:
+    """Store a copy of results for key, evicting the least recently used entry when full."""
+    settings = get_settings()
+    if settings.rag_tool_cache_size <= 0:
+        return
+    _rag_cache[key] = (time.monotonic() + settings.rag_tool_cache_ttl_seconds, [dict(result) for result in results])
+    _rag_cache.move_to_end(key)
+    while len(_rag_cache) > settings.rag_tool_cache_size:
+        _rag_cache.popitem(last=False)
+
+
+# Searches currently running, so concurrent identical tool calls share one retrieval
+_rag_inflight: Dict[Tuple, "asyncio.Task[List[Dict[str, Any]]]"] = {}
+
+
+def clear_rag_cache(course_id: Optional[str] = None) -> None:
+    """
+    Drop cached RAG search results, only those for course_id when given.
+    
+    Running searches are forgotten too, so later identical calls search again
+    instead of joining one that may predate the change (called on the event loop).
+    """
+    for cache in (_rag_cache, _rag_inflight):
+        if course_id is None:
+            cache.clear()
+            continue
+        for key in [key for key in cache if key[1] == course_id]:
+            del cache[key]
+
+
+@lru_cache(maxsize=256)
+def cap_source_text(content: str) -> str:
+    """
+    Return a RAG tool result with each source's text capped at RAG_MAX_CHUNK_CHARS.
+    
+    Long transcripts otherwise balloon the prompt; sources returned to the
+    frontend and stored tool messages keep the full text. Cached because the
+    agent re-sends the same tool messages on every step.
+    
+    Args:
+        content: JSON content of a rag_search_tool message
+    
+    Returns:
+        The content to show the model (unchanged if nothing was too long)
+    """
+    try:
+        tool_result = orjson.loads(content)
+        results = tool_result.get("results") or []
+    except (ValueError, AttributeError):
+        return content
+    
+    max_chars = get_settings().rag_max_chunk_chars
+    capped = False
+    for source in results:
+        text = source.get("text")
+        if isinstance(text, str) and len(text) > max_chars:
+            source["text"] = text[:max_chars] + "…"
+            capped = True
+    return orjson.dumps(tool_result).decode() if capped else content
+
+
+async def _search_course(
+    cache_key: Tuple,
+    query: str,
+    course_id: str,
+    slides: List[str],
+    limit: int
+) -> List[Dict[str, Any]]:
+    """Run the vector search, format the hits for the agent and cache them."""
+    epoch = cache_epoch()
+    results = await retrieve_similar_chunks_async(
+        course_id=course_id,
+        slides=slides,
+        chunks=[],  # No chunk filtering
+        prompt=query,
+        limit=limit
+    )
+    
+    # Format results for the agent; the retrieval projection guarantees every
+    # metadata field (defaults are filled in server-side), so index directly
+    formatted_results = []
+    for i, result in enumerate(results, 1):
+        slide, s3file, start, end, text = _SOURCE_FIELDS(result["metadata"])
+        formatted_results.append({
+            "id": str(i),
+            "slide": slide,
+            "s3file": s3file,
+            "start": str(start),
+            "end": str(end),
+            "text": text,
+            "score": result["score"]
+        })
+    
+    # Skip the cache if the course's chunks changed while the search ran
+    if cache_epoch() == epoch:
+        _rag_cache_put(cache_key, formatted_results)
+    return formatted_results
 
 
 # RAG Search Tool
@@ -43,29 +167,33 @@ async def rag_search_tool(
     """
     logger.info(f"RAG search - Query: '{query}', Course: {course_id}, Slides: {slides_priority}")
     
+    cache_key = (query, course_id, tuple(slides_priority or ()), limit)
+    cached_results = _rag_cache_get(cache_key)
+    if cached_results is not None:
+        logger.info(f"RAG search cache hit for course {course_id}")
+        return {
+            "success": True,
+            "results": cached_results,
+            "count": len(cached_results)
+        }
+    
     try:
-        # Use the real RAG retrieval function
-        results = await retrieve_similar_chunks_async(
-            course_id=course_id,
-            slides=slides_priority or [],
-            chunks=[],  # No chunk filtering
-            prompt=query,
-            limit=limit
-        )
+        # Join an identical search that is already running instead of issuing another
+        task = _rag_inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(
+                _search_course(cache_key, query, course_id, slides_priority or [], limit)
+            )
+            _rag_inflight[cache_key] = task
+            # Only unregister itself; invalidation may have replaced it with a newer search
+            task.add_done_callback(
+                lambda done: _rag_inflight.pop(cache_key) if _rag_inflight.get(cache_key) is done else None
+            )
+        else:
+            logger.info(f"RAG search joined in-flight query for course {course_id}")
         
-        # Format results for the agent
-        formatted_results = []
-        for i, result in enumerate(results, 1):
-            metadata = result.get("metadata", {})
-            formatted_results.append({
-                "id": str(i),
-                "slide": metadata.get("slideId", ""),
-                "s3file": metadata.get("s3_path", ""),
-                "start": str(metadata.get("pageStart", "")),
-                "end": str(metadata.get("pageEnd", "")),
-                "text": metadata.get("rawText", ""),
-                "score": result.get("score", 0.0)
-            })
+        # Shield so one cancelled caller does not cancel the search for the others
+        formatted_results = [dict(result) for result in await asyncio.shield(task)]
         
         return {
             "success": True,
@@ -73,6 +201,15 @@ async def rag_search_tool(
             "count": len(formatted_results)
         }
         
+    except RetrievalTimeoutError as e:
+        # Degrade instead of failing the turn; the agent can answer or use web search
+        logger.warning(f"RAG search timed out: {e}")
+        return {
+            "success": False,
+            "error": str(e),
+            "timed_out": True,
+            "results": []
+        }
     except Exception as e:
         logger.error(f"RAG search error: {e}")
         return {
@@ -82,9 +219,22 @@ async def rag_search_tool(
         }
 
 
+@lru_cache(maxsize=8)
+def _get_tavily_search(max_results: int) -> TavilySearchResults:
+    """Get a shared Tavily search client for a result count."""
+    tavily_api_key = get_settings().tavily_api_key
+    if not tavily_api_key:
+        raise ValueError("TAVILY_API_KEY not found in environment")
+    
+    return TavilySearchResults(
+        api_key=tavily_api_key,
+        max_results=max_results
+    )
+
+
 # Web Search Tool
 @tool
-def web_search_tool(query: str, max_results: int = 5) -> Dict[str, Any]:
+async def web_search_tool(query: str, max_results: int = 5) -> Dict[str, Any]:
     """
     Search the web for current information using Tavily.
     
@@ -98,18 +248,8 @@ def web_search_tool(query: str, max_results: int = 5) -> Dict[str, Any]:
     logger.info(f"Web search - Query: '{query}'")
     
     try:
-        # Initialize Tavily search
-        tavily_api_key = os.getenv("TAVILY_API_KEY")
-        if not tavily_api_key:
-            raise ValueError("TAVILY_API_KEY not found in environment")
-        
-        search = TavilySearchResults(
-            api_key=tavily_api_key,
-            max_results=max_results
-        )
-        
-        # Perform search
-        results = search.invoke(query)
+        # Perform search without blocking the event loop
+        results = await _get_tavily_search(max_results).ainvoke(query)
         
         # Format results
         formatted_results = []
@@ -164,40 +304,39 @@ def create_retrieve_previous_sources_tool(state_manager: AgentStateManager, user
                 tool_message_ids=tool_message_ids
             )
             
-            # Combine all sources from the tool messages
-            all_rag_sources = []
-            all_web_sources = []
-            all_image_sources = []
+            # Only successful tool calls carry sources
+            successful = [
+                (tool_msg_id, tool_data.get("tool_name"), tool_data["content"])
+                for tool_msg_id, tool_data in tool_messages.items()
+                if tool_data.get("content", {}).get("success")
+            ]
             
-            for tool_msg_id, tool_data in tool_messages.items():
-                content = tool_data.get("content", {})
-                tool_name = tool_data.get("tool_name")
-                
-                if content.get("success"):
-                    # Extract sources based on tool type
-                    if tool_name == "rag_search_tool":
-                        results = content.get("results", [])
-                        for source in results:
-                            source["from_tool_message"] = tool_msg_id
-                            all_rag_sources.append(source)
-                    
-                    elif tool_name == "web_search_tool":
-                        results = content.get("results", [])
-                        for source in results:
-                            source["from_tool_message"] = tool_msg_id
-                            all_web_sources.append(source)
-                    
-                    elif tool_name in ["current_user_view", "previous_user_view"]:
-                        # Image analysis results
-                        image_info = {
-                            "tool": tool_name,
-                            "from_tool_message": tool_msg_id,
-                            "query": content.get("query"),
-                            "analysis": content.get("analysis"),
-                            "slide_id": content.get("slide_id"),
-                            "page_number": content.get("page_number")
-                        }
-                        all_image_sources.append(image_info)
+            # Tag copies of each source with its tool message; the stored dicts are left untouched
+            all_rag_sources = [
+                {**source, "from_tool_message": tool_msg_id}
+                for tool_msg_id, tool_name, content in successful
+                if tool_name == "rag_search_tool"
+                for source in content.get("results", [])
+            ]
+            all_web_sources = [
+                {**source, "from_tool_message": tool_msg_id}
+                for tool_msg_id, tool_name, content in successful
+                if tool_name == "web_search_tool"
+                for source in content.get("results", [])
+            ]
+            # Image analysis results
+            all_image_sources = [
+                {
+                    "tool": tool_name,
+                    "from_tool_message": tool_msg_id,
+                    "query": content.get("query"),
+                    "analysis": content.get("analysis"),
+                    "slide_id": content.get("slide_id"),
+                    "page_number": content.get("page_number")
+                }
+                for tool_msg_id, tool_name, content in successful
+                if tool_name in ("current_user_view", "previous_user_view")
+            ]
             
             return {
                 "success": True,
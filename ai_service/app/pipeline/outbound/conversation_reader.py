@@ -3,57 +3,110 @@ Utility module for reading conversation history from MongoDB/Redis.
 Provides functions to retrieve and format messages for frontend display.
 """
 
-import os
-import json
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+import orjson
 from datetime import datetime
+from functools import lru_cache
 from pymongo import MongoClient, DESCENDING
 import redis
-from dotenv import load_dotenv
 
-# Load environment variables
-if not os.getenv('MONGO_URI'):
-    load_dotenv()
+from app.config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Known-empty thread marker, shared with agent_state (cleared whenever history is cached)
+_EMPTY_MARKER_PREFIX = "agent_state_empty:"
+_EMPTY_MARKER_TTL = 60
+
+
+def _execute_pipeline(pipe) -> List[Any]:
+    """Run a Redis pipeline (Upstash uses exec(), redis-py uses execute())."""
+    if hasattr(pipe, "exec"):
+        return pipe.exec()
+    return pipe.execute()
+
+
+# Preview of the last human/AI message: first 100 code points plus an ellipsis.
+# Multimodal content is stored as a list, which has no text preview.
+_LAST_MESSAGE_PREVIEW = {
+    "$let": {
+        "vars": {"last": {"$arrayElemAt": ["$messages", -1]}},
+        "in": {
+            "$cond": [
+                {"$and": [
+                    {"$in": ["$$last.type", ["human", "ai"]]},
+                    {"$eq": [{"$type": "$$last.content"}, "string"]}
+                ]},
+                {"$concat": [{"$substrCP": ["$$last.content", 0, 100]}, "..."]},
+                ""
+            ]
+        }
+    }
+}
+
 
 class ConversationReader:
     """Reads conversation history from MongoDB and Redis."""
     
     def __init__(self):
+        settings = get_settings()
+        
         # MongoDB setup
-        mongo_uri = os.getenv('MONGO_URI')
+        mongo_uri = settings.mongo_uri
         if not mongo_uri:
             raise ValueError("MONGO_URI not found in environment")
         
-        self.mongo_client = MongoClient(mongo_uri)
-        db_name = os.getenv('MONGO_DB')
+        self.mongo_client = MongoClient(
+            mongo_uri,
+            maxPoolSize=settings.mongo_pool_size,
+            minPoolSize=1,
+            compressors="zstd,snappy,zlib",  # Negotiated; unavailable codecs are skipped
+            readPreference="primaryPreferred",
+            serverSelectionTimeoutMS=3000
+        )
+        db_name = settings.mongo_db
         if not db_name:
             raise ValueError("MONGO_DB not found in environment")
             
         self.mongo_db = self.mongo_client[db_name]
-        self.states_collection = self.mongo_db[os.getenv('MONGO_STATES_COLLECTION', 'agent_states')]
+        self.states_collection = self.mongo_db[settings.mongo_states_collection]
+        self.redis_ttl = settings.redis_ttl  # Same TTL agent_state uses for the history key
         
         # Redis setup (optional - will use MongoDB as fallback)
         self.redis_client = None
         try:
-            redis_url = os.getenv('UPSTASH_REDIS_REST_URL')
-            redis_token = os.getenv('UPSTASH_REDIS_REST_TOKEN')
+            tcp_url = settings.upstash_redis_url
+            redis_url = settings.redis_url
+            redis_token = settings.redis_token
             
-            if redis_url and redis_token:
+            if tcp_url:
+                # Upstash's native TCP endpoint (rediss://): pooled keepalive connections
+                # and real pipelines instead of one HTTPS request per command
+                self.redis_client = redis.Redis.from_url(
+                    tcp_url,
+                    decode_responses=True,
+                    max_connections=settings.redis_pool_size,
+                    socket_keepalive=True,
+                    health_check_interval=30
+                )
+                logger.info("Upstash Redis TCP client initialized for reading")
+            elif redis_url and redis_token:
                 from upstash_redis import Redis
                 self.redis_client = Redis(url=redis_url, token=redis_token)
                 logger.info("Redis client initialized for reading")
             else:
                 # Try local Redis
-                redis_host = os.getenv('REDIS_HOST', 'localhost')
-                redis_port = int(os.getenv('REDIS_PORT', '6379'))
                 self.redis_client = redis.Redis(
-                    host=redis_host,
-                    port=redis_port,
-                    decode_responses=True
+                    connection_pool=redis.ConnectionPool(
+                        host=settings.redis_host,
+                        port=settings.redis_port,
+                        db=settings.redis_db,
+                        decode_responses=True,
+                        max_connections=settings.redis_pool_size,
+                        socket_keepalive=True
+                    )
                 )
                 logger.info("Local Redis client initialized")
         except Exception as e:
@@ -63,6 +116,42 @@ class ConversationReader:
         """Generate thread ID from user and course IDs."""
         return f"{user_id}:{course_id}"
     
+    def _read_cached(
+        self,
+        thread_id: str,
+        limit: int,
+        include_sources: bool
+    ) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]]:
+        """
+        Read the cached history slice and the sources of the AI messages in it.
+        
+        Only the AI message ids in the slice are fetched from the sources hash,
+        so older turns' sources are never transferred or decoded.
+        
+        Returns:
+            Tuple of (raw messages oldest first, sources by message id), or
+            None if the thread is marked as known-empty
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.get(f"agent_state:{thread_id}")
+        pipe.exists(f"{_EMPTY_MARKER_PREFIX}{thread_id}")
+        cached_data, marked_empty = _execute_pipeline(pipe)
+        if not cached_data and marked_empty:
+            return None
+        
+        raw_messages = orjson.loads(cached_data).get("messages", [])[-limit:] if cached_data else []
+        sources_by_message = {}
+        
+        if include_sources and raw_messages:
+            ai_ids = [msg["id"] for msg in raw_messages if msg.get("type") == "ai" and msg.get("id")]
+            if ai_ids:
+                values = self.redis_client.hmget(f"agent_sources:{thread_id}", *ai_ids)
+                for msg_id, source_data in zip(ai_ids, values):
+                    if source_data:
+                        sources_by_message[msg_id] = orjson.loads(source_data)
+        
+        return raw_messages, sources_by_message
+    
     async def get_conversation_messages(
         self, 
         user_id: str, 
@@ -89,21 +178,16 @@ class ConversationReader:
         # Try Redis first
         if self.redis_client:
             try:
-                # Get messages from Redis
-                redis_key = f"agent_state:{thread_id}"
-                cached_data = self.redis_client.get(redis_key)
+                # Get messages (oldest first) and sources off the event loop
+                cached = await asyncio.to_thread(
+                    self._read_cached, thread_id, limit, include_sources
+                )
+                if cached is None:
+                    # Recently confirmed empty; skip MongoDB
+                    return messages
+                raw_messages, sources_by_message = cached
                 
-                if cached_data:
-                    state_data = json.loads(cached_data)
-                    raw_messages = state_data.get("messages", [])[-limit:]
-                    
-                    # Get sources if requested
-                    if include_sources:
-                        sources_key = f"agent_sources:{thread_id}"
-                        all_sources = self.redis_client.hgetall(sources_key)
-                        for msg_id, source_data in all_sources.items():
-                            sources_by_message[msg_id] = json.loads(source_data)
-                    
+                if raw_messages:
                     # Format messages
                     messages = self._format_messages_for_frontend(raw_messages, sources_by_message)
                     logger.info(f"Retrieved {len(messages)} messages from Redis")
@@ -114,8 +198,9 @@ class ConversationReader:
         
         # Fallback to MongoDB
         try:
-            # Get conversation state
-            doc = self.states_collection.find_one(
+            # Get conversation state (pymongo blocks, so run it in a worker thread)
+            doc = await asyncio.to_thread(
+                self.states_collection.find_one,
                 {"thread_id": thread_id},
                 {"messages": {"$slice": -limit}}
             )
@@ -126,6 +211,17 @@ class ConversationReader:
                 # Format messages
                 messages = self._format_messages_for_frontend(raw_messages, sources_by_message)
                 logger.info(f"Retrieved {len(messages)} messages from MongoDB")
+            elif self.redis_client:
+                # Remember the miss briefly so polling a new thread does not hit MongoDB
+                try:
+                    await asyncio.to_thread(
+                        self.redis_client.setex,
+                        f"{_EMPTY_MARKER_PREFIX}{thread_id}",
+                        _EMPTY_MARKER_TTL,
+                        "1"
+                    )
+                except Exception as e:
+                    logger.warning(f"Error caching empty thread marker: {e}")
                 
         except Exception as e:
             logger.error(f"Error reading from MongoDB: {e}")
@@ -143,37 +239,34 @@ class ConversationReader:
         Returns messages in newest-first order with formatted structure.
         """
         formatted_messages = []
+        # Computed once; only used for messages stored without a timestamp
+        fallback_timestamp = datetime.utcnow().isoformat()
         
-        for i, msg in enumerate(raw_messages):
-            msg_type = msg.get("type", "")
-            content = msg.get("content", "")
+        # Walk newest to oldest so no reverse pass is needed; i keeps the original position
+        for i in range(len(raw_messages) - 1, -1, -1):
+            msg = raw_messages[i]
+            get = msg.get
+            msg_type = get("type", "")
             
             # Skip system and tool messages
-            if msg_type in ["system", "tool"]:
+            if msg_type == "system" or msg_type == "tool":
                 continue
             
-            # Create formatted message
-            formatted_msg = {
-                "id": msg.get("id", f"msg_{i}"),
+            msg_id = get("id", f"msg_{i}")
+            # Sources only apply to AI messages
+            source_data = sources_by_message.get(msg_id) if msg_type == "ai" else None
+            
+            # Build the formatted message in one pass
+            formatted_messages.append({
+                "id": msg_id,
                 "type": "user" if msg_type == "human" else "assistant",
-                "content": content,
-                "timestamp": msg.get("timestamp", datetime.utcnow().isoformat()),
+                "content": get("content", ""),
+                "timestamp": get("timestamp", fallback_timestamp),
                 "sources": {
-                    "ragSources": [],
-                    "webSources": []
+                    "ragSources": source_data.get("rag_sources", []) if source_data else [],
+                    "webSources": source_data.get("web_sources", []) if source_data else []
                 }
-            }
-            
-            # Add sources if available and this is an AI message
-            if msg_type == "ai" and msg.get("id") in sources_by_message:
-                source_data = sources_by_message[msg["id"]]
-                formatted_msg["sources"]["ragSources"] = source_data.get("rag_sources", [])
-                formatted_msg["sources"]["webSources"] = source_data.get("web_sources", [])
-            
-            formatted_messages.append(formatted_msg)
-        
-        # Reverse to get newest first
-        formatted_messages.reverse()
+            })
         
         return formatted_messages
     
@@ -187,30 +280,29 @@ class ConversationReader:
         conversations = []
         
         try:
-            # Find all conversations for the user
-            cursor = self.states_collection.find(
-                {"user_id": user_id},
-                {
+            # Find all conversations for the user; the preview is trimmed server-side
+            pipeline = [
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"updated_at": DESCENDING}},
+                {"$project": {
+                    "_id": 0,
                     "thread_id": 1,
                     "course_id": 1,
                     "updated_at": 1,
                     "message_count": 1,
-                    "messages": {"$slice": -1}  # Get only last message
-                }
-            ).sort("updated_at", DESCENDING)
+                    "last_message": _LAST_MESSAGE_PREVIEW
+                }}
+            ]
+            # Drain the cursor in a worker thread so the event loop is not blocked
+            docs = await asyncio.to_thread(
+                lambda: list(self.states_collection.aggregate(pipeline))
+            )
             
-            for doc in cursor:
-                # Get last message preview
-                last_message = ""
-                if doc.get("messages"):
-                    last_msg = doc["messages"][-1]
-                    if last_msg.get("type") in ["human", "ai"]:
-                        last_message = last_msg.get("content", "")[:100] + "..."
-                
+            for doc in docs:
                 conversations.append({
                     "threadId": doc["thread_id"],
                     "courseId": doc["course_id"],
-                    "lastMessage": last_message,
+                    "lastMessage": doc.get("last_message", ""),
                     "messageCount": doc.get("message_count", 0),
                     "updatedAt": doc.get("updated_at", "")
                 })
@@ -237,7 +329,11 @@ class ConversationReader:
         
         try:
             # Get data from MongoDB
-            doc = self.states_collection.find_one({"thread_id": thread_id})
+            doc = await asyncio.to_thread(
+                self.states_collection.find_one,
+                {"thread_id": thread_id},
+                {"_id": 0, "messages": 1}
+            )
             
             if not doc:
                 logger.info(f"No conversation found for thread {thread_id}")
@@ -245,20 +341,17 @@ class ConversationReader:
             
             # Prepare data for Redis
             messages = doc.get("messages", [])
-            state_data = {
-                "messages": messages,
-                "updated_at": doc.get("updated_at", datetime.utcnow().isoformat())
-            }
             
-            # Store in Redis with TTL
+            # Replace the cached state with TTL in one pipelined round-trip
             redis_key = f"agent_state:{thread_id}"
-            ttl = 3600 * 24  # 24 hours
             
-            self.redis_client.setex(
-                redis_key,
-                ttl,
-                json.dumps(state_data)
-            )
+            pipe = self.redis_client.pipeline()
+            pipe.delete(f"{_EMPTY_MARKER_PREFIX}{thread_id}")
+            if messages:
+                pipe.setex(redis_key, self.redis_ttl, orjson.dumps({"messages": messages}, option=orjson.OPT_NON_STR_KEYS).decode())
+            else:
+                pipe.delete(redis_key)
+            await asyncio.to_thread(_execute_pipeline, pipe)
             
             logger.info(f"Synced {len(messages)} messages to Redis for thread {thread_id}")
             return True
@@ -274,6 +367,20 @@ class ConversationReader:
         # Redis connections are handled automatically
 
 
+@lru_cache(maxsize=1)
+def get_conversation_reader() -> ConversationReader:
+    """Get the shared ConversationReader (singleton) so clients are pooled across requests."""
+    return ConversationReader()
+
+
+def cleanup_conversation_reader():
+    """Close the shared reader's connections if it was created."""
+    if get_conversation_reader.cache_info().currsize:
+        get_conversation_reader().close()
+        get_conversation_reader.cache_clear()
+        logger.info("Conversation reader connections closed")
+
+
 # Convenience functions for direct usage
 async def get_conversation_for_frontend(
     user_id: str, 
@@ -304,12 +411,7 @@ async def get_conversation_for_frontend(
         }
     ]
     """
-    reader = ConversationReader()
-    try:
-        messages = await reader.get_conversation_messages(user_id, course_id, limit)
-        return messages
-    finally:
-        reader.close()
+    return await get_conversation_reader().get_conversation_messages(user_id, course_id, limit)
 
 
 async def get_user_conversations(user_id: str) -> List[Dict[str, Any]]:
@@ -327,9 +429,4 @@ async def get_user_conversations(user_id: str) -> List[Dict[str, Any]]:
         }
     ]
     """
-    reader = ConversationReader()
-    try:
-        conversations = await reader.get_all_conversations(user_id)
-        return conversations
-    finally:
-        reader.close()
\ No newline at end of file
+    return await get_conversation_reader().get_all_conversations(user_id)
\ No newline at end of file
@@ -5,9 +5,9 @@ Integrates with the new agent system that supports RAG, web search, and multimod
 
 import logging
 import time
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 from pydantic import BaseModel, Field
-from app.pipeline.outbound.agent import process_agent_query, SearchType
+from app.pipeline.outbound.agent import process_agent_query
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -77,7 +77,7 @@ async def process_outbound_pipeline(request: OutboundRequest) -> ChatResponseDTO
     Returns:
         ChatResponseDTO with agent response and sources
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     
     try:
         logger.info(f"Processing outbound request for user: {request.user_id}, course: {request.course_id}")
@@ -105,23 +105,24 @@ async def process_outbound_pipeline(request: OutboundRequest) -> ChatResponseDTO
             snapshot=request.snapshot.model_dump() if request.snapshot else None
         )
         
-        # Convert result to response format
+        # Convert result to response format; the source dicts are validated by
+        # ChatResponseDTO in one pass instead of one model per source
         response = ChatResponseDTO(
             response=result.get("response", ""),
-            ragSources=[RagSource(**source) for source in result.get("rag_sources", [])],
-            webSources=[WebSource(**source) for source in result.get("web_sources", [])],
-            imageSources=[ImageSource(
-                id=source["id"],
-                type=source["type"],
-                messageId=source.get("message_id"),
-                timestamp=source.get("timestamp"),
-                slideId=source.get("slide_id"),
-                pageNumber=source.get("page_number")
-            ) for source in result.get("image_sources", [])]
+            ragSources=result.get("rag_sources", []),
+            webSources=result.get("web_sources", []),
+            imageSources=[{
+                "id": source["id"],
+                "type": source["type"],
+                "messageId": source.get("message_id"),
+                "timestamp": source.get("timestamp"),
+                "slideId": source.get("slide_id"),
+                "pageNumber": source.get("page_number")
+            } for source in result.get("image_sources", [])]
         )
         
         # Log performance metrics
-        processing_time = time.time() - start_time
+        processing_time = time.perf_counter() - start_time
         logger.info(f"Outbound pipeline completed in {processing_time:.2f}s")
         logger.info(f"Response length: {len(response.response)} chars")
         logger.info(f"RAG sources: {len(response.ragSources)}, Web sources: {len(response.webSources)}")
@@ -137,16 +138,3 @@ async def process_outbound_pipeline(request: OutboundRequest) -> ChatResponseDTO
             webSources=[],
             imageSources=[]
         )
-
-
-def cleanup_outbound_connections():
-    """Clean up any connections used by the outbound pipeline."""
-    from app.pipeline.outbound.agent import cleanup_agent_connections
-    from app.pipeline.outbound.rag_retrieval import cleanup_rag_connections
-    
-    try:
-        cleanup_agent_connections()
-        cleanup_rag_connections()
-        logger.info("Outbound pipeline connections cleaned up")
-    except Exception as e:
-        logger.error(f"Error cleaning up outbound connections: {e}")
\ No newline at end of file
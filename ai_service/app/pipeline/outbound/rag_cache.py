@@ -0,0 +1,168 @@
+"""
+Persistent retrieval cache backed by a MongoDB Atlas collection.
+
+Retrieval results are stored next to their query embedding. Before a real
+vector search, a top-1 vector search over the cache collection looks for a
+near-identical earlier query with the same filters, so results are reused
+across processes and restarts.
+
+Enabled by setting RAG_CACHE_COLLECTION. The collection needs an Atlas
+vector index (RAG_CACHE_VECTOR_INDEX) on "embedding" with "course_id" and
+"filter_hash" as filter fields; entries expire through a TTL index on
+"created_at" that is created on first write.
+"""
+
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+
+import orjson
+
+from app.config import get_settings
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_indexes_created = False
+
+
+def is_enabled() -> bool:
+    """Whether the persistent retrieval cache is configured."""
+    return bool(get_settings().rag_cache_collection)
+
+
+def filter_hash(slides: List[str], chunks: List[int], limit: int) -> str:
+    """Hash the search filters (order-insensitive) and limit into a cache filter key."""
+    return hashlib.sha1(orjson.dumps([sorted(slides), sorted(chunks), limit])).hexdigest()
+
+
+def _collection(mongo_client):
+    """Return the cache collection on a (sync or async) MongoDB client."""
+    settings = get_settings()
+    return mongo_client[settings.mongo_db][settings.rag_cache_collection]
+
+
+async def lookup(
+    mongo_client,
+    course_id: str,
+    slides: List[str],
+    chunks: List[int],
+    limit: int,
+    query_embedding: List[float]
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Find cached results for a near-identical query with the same filters.
+
+    Args:
+        mongo_client: Async MongoDB client
+        course_id: Course the search is scoped to
+        slides: Slide filter of the search
+        chunks: Chunk filter of the search
+        limit: Result limit of the search
+        query_embedding: Embedding of the query
+
+    Returns:
+        The cached results, or None on a miss or error
+    """
+    pipeline = [
+        {
+            "$vectorSearch": {
+                "index": get_settings().rag_cache_vector_index,
+                "path": "embedding",
+                "queryVector": query_embedding,
+                "numCandidates": 50,
+                "limit": 1,
+                "filter": {"course_id": course_id, "filter_hash": filter_hash(slides, chunks, limit)}
+            }
+        },
+        {"$project": {"_id": 0, "results": 1, "score": {"$meta": "vectorSearchScore"}}}
+    ]
+
+    try:
+        cursor = await _collection(mongo_client).aggregate(pipeline)
+        docs = await cursor.to_list(1)
+    except Exception as e:
+        logger.warning(f"RAG cache lookup failed: {e}")
+        return None
+
+    if docs and docs[0].get("score", 0.0) >= get_settings().rag_cache_threshold:
+        logger.info(f"RAG cache hit for course {course_id} (score {docs[0]['score']:.3f})")
+        return docs[0].get("results", [])
+    return None
+
+
+async def store(
+    mongo_client,
+    course_id: str,
+    slides: List[str],
+    chunks: List[int],
+    limit: int,
+    query_embedding: List[float],
+    results: List[Dict[str, Any]]
+) -> None:
+    """
+    Cache the results of a search.
+
+    Args:
+        mongo_client: Async MongoDB client
+        course_id: Course the search is scoped to
+        slides: Slide filter of the search
+        chunks: Chunk filter of the search
+        limit: Result limit of the search
+        query_embedding: Embedding of the query
+        results: Formatted retrieval results
+    """
+    global _indexes_created
+    collection = _collection(mongo_client)
+
+    try:
+        if not _indexes_created:
+            await collection.create_index("created_at", expireAfterSeconds=get_settings().rag_cache_ttl_seconds)
+            await collection.create_index([("course_id", 1), ("slide_ids", 1)])
+            _indexes_created = True
+
+        await collection.insert_one({
+            "course_id": course_id,
+            "filter_hash": filter_hash(slides, chunks, limit),
+            "slide_ids": sorted(slides),  # Empty means the whole course
+            "embedding": query_embedding,
+            "results": results,
+            "created_at": datetime.now(timezone.utc)
+        })
+    except Exception as e:
+        logger.warning(f"RAG cache store failed: {e}")
+
+
+def invalidate_course(mongo_client, course_id: Optional[str], slide_id: Optional[str] = None) -> int:
+    """
+    Drop cached results that may include content that changed.
+
+    Called after chunks are added or deleted. Entries for the changed slide
+    and whole-course entries are removed; without a course every entry is.
+
+    Args:
+        mongo_client: Sync MongoDB client
+        course_id: Course whose content changed
+        slide_id: Slide whose content changed, if known
+
+    Returns:
+        Number of cache entries removed
+    """
+    if not is_enabled():
+        return 0
+
+    filter_query: Dict[str, Any] = {}
+    if course_id:
+        filter_query["course_id"] = course_id
+        if slide_id:
+            filter_query["slide_ids"] = {"$in": [slide_id, []]}
+
+    try:
+        deleted = _collection(mongo_client).delete_many(filter_query).deleted_count
+    except Exception as e:
+        logger.warning(f"RAG cache invalidation failed: {e}")
+        return 0
+
+    logger.info(f"Invalidated {deleted} RAG cache entries for course {course_id}")
+    return deleted
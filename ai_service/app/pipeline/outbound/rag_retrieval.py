@@ -3,53 +3,296 @@ RAG Retrieval module for finding relevant chunks from MongoDB vector index.
 Uses MongoDB Atlas Vector Search with direct Voyage API for 512-dimension embeddings.
 """
 
-import os
+import sys
+import time
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Set, Tuple
 import voyageai
-from pymongo import MongoClient
-from dotenv import load_dotenv
+from bson.binary import Binary, BinaryVectorDtype
+from pymongo import AsyncMongoClient
+from pymongo.errors import ExecutionTimeout, OperationFailure
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 
-# Load environment variables only if not already loaded
-if not os.getenv('MONGO_URI'):
-    load_dotenv()
+from app.config import get_settings
+from app.pipeline.outbound import rag_cache
+from app.utils.hedging import hedged
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 # Global connections
-_mongo_client: Optional[MongoClient] = None
+_mongo_client: Optional[AsyncMongoClient] = None
 _voyage_client: Optional[voyageai.Client] = None
-_thread_pool: Optional[ThreadPoolExecutor] = None
+_async_voyage_client: Optional[voyageai.AsyncClient] = None
 
+# RAG_BSON_QUERY_VECTOR=1 sends float query vectors as packed BSON float32 vectors
+# instead of arrays of doubles. Needs a cluster that accepts binData query vectors;
+# the first rejection sets this and the search is retried with a plain list.
+_bson_query_vector_rejected = False
 
-def get_thread_pool() -> ThreadPoolExecutor:
-    """Get or create thread pool for CPU-bound operations"""
-    global _thread_pool
-    if _thread_pool is None:
-        _thread_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag_retrieval_")
-    return _thread_pool
+# Query embeddings keyed by sha256(model|dimensions|dtype|normalized text); repeat questions skip Voyage
+_embed_cache: "OrderedDict[str, Tuple[float, Tuple[float, ...]]]" = OrderedDict()
+_embed_cache_lock = threading.Lock()  # The sync embed_query may run on worker threads
+_embed_cache_hits = 0
+_embed_cache_misses = 0
 
+# Near-duplicate query cache (numpy LSH), opt-in via RAG_SEMANTIC_CACHE=1
+_semantic_cache = None
+_semantic_cache_unsupported = False  # Set once a binary VOYAGE_DTYPE has been reported
 
-def get_mongo_client() -> MongoClient:
-    """Get or create MongoDB client (singleton)."""
+_embedding_batcher: Optional["EmbeddingBatcher"] = None
+
+@dataclass(frozen=True, slots=True)
+class RagConfig:
+    """Vector search configuration, read from the environment once per process"""
+    db_name: str
+    collection_name: str
+    vector_index: str
+    num_candidates: int
+    max_time_ms: int
+
+
+class RetrievalTimeoutError(Exception):
+    """Vector search exceeded its server-side time budget, even after retrying smaller."""
+
+
+@lru_cache(maxsize=1)
+def get_config() -> RagConfig:
+    """
+    Get the cached vector search configuration.
+    
+    Raises:
+        ValueError: If MONGO_DB, MONGO_COLLECTION_NAME or MONGO_VECTOR_INDEX is unset
+    """
+    settings = get_settings()
+    if not all([settings.mongo_db, settings.mongo_collection_name, settings.mongo_vector_index]):
+        raise ValueError("MONGO_DB, MONGO_COLLECTION_NAME, and MONGO_VECTOR_INDEX must be set in .env")
+    return RagConfig(
+        db_name=settings.mongo_db,
+        collection_name=settings.mongo_collection_name,
+        vector_index=settings.mongo_vector_index,
+        num_candidates=settings.mongo_num_candidates,  # Defaults to 10000 if MONGO_NUM_CANDIDATES is unset
+        max_time_ms=settings.mongo_search_max_time_ms  # Defaults to 2500 if MONGO_SEARCH_MAX_TIME_MS is unset
+    )
+
+
+@lru_cache(maxsize=1)
+def _vector_search_template() -> Dict[str, Any]:
+    """Fixed part of the $vectorSearch stage; calls add queryVector, limit and filter."""
+    config = get_config()
+    return {
+        "index": config.vector_index,
+        "path": "embedding",  # The field containing embeddings
+        "numCandidates": config.num_candidates  # Configurable via MONGO_NUM_CANDIDATES env var
+    }
+
+
+# Per-course {slide_id: chunk_count}, used to size numCandidates to the filter.
+# Counted in the background so the course-wide $group never runs on a request.
+_slide_counts: Dict[str, Tuple[float, Dict[str, int]]] = {}
+_slide_counts_refreshing: Set[str] = set()
+
+# Bumped by invalidate_course_caches; work that started under an older epoch
+# (recounts, searches) doesn't store its results in the in-process caches
+_cache_epoch = 0
+
+
+def cache_epoch() -> int:
+    """Return the current invalidation epoch of the in-process retrieval caches."""
+    return _cache_epoch
+
+
+def _get_slide_counts(collection, course_id: str) -> Optional[Dict[str, int]]:
+    """
+    Return the cached chunk counts per slide for a course, possibly stale.
+    
+    A missing or expired entry schedules a background recount; until it lands
+    the caller gets the stale counts, or None if the course was never counted.
+    """
+    entry = _slide_counts.get(course_id)
+    if (entry is None or entry[0] <= time.monotonic()) and course_id not in _slide_counts_refreshing:
+        _slide_counts_refreshing.add(course_id)
+        task = asyncio.create_task(_refresh_slide_counts(collection, course_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return entry[1] if entry is not None else None
+
+
+async def _refresh_slide_counts(collection, course_id: str) -> None:
+    """Recount a course's chunks per slide and cache the result."""
+    epoch = _cache_epoch
+    try:
+        cursor = await collection.aggregate([
+            {"$match": {"course_id": course_id}},
+            {"$group": {"_id": "$slide_id", "count": {"$sum": 1}}}
+        ])
+        counts = {doc["_id"]: doc["count"] async for doc in cursor}
+        if epoch == _cache_epoch:
+            ttl = get_settings().rag_slide_counts_ttl_seconds
+            _slide_counts[course_id] = (time.monotonic() + ttl, counts)
+    except Exception as e:
+        logger.warning(f"Could not count chunks for course {course_id}: {e}")
+    finally:
+        _slide_counts_refreshing.discard(course_id)
+
+
+def invalidate_course_caches(course_id: Optional[str]) -> None:
+    """
+    Drop in-process retrieval state for a course whose chunks changed.
+    
+    Clears the per-slide chunk counts, semantic cache entries and the RAG
+    tool's result cache for the course, so the next search sees the new
+    content instead of waiting out the TTLs. The persistent Atlas cache is
+    invalidated separately (rag_cache.invalidate_course).
+    
+    These caches belong to the event loop, so call this on the loop thread
+    (the ingest and delete pipelines do so once their worker thread returns).
+    
+    Args:
+        course_id: Course whose chunks were added or deleted (None for all courses)
+    """
+    global _cache_epoch
+    
+    _cache_epoch += 1
+    if course_id is None:
+        _slide_counts.clear()
+    else:
+        _slide_counts.pop(course_id, None)
+    if _semantic_cache is not None:
+        _semantic_cache.invalidate(lambda filter_key: course_id is None or filter_key[0] == course_id)
+    
+    # The tool cache only exists once the agent tools have been imported
+    agent_tools = sys.modules.get("app.pipeline.outbound.agent_tools")
+    if agent_tools is not None:
+        agent_tools.clear_rag_cache(course_id)
+    
+    logger.info(f"Invalidated in-process retrieval caches for course {course_id}")
+
+
+def _num_candidates(collection, course_id: str, slides: List[str], limit: int) -> int:
+    """
+    Size the ANN candidate pool to the filter: about twice the documents the
+    filter can match, at least 20x the limit and at most MONGO_NUM_CANDIDATES.
+    Uses the full MONGO_NUM_CANDIDATES until the course has been counted.
+    """
+    max_candidates = get_config().num_candidates
+    counts = _get_slide_counts(collection, course_id)
+    if counts is None:
+        return max_candidates
+    
+    estimated_docs = sum(counts.get(slide, 0) for slide in slides) if slides else sum(counts.values())
+    return min(max_candidates, max(limit * 20, estimated_docs * 2))
+
+
+# Strong references to fire-and-forget cache writes so they are not garbage collected
+_background_tasks = set()
+
+# Result metadata as (response field, stored field, default when missing). The
+# $project stage below renames server-side, so embeddings never cross the wire.
+_METADATA_FIELDS = (
+    ("courseId", "course_id", ""),
+    ("slideId", "slide_id", ""),
+    ("chunkIndex", "chunk_index", 0),
+    ("rawText", "text", ""),
+    ("wordCount", "word_count", 0),
+    ("charCount", "char_count", 0),
+    ("splitLevel", "split_level", ""),
+    ("pageStart", "page_start", 0),
+    ("pageEnd", "page_end", 0),
+    ("headersHierarchy", "headers_hierarchy", []),
+    ("headersHierarchyTitles", "headers_hierarchy_titles", []),
+    ("s3_path", "s3_file_name", ""),
+    ("totalPages", "total_pages", 0),
+    ("timestamp", "timestamp", 0),
+    ("sentenceSiblingCount", "sentence_sibling_count", 0),
+    ("sentenceSiblingIndex", "sentence_sibling_index", 0),
+    ("updatedAt", "updated_at", 0),
+    # Optional fields
+    ("isHeader", "is_header", False),
+    ("headerLevel", "header_level", None),
+    ("headerText", "header_text", None),
+)
+_RESULT_PROJECTION = {
+    "$project": {
+        "_id": 1,
+        "score": {"$meta": "vectorSearchScore"},  # Similarity score
+        **{name: {"$ifNull": [f"${field}", default]} for name, field, default in _METADATA_FIELDS}
+    }
+}
+
+
+def get_mongo_client() -> AsyncMongoClient:
+    """Get or create the async MongoDB client (singleton)."""
     global _mongo_client
     if _mongo_client is None:
-        mongo_uri = os.getenv('MONGO_URI')
+        mongo_uri = get_settings().mongo_uri
         if not mongo_uri:
             raise ValueError("MONGO_URI not found in .env file")
-        _mongo_client = MongoClient(mongo_uri)
+        _mongo_client = AsyncMongoClient(
+            mongo_uri,
+            maxPoolSize=get_settings().mongo_pool_size,
+            minPoolSize=2,
+            compressors="zstd,snappy,zlib",  # Negotiated; unavailable codecs are skipped
+            readPreference="primaryPreferred",
+            serverSelectionTimeoutMS=3000
+        )
         logger.info("MongoDB client initialized for RAG retrieval")
     return _mongo_client
 
 
+def get_semantic_cache():
+    """Get the semantic result cache (singleton), or None when it is disabled."""
+    global _semantic_cache, _semantic_cache_unsupported
+    if _semantic_cache is not None or _semantic_cache_unsupported:
+        return _semantic_cache
+    settings = get_settings()
+    if settings.rag_semantic_cache:
+        if settings.voyage_dtype in ("binary", "ubinary"):
+            # Bit-packed vectors are not comparable by cosine similarity
+            logger.warning("Semantic cache disabled: not supported with binary VOYAGE_DTYPE")
+            _semantic_cache_unsupported = True
+            return None
+        from app.pipeline.outbound.semantic_cache import SemanticCache
+        _semantic_cache = SemanticCache(
+            threshold=settings.rag_semantic_cache_threshold,
+            maxlen=settings.rag_semantic_cache_size,
+            ttl_seconds=settings.rag_semantic_cache_ttl_seconds
+        )
+        logger.info("Semantic cache initialized for RAG retrieval")
+    return _semantic_cache
+
+
+def get_embedding_batcher() -> "EmbeddingBatcher":
+    """Get or create the query embedding batcher (singleton)."""
+    global _embedding_batcher
+    if _embedding_batcher is None:
+        settings = get_settings()
+        _embedding_batcher = EmbeddingBatcher(
+            max_tokens=settings.embed_batch_max_tokens,
+            max_wait_ms=settings.embed_batch_wait_ms
+        )
+    return _embedding_batcher
+
+
+async def close_embedding_batcher():
+    """Stop the embedding batcher; it runs on the event loop, so close it there."""
+    global _embedding_batcher
+    if _embedding_batcher is not None:
+        await _embedding_batcher.close()
+        _embedding_batcher = None
+
+
 def get_voyage_client() -> voyageai.Client:
     """Get or create Voyage client (singleton)."""
     global _voyage_client
     if _voyage_client is None:
-        api_key = os.getenv('VOYAGE_API_KEY')
+        api_key = get_settings().voyage_api_key
         if not api_key:
             raise ValueError("VOYAGE_API_KEY not found in .env file")
         _voyage_client = voyageai.Client(api_key=api_key)
@@ -57,9 +300,165 @@ def get_voyage_client() -> voyageai.Client:
     return _voyage_client
 
 
+def get_async_voyage_client() -> voyageai.AsyncClient:
+    """Get or create the async Voyage client (singleton) used on the event loop."""
+    global _async_voyage_client
+    if _async_voyage_client is None:
+        api_key = get_settings().voyage_api_key
+        if not api_key:
+            raise ValueError("VOYAGE_API_KEY not found in .env file")
+        _async_voyage_client = voyageai.AsyncClient(api_key=api_key)
+        logger.info("Async Voyage client initialized for RAG retrieval")
+    return _async_voyage_client
+
+
+def _embed_cache_key(model: str, dimensions: int, dtype: str, query: str) -> str:
+    """Hash the model, dimensions, output type and normalized query text into a cache key."""
+    normalized = unicodedata.normalize("NFKC", query).strip().lower()
+    return hashlib.sha256(f"{model}|{dimensions}|{dtype}|{normalized}".encode()).hexdigest()
+
+
+def embedding_cache_info() -> Dict[str, Any]:
+    """Return query embedding cache statistics."""
+    settings = get_settings()
+    with _embed_cache_lock:
+        return {
+            "hits": _embed_cache_hits,
+            "misses": _embed_cache_misses,
+            "size": len(_embed_cache),
+            "maxsize": settings.embed_cache_size,
+            "ttl_seconds": settings.embed_cache_ttl_seconds
+        }
+
+
+def clear_embedding_cache() -> None:
+    """Drop all cached query embeddings."""
+    with _embed_cache_lock:
+        _embed_cache.clear()
+
+
+_EMBED_MODEL = "voyage-3.5-lite"
+_EMBED_DIMENSIONS = 512
+
+
+def _embed_cache_get(key: str, record_miss: bool = True) -> Optional[List[float]]:
+    """Return a cached query embedding, or None if missing or expired."""
+    global _embed_cache_hits, _embed_cache_misses
+    with _embed_cache_lock:
+        entry = _embed_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _embed_cache.move_to_end(key)
+            _embed_cache_hits += 1
+            return list(entry[1])
+        if record_miss:
+            _embed_cache_misses += 1
+        return None
+
+
+def _embed_cache_put(key: str, embedding: List[float]) -> None:
+    """Cache a query embedding, evicting the least recently used entries when full."""
+    settings = get_settings()
+    if settings.embed_cache_size <= 0:
+        return
+    with _embed_cache_lock:
+        # Stored as a tuple so callers can never mutate a cached vector
+        _embed_cache[key] = (time.monotonic() + settings.embed_cache_ttl_seconds, tuple(embedding))
+        _embed_cache.move_to_end(key)
+        while len(_embed_cache) > settings.embed_cache_size:
+            _embed_cache.popitem(last=False)
+
+
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    """
+    Embed query strings using Voyage 3.5-lite with 512 dimensions.
+    
+    The output type follows VOYAGE_DTYPE (float by default); quantized types
+    come back as integer lists and must match the ingested documents.
+    
+    Repeated queries (after unicode, whitespace and case normalization) are
+    served from an in-process LRU cache until their TTL expires; the rest
+    are embedded in a single Voyage request.
+    
+    Args:
+        queries: The query texts to embed
+    
+    Returns:
+        Embedding vectors in the same order as queries
+    """
+    keys, embeddings, missing = _lookup_cached_embeddings(queries)
+    
+    if missing:
+        client = get_voyage_client()
+        
+        # Embed the uncached queries
+        result = client.embed(
+            texts=[queries[i] for i in missing.values()],
+            model=_EMBED_MODEL,
+            input_type="query",  # Use "query" for search queries
+            output_dimension=_EMBED_DIMENSIONS,
+            output_dtype=get_settings().voyage_dtype
+        )
+        embeddings = _merge_embedded(keys, embeddings, missing, result.embeddings)
+    
+    return embeddings
+
+
+async def aembed_queries(queries: List[str]) -> List[List[float]]:
+    """
+    Embed query strings on the event loop (see embed_queries).
+    
+    Args:
+        queries: The query texts to embed
+    
+    Returns:
+        Embedding vectors in the same order as queries
+    """
+    keys, embeddings, missing = _lookup_cached_embeddings(queries)
+    
+    if missing:
+        result = await get_async_voyage_client().embed(
+            texts=[queries[i] for i in missing.values()],
+            model=_EMBED_MODEL,
+            input_type="query",
+            output_dimension=_EMBED_DIMENSIONS,
+            output_dtype=get_settings().voyage_dtype
+        )
+        embeddings = _merge_embedded(keys, embeddings, missing, result.embeddings)
+    
+    return embeddings
+
+
+def _lookup_cached_embeddings(queries: List[str]) -> Tuple[List[str], List[Optional[List[float]]], Dict[str, int]]:
+    """Return the cache keys, cached embeddings (None on a miss) and first position of each distinct miss."""
+    dtype = get_settings().voyage_dtype
+    keys = [_embed_cache_key(_EMBED_MODEL, _EMBED_DIMENSIONS, dtype, query) for query in queries]
+    embeddings = [_embed_cache_get(key) for key in keys]
+    missing = {}
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            missing.setdefault(keys[i], i)
+    return keys, embeddings, missing
+
+
+def _merge_embedded(
+    keys: List[str],
+    embeddings: List[Optional[List[float]]],
+    missing: Dict[str, int],
+    embedded_vectors: List[List[float]]
+) -> List[List[float]]:
+    """Cache freshly embedded vectors and fill them into the cache misses."""
+    embedded = dict(zip(missing, embedded_vectors))
+    for key, embedding in embedded.items():
+        _embed_cache_put(key, embedding)
+    return [
+        embedding if embedding is not None else list(embedded[key])
+        for key, embedding in zip(keys, embeddings)
+    ]
+
+
 def embed_query(query: str) -> List[float]:
     """
-    Embed a query string using Voyage 3.5-lite with 512 dimensions.
+    Embed a single query string (see embed_queries).
     
     Args:
         query: The query text to embed
@@ -67,28 +466,102 @@ def embed_query(query: str) -> List[float]:
     Returns:
         List of floats representing the embedding vector
     """
-    client = get_voyage_client()
-    model = "voyage-3.5-lite"
-    dimensions = 512
-    
-    # Embed the query
-    result = client.embed(
-        texts=[query],
-        model=model,
-        input_type="query",  # Use "query" for search queries
-        output_dimension=dimensions
-    )
+    return embed_queries([query])[0]
+
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent query embeddings into shared Voyage requests.
+    
+    Queries arriving within max_wait_ms of each other are sent together,
+    up to a rough token budget (characters / 4). Cached queries bypass
+    the queue entirely.
+    """
+    
+    def __init__(self, max_tokens: int = 2048, max_wait_ms: float = 10.0):
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._dispatch_tasks = set()
     
-    return result.embeddings[0]
+    async def embed(self, query: str) -> List[float]:
+        """Embed one query, sharing the Voyage request with concurrent callers."""
+        # Misses are counted when the batch is embedded
+        cached = _embed_cache_get(
+            _embed_cache_key(_EMBED_MODEL, _EMBED_DIMENSIONS, get_settings().voyage_dtype, query), record_miss=False
+        )
+        if cached is not None:
+            return cached
+        
+        loop = asyncio.get_running_loop()
+        if self._drain_task is None or self._drain_task.done():
+            self._queue = asyncio.Queue()
+            self._drain_task = loop.create_task(self._drain())
+        
+        future = loop.create_future()
+        self._queue.put_nowait((query, future))
+        return await future
+    
+    async def _drain(self) -> None:
+        """Collect queued queries into batches and dispatch them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            tokens = len(batch[0][0]) // 4 + 1
+            deadline = loop.time() + self.max_wait
+            
+            while tokens < self.max_tokens:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                tokens += len(item[0]) // 4 + 1
+            
+            # Dispatch without blocking the next batch from forming
+            task = loop.create_task(self._dispatch(batch))
+            self._dispatch_tasks.add(task)
+            task.add_done_callback(self._dispatch_tasks.discard)
+    
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        """Embed a batch with the async Voyage client and resolve each caller's future."""
+        try:
+            embeddings = await aembed_queries([query for query, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        logger.info(f"Embedded batch of {len(batch)} queries")
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+    
+    async def close(self) -> None:
+        """Stop the drain task and wait for in-flight batches."""
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
+        if self._dispatch_tasks:
+            await asyncio.gather(*self._dispatch_tasks, return_exceptions=True)
 
 
-def retrieve_similar_chunks(
+async def retrieve_similar_chunks(
     course_id: str,
     slides: List[str],
     chunks: List[int],
     query_embedding: List[float],
     limit: int,
-    mongo_client: Optional[MongoClient] = None
+    mongo_client: Optional[AsyncMongoClient] = None
 ) -> List[Dict[str, Any]]:
     """
     Retrieve similar chunks from MongoDB using vector search with pre-filtering.
@@ -107,27 +580,20 @@ def retrieve_similar_chunks(
         chunks: List of chunk indices to filter by (empty list = all chunks that match course/slides)
         query_embedding: The embedding vector to search with
         limit: Maximum number of results to return (top K)
-        mongo_client: Optional MongoClient instance (creates new if not provided)
+        mongo_client: Optional AsyncMongoClient instance (uses the shared client if not provided)
     
     Returns:
         List of up to 'limit' chunks sorted by similarity score
     """
-    # Get MongoDB configuration
-    db_name = os.getenv('MONGO_DB')
-    collection_name = os.getenv('MONGO_COLLECTION_NAME')
-    vector_index_name = os.getenv('MONGO_VECTOR_INDEX')
-    num_candidates = int(os.getenv('MONGO_NUM_CANDIDATES', '10000'))  # Default to 10000 if not set
-    
-    if not all([db_name, collection_name, vector_index_name]):
-        raise ValueError("MONGO_DB, MONGO_COLLECTION_NAME, and MONGO_VECTOR_INDEX must be set in .env")
+    # Get MongoDB configuration (read once per process)
+    config = get_config()
     
     # Initialize MongoDB client if not provided
     if mongo_client is None:
         mongo_client = get_mongo_client()
     
     # Get database and collection
-    db = mongo_client[db_name]
-    collection = db[collection_name]
+    collection = mongo_client[config.db_name][config.collection_name]
     
     # Build filter query - this is applied BEFORE vector search
     filter_query = {"course_id": course_id}
@@ -144,72 +610,74 @@ def retrieve_similar_chunks(
     
     # Perform vector search using MongoDB Atlas Vector Search
     # The filter is applied as pre-filtering before similarity calculation
-    # Note: numCandidates is configurable via MONGO_NUM_CANDIDATES env variable
-    # This value determines the candidate pool size for the ANN algorithm.
-    # Since pre-filtering limits the search space, set this high enough to
-    # search through all relevant documents while maintaining good performance.
-    pipeline = [
-        {
-            "$vectorSearch": {
-                "index": vector_index_name,  # Use env variable for index name
-                "path": "embedding",  # The field containing embeddings
-                "queryVector": query_embedding,
-                "numCandidates": num_candidates,  # Configurable via MONGO_NUM_CANDIDATES env var
-                "limit": limit,
-                "filter": filter_query  # Pre-filtering applied here
-            }
-        },
-        {
-            "$addFields": {
-                "score": {"$meta": "vectorSearchScore"}  # Add similarity score to the document
-            }
-        }
-    ]
+    # Note: numCandidates determines the candidate pool size for the ANN algorithm.
+    # It is scaled to the number of chunks the filter can match, capped by the
+    # MONGO_NUM_CANDIDATES env variable, so narrow filters don't over-search.
+    num_candidates = _num_candidates(collection, course_id, slides, limit)
+    
+    # Packed once, reused by the retry; a binData vector is 4 bytes per dimension
+    # encoded in one call, versus a keyed 8-byte double per element for a list
+    settings = get_settings()
+    use_bson = settings.rag_bson_query_vector and settings.voyage_dtype == 'float' and not _bson_query_vector_rejected
+    query_vector = (
+        Binary.from_vector(query_embedding, BinaryVectorDtype.FLOAT32)
+        if use_bson else query_embedding
+    )
+    
+    def build_pipeline(candidates: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                "$vectorSearch": {
+                    **_vector_search_template(),
+                    "numCandidates": candidates,  # Scaled to the filter's selectivity
+                    "queryVector": query_vector,
+                    "limit": limit,
+                    "filter": filter_query  # Pre-filtering applied here
+                }
+            },
+            _RESULT_PROJECTION  # Only the response fields, already renamed
+        ]
+    
+    # Bounded server-side so a slow node can't hold the request (and a pool slot)
+    # indefinitely; all results fit in the first batch, so there is no getMore
+    aggregate_options = {"maxTimeMS": config.max_time_ms, "allowDiskUse": False, "batchSize": limit}
+    
+    async def run_search(candidates: int):
+        global _bson_query_vector_rejected
+        nonlocal query_vector
+        if query_vector is not query_embedding:
+            try:
+                return await collection.aggregate(build_pipeline(candidates), **aggregate_options)
+            except ExecutionTimeout:
+                raise
+            except OperationFailure as e:
+                # The cluster doesn't take binData query vectors; stop sending them
+                _bson_query_vector_rejected = True
+                query_vector = query_embedding
+                logger.warning(f"BSON query vector rejected, falling back to a list: {e}")
+        return await collection.aggregate(build_pipeline(candidates), **aggregate_options)
     
     try:
-        # Execute the aggregation pipeline
-        results = list(collection.aggregate(pipeline))
+        try:
+            cursor = await run_search(num_candidates)
+        except ExecutionTimeout:
+            # Retry once with a smaller candidate pool, which is cheaper to score
+            num_candidates = max(limit, num_candidates // 2)
+            logger.warning(f"Vector search timed out; retrying with numCandidates={num_candidates}")
+            cursor = await run_search(num_candidates)
         
-        logger.info(f"Retrieved {len(results)} chunks from MongoDB for course {course_id}")
-        
-        # Format results to match expected structure
-        formatted_results = []
-        for doc in results:
-            # Remove the embedding field to avoid sending large vectors
-            doc.pop("embedding", None)
-            
-            # Create metadata dict with all fields from MongoDB
-            formatted_chunk = {
-                "id": doc.get("_id", ""),
-                "metadata": {
-                    "courseId": doc.get("course_id", ""),
-                    "slideId": doc.get("slide_id", ""),
-                    "chunkIndex": doc.get("chunk_index", 0),
-                    "rawText": doc.get("text", ""),
-                    "wordCount": doc.get("word_count", 0),
-                    "charCount": doc.get("char_count", 0),
-                    "splitLevel": doc.get("split_level", ""),
-                    "pageStart": doc.get("page_start", 0),
-                    "pageEnd": doc.get("page_end", 0),
-                    "headersHierarchy": doc.get("headers_hierarchy", []),
-                    "headersHierarchyTitles": doc.get("headers_hierarchy_titles", []),
-                    "s3_path": doc.get("s3_file_name", ""),
-                    "totalPages": doc.get("total_pages", 0),
-                    "timestamp": doc.get("timestamp", 0),
-                    "sentenceSiblingCount": doc.get("sentence_sibling_count", 0),
-                    "sentenceSiblingIndex": doc.get("sentence_sibling_index", 0),
-                    "updatedAt": doc.get("updated_at", 0),
-                    # Optional fields
-                    "isHeader": doc.get("is_header", False),
-                    "headerLevel": doc.get("header_level", None),
-                    "headerText": doc.get("header_text", None)
-                },
-                "score": doc.get("score", 0.0)
-            }
-            formatted_results.append(formatted_chunk)
+        # Documents already have the metadata shape; only id and score move out
+        formatted_results = [
+            {"id": doc.pop("_id", ""), "metadata": doc, "score": doc.pop("score", 0.0)}
+            async for doc in cursor
+        ]
         
+        logger.info(f"Retrieved {len(formatted_results)} chunks from MongoDB for course {course_id}")
         return formatted_results
         
+    except ExecutionTimeout as e:
+        logger.error(f"Vector search timed out after {config.max_time_ms}ms: {e}")
+        raise RetrievalTimeoutError(f"Course search timed out after {config.max_time_ms}ms") from e
     except Exception as e:
         logger.error(f"Error retrieving chunks from MongoDB: {str(e)}")
         raise
@@ -242,35 +710,71 @@ async def retrieve_similar_chunks_async(
     Returns:
         List of up to 'limit' chunks sorted by similarity score
     """
+    # Results of a search that overlaps an ingest or delete may predate it
+    epoch = _cache_epoch
+    
+    # Embedding and vector search calls still running after RAG_HEDGE_DELAY_MS get a
+    # duplicate request, for at most RAG_HEDGE_BUDGET of calls; 0 disables hedging
+    settings = get_settings()
+    hedge_delay = settings.rag_hedge_delay_ms / 1000
+    
     try:
-        # Use thread pool for CPU-bound operations
-        thread_pool = get_thread_pool()
-        loop = asyncio.get_event_loop()
-        
-        # Step 1: Embed the query
+        # Step 1: Embed the query (batched with concurrent requests)
         logger.info(f"Embedding query: '{prompt[:100]}...'")
+        query_embedding = await hedged(
+            lambda: get_embedding_batcher().embed(prompt),
+            delay=hedge_delay,
+            budget=settings.rag_hedge_budget
+        )
+        logger.info(f"Query embedded successfully (dimension: {len(query_embedding)})")
         
-        def _embed_query():
-            return embed_query(prompt)
+        # Reuse results of a near-duplicate query with the same filters
+        semantic_cache = get_semantic_cache()
+        filter_key = (course_id, tuple(slides), tuple(chunks), limit)
+        if semantic_cache is not None:
+            cached_results = semantic_cache.lookup(query_embedding, filter_key)
+            if cached_results is not None:
+                return cached_results
         
-        query_embedding = await loop.run_in_executor(thread_pool, _embed_query)
-        logger.info(f"Query embedded successfully (dimension: {len(query_embedding)})")
+        # Then the persistent cache shared by all processes
+        if rag_cache.is_enabled():
+            cached_results = await rag_cache.lookup(
+                get_mongo_client(), course_id, slides, chunks, limit, query_embedding
+            )
+            if cached_results is not None:
+                if semantic_cache is not None and epoch == _cache_epoch:
+                    semantic_cache.store(query_embedding, filter_key, cached_results)
+                return cached_results
         
-        # Step 2: Retrieve similar chunks with pre-filtering
+        # Step 2: Retrieve similar chunks with pre-filtering (awaited directly, no thread hop)
         logger.info(f"Retrieving similar chunks from MongoDB with pre-filtering")
-        
-        def _retrieve_chunks():
-            return retrieve_similar_chunks(
+        results = await hedged(
+            lambda: retrieve_similar_chunks(
                 course_id=course_id,
                 slides=slides,
                 chunks=chunks,
                 query_embedding=query_embedding,
                 limit=limit
-            )
-        
-        results = await loop.run_in_executor(thread_pool, _retrieve_chunks)
+            ),
+            delay=hedge_delay,
+            budget=settings.rag_hedge_budget
+        )
         logger.info(f"Retrieved {len(results)} similar chunks")
         
+        # The course changed while this search ran, so don't cache what it found
+        if epoch != _cache_epoch:
+            return results
+        
+        if semantic_cache is not None:
+            semantic_cache.store(query_embedding, filter_key, results)
+        if rag_cache.is_enabled():
+            # Write the persistent cache entry off the request path
+            task = asyncio.create_task(rag_cache.store(
+                get_mongo_client(), course_id, slides, chunks, limit, query_embedding, results
+            ))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        
         return results
         
     except Exception as e:
@@ -278,18 +782,22 @@ async def retrieve_similar_chunks_async(
         raise
 
 
+async def close_mongo_client():
+    """Close the async MongoDB client; its close() has to run on the event loop."""
+    global _mongo_client
+    client, _mongo_client = _mongo_client, None
+    if client is not None:
+        await client.close()
+
+
 def cleanup_rag_connections():
     """Clean up connections on shutdown"""
-    global _thread_pool, _mongo_client, _voyage_client
-    
-    if _thread_pool:
-        _thread_pool.shutdown(wait=True)
-        _thread_pool = None
-    
-    if _mongo_client:
-        _mongo_client.close()
-        _mongo_client = None
+    global _mongo_client, _voyage_client, _async_voyage_client, _semantic_cache
     
+    # The async MongoDB client is closed by close_mongo_client on the event loop
+    _mongo_client = None
     _voyage_client = None
+    _async_voyage_client = None
+    _semantic_cache = None
     
     logger.info("RAG retrieval connections cleaned up")
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+Near-duplicate query cache for RAG retrieval.
+
+Recent query embeddings are indexed with random-projection LSH so a
+paraphrased query with the same filters can reuse an earlier result set
+instead of running another MongoDB vector search.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+import numpy as np
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """LSH index over recent query embeddings and their retrieval results."""
+
+    def __init__(
+        self,
+        dimensions: int = 512,
+        tables: int = 8,
+        bits: int = 16,
+        threshold: float = 0.97,
+        maxlen: int = 2048,
+        ttl_seconds: float = 300.0,
+        seed: int = 0
+    ):
+        """
+        Args:
+            dimensions: Embedding dimensions
+            tables: Number of hash tables (more tables = higher recall)
+            bits: Signature bits per table (more bits = smaller buckets)
+            threshold: Minimum cosine similarity for a hit
+            maxlen: Maximum number of cached queries
+            ttl_seconds: How long a cached result set stays valid
+            seed: Seed for the random projections
+        """
+        rng = np.random.default_rng(seed)
+        # One set of random +/-1 hyperplanes per table: (tables, bits, dimensions)
+        self._planes = rng.choice([-1.0, 1.0], size=(tables, bits, dimensions)).astype(np.float32)
+        self._tables: List[Dict[bytes, List[int]]] = [{} for _ in range(tables)]
+        self._entries: Dict[int, Tuple[np.ndarray, Tuple, List[bytes], float, List[Dict[str, Any]]]] = {}
+        self._order = deque()
+        self._next_id = 0
+        self._threshold = threshold
+        self._maxlen = maxlen
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def _signatures(self, unit: np.ndarray) -> List[bytes]:
+        """Return one packed sign-bit signature per table."""
+        signs = (self._planes @ unit) > 0
+        return [np.packbits(row).tobytes() for row in signs]
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        """L2-normalize an embedding; None for a zero vector."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        return vector / norm
+
+    def _evict(self, entry_id: int) -> None:
+        """Remove an entry from the index (caller holds the lock)."""
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for table, signature in zip(self._tables, entry[2]):
+            bucket = table.get(signature)
+            if bucket:
+                bucket.remove(entry_id)
+                if not bucket:
+                    del table[signature]
+
+    def lookup(self, embedding: List[float], filter_key: Tuple) -> Optional[List[Dict[str, Any]]]:
+        """
+        Find cached results for a near-duplicate query with the same filters.
+
+        Args:
+            embedding: Query embedding
+            filter_key: Hashable tuple of the search filters and limit
+
+        Returns:
+            Copy of the cached results, or None on a miss
+        """
+        unit = self._normalize(embedding)
+        if unit is None:
+            return None
+        signatures = self._signatures(unit)
+        now = time.monotonic()
+
+        with self._lock:
+            candidates = set()
+            for table, signature in zip(self._tables, signatures):
+                candidates.update(table.get(signature, ()))
+
+            best_id, best_score = None, self._threshold
+            for entry_id in candidates:
+                vector, entry_filter, _, expires_at, _ = self._entries[entry_id]
+                if entry_filter != filter_key or expires_at < now:
+                    continue
+                score = float(np.dot(unit, vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                return None
+            results = self._entries[best_id][4]
+
+        logger.info(f"Semantic cache hit (cosine {best_score:.3f})")
+        return [dict(result) for result in results]
+
+    def store(self, embedding: List[float], filter_key: Tuple, results: List[Dict[str, Any]]) -> None:
+        """
+        Cache the results of a query.
+
+        Args:
+            embedding: Query embedding
+            filter_key: Hashable tuple of the search filters and limit
+            results: Retrieval results to reuse for near-duplicate queries
+        """
+        unit = self._normalize(embedding)
+        if unit is None:
+            return
+        signatures = self._signatures(unit)
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (
+                unit,
+                filter_key,
+                signatures,
+                time.monotonic() + self._ttl_seconds,
+                [dict(result) for result in results]
+            )
+            self._order.append(entry_id)
+            for table, signature in zip(self._tables, signatures):
+                table.setdefault(signature, []).append(entry_id)
+
+            while len(self._order) > self._maxlen:
+                self._evict(self._order.popleft())
+
+    def invalidate(self, matches: Callable[[Tuple], bool]) -> int:
+        """
+        Drop cached queries whose filter key matches.
+        
+        Args:
+            matches: Predicate over filter keys
+        
+        Returns:
+            Number of entries dropped
+        """
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items() if matches(entry[1])]
+            for entry_id in stale:
+                self._evict(entry_id)
+            if stale:
+                dropped = set(stale)
+                self._order = deque(entry_id for entry_id in self._order if entry_id not in dropped)
+        return len(stale)
+    
+    def clear(self) -> None:
+        """Drop every cached query."""
+        with self._lock:
+            for table in self._tables:
+                table.clear()
+            self._entries.clear()
+            self._order.clear()
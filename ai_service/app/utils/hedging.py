@@ -0,0 +1,76 @@
+"""
+Request hedging for remote calls with a long latency tail.
+
+If a call hasn't finished after a short delay, a duplicate is started and
+whichever finishes first wins. A process-wide budget caps how many calls
+get a duplicate, so hedging can't double the load on a slow dependency.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hedged calls seen and duplicates started, for the budget
+_hedge_calls = 0
+_hedges_fired = 0
+
+
+async def hedged(fn: Callable[[], Awaitable[T]], *, delay: float = 0.3, budget: float = 0.05) -> T:
+    """
+    Await fn(), racing a second fn() if the first is still running after delay.
+
+    Args:
+        fn: Zero-argument coroutine function; it may be called twice
+        delay: Seconds to wait before starting the duplicate (0 disables hedging)
+        budget: Maximum fraction of calls that may start a duplicate
+
+    Returns:
+        The result of the first attempt to succeed
+
+    Raises:
+        Exception: The last attempt's error, if every attempt fails
+    """
+    global _hedge_calls, _hedges_fired
+
+    if delay <= 0:
+        return await fn()
+
+    _hedge_calls += 1
+    tasks = [asyncio.ensure_future(fn())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return tasks[0].result()
+
+        if _hedges_fired < budget * _hedge_calls:
+            _hedges_fired += 1
+            logger.info(f"Hedging slow call after {delay:.3f}s")
+            tasks.append(asyncio.ensure_future(fn()))
+
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                # Every attempt failed; surface the last error
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def hedge_info() -> Dict[str, Any]:
+    """Return hedging counters (calls, fired, rate)."""
+    return {
+        "calls": _hedge_calls,
+        "fired": _hedges_fired,
+        "rate": _hedges_fired / _hedge_calls if _hedge_calls else 0.0
+    }
@@ -2,39 +2,121 @@
 S3 utility functions for handling presigned URLs.
 """
 
-import os
+import time
 import logging
+import threading
+from collections import OrderedDict
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from typing import Optional
+from typing import Optional, Dict, Any, Tuple
+
+from app.config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Global client - botocore clients are thread-safe and expensive to build
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
 
 def get_s3_client():
-    """Get or create S3 client."""
-    # Get AWS credentials from environment
-    aws_access_key = os.getenv("AWS_ACCESS_KEY_ID")
-    aws_secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-    aws_region = os.getenv("AWS_REGION", "us-east-1")
+    """Get or create S3 client (singleton)."""
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
     
-    if not aws_access_key or not aws_secret_key:
-        logger.warning("AWS credentials not found in environment. Using default credentials chain.")
-        # This will use IAM role, instance profile, or other AWS credential sources
-        return boto3.client('s3', region_name=aws_region)
-    
-    return boto3.client(
-        's3',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
-    )
+    with _s3_client_lock:
+        if _s3_client is None:
+            # Get AWS credentials from the settings snapshot
+            settings = get_settings()
+            # Keep-alive pool sized for concurrent requests; fail over quickly on throttling
+            s3_config = Config(
+                max_pool_connections=settings.s3_max_pool_connections,
+                retries={"max_attempts": 2, "mode": "adaptive"},
+                tcp_keepalive=True
+            )
+            aws_access_key = settings.aws_access_key_id
+            aws_secret_key = settings.aws_secret_access_key
+            aws_region = settings.aws_region
+            
+            if not aws_access_key or not aws_secret_key:
+                logger.warning("AWS credentials not found in environment. Using default credentials chain.")
+                # This will use IAM role, instance profile, or other AWS credential sources
+                _s3_client = boto3.client('s3', region_name=aws_region, config=s3_config)
+            else:
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=aws_access_key,
+                    aws_secret_access_key=aws_secret_key,
+                    region_name=aws_region,
+                    config=s3_config
+                )
+            logger.info("S3 client initialized")
+    return _s3_client
+
+
+# Presigned URLs are reused for the first half of their validity, so a cached
+# URL always has at least half its expiration left when it is handed out
+_presign_cache: "OrderedDict[Tuple[str, str, int], Tuple[float, str]]" = OrderedDict()
+_presign_cache_lock = threading.Lock()
+_presign_cache_hits = 0
+_presign_cache_misses = 0
+
+
+def _presign_cache_get(key: Tuple[str, str, int]) -> Optional[str]:
+    """Return the cached URL for key, or None if missing or about to expire."""
+    global _presign_cache_hits, _presign_cache_misses
+    with _presign_cache_lock:
+        entry = _presign_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _presign_cache.move_to_end(key)
+            _presign_cache_hits += 1
+            return entry[1]
+        if entry is not None:
+            del _presign_cache[key]
+        _presign_cache_misses += 1
+        return None
+
+
+def _presign_cache_put(key: Tuple[str, str, int], url: str) -> None:
+    """Cache url for half its expiration, evicting the least recently used entry when full."""
+    ttl = key[2] / 2
+    maxsize = get_settings().presign_cache_size
+    if ttl <= 0 or maxsize <= 0:
+        return
+    with _presign_cache_lock:
+        _presign_cache[key] = (time.monotonic() + ttl, url)
+        _presign_cache.move_to_end(key)
+        while len(_presign_cache) > maxsize:
+            _presign_cache.popitem(last=False)
+
+
+def presigned_url_cache_info() -> Dict[str, Any]:
+    """Return presigned URL cache statistics."""
+    with _presign_cache_lock:
+        return {
+            "hits": _presign_cache_hits,
+            "misses": _presign_cache_misses,
+            "size": len(_presign_cache),
+            "maxsize": get_settings().presign_cache_size
+        }
+
+
+def clear_presigned_url_cache() -> None:
+    """Drop all cached presigned URLs."""
+    with _presign_cache_lock:
+        _presign_cache.clear()
 
 
 def generate_presigned_url(s3_key: str, bucket_name: Optional[str] = None, expiration: int = 3600) -> Optional[str]:
     """
     Generate a presigned URL for an S3 object.
     
+    URLs are cached for half their expiration, so repeated requests for
+    the same object skip the signing and every URL handed out still has at
+    least half its lifetime left.
+    
     Args:
         s3_key: The S3 key of the object
         bucket_name: The S3 bucket name (from env if not provided)
@@ -45,10 +127,15 @@ def generate_presigned_url(s3_key: str, bucket_name: Optional[str] = None, expir
     """
     try:
         if not bucket_name:
-            bucket_name = os.getenv("S3_BUCKET_NAME")
+            bucket_name = get_settings().s3_bucket
             if not bucket_name:
                 raise ValueError("S3_BUCKET_NAME not found in environment")
         
+        cache_key = (bucket_name, s3_key, expiration)
+        cached = _presign_cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         s3_client = get_s3_client()
         
         response = s3_client.generate_presigned_url(
@@ -56,6 +143,7 @@ def generate_presigned_url(s3_key: str, bucket_name: Optional[str] = None, expir
             Params={'Bucket': bucket_name, 'Key': s3_key},
             ExpiresIn=expiration
         )
+        _presign_cache_put(cache_key, response)
         
         logger.info(f"Generated presigned URL for s3://{bucket_name}/{s3_key}")
         return response
@@ -1,3 +1,8 @@
+from app.config import configure_logging
+
+# Configure logging before the pipeline modules are imported
+configure_logging()
+
 from app.controller import app
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Script to precompile the .env file into app/env_compiled.py.
+
+The generated module holds the parsed values as a literal dict so the
+service can import it (bytecode cached) instead of parsing .env text on
+every cold start. It records a hash of the .env it was built from; if .env
+changes afterwards, the service ignores the stale module and loads .env
+instead, so re-run this script whenever .env changes.
+"""
+
+import os
+import sys
+import hashlib
+
+from dotenv import dotenv_values
+
+# Resolve paths relative to the service root (parent of scripts/)
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_PATH = os.path.join(SERVICE_ROOT, ".env")
+OUTPUT_PATH = os.path.join(SERVICE_ROOT, "app", "env_compiled.py")
+
+
+def compile_env(env_path: str = ENV_PATH, output_path: str = OUTPUT_PATH) -> int:
+    """
+    Parse a .env file and write its values as a Python module.
+
+    Args:
+        env_path: Path to the .env file to read
+        output_path: Path of the module to generate
+
+    Returns:
+        Number of variables written
+    """
+    values = {key: value for key, value in dotenv_values(env_path).items() if value is not None}
+    with open(env_path, "rb") as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+
+    lines = [
+        '"""Generated by scripts/compile_env.py from .env - do not edit or commit."""',
+        "",
+        f"SOURCE_SHA256 = {source_hash!r}",
+        "",
+        "ENV = {",
+    ]
+    lines.extend(f"    {key!r}: {value!r}," for key, value in sorted(values.items()))
+    lines.append("}")
+
+    with open(output_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return len(values)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(ENV_PATH):
+        print(f"❌ No .env file found at {ENV_PATH}")
+        sys.exit(1)
+    count = compile_env()
+    print(f"✅ Compiled {count} variables into {OUTPUT_PATH}")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+One-time MongoDB setup for the AI service.
+
+Creates the conversation states collection with zstd block compression,
+and the indexes its queries rely on. Both need DDL privileges, so they run
+here as a deploy step instead of on the first request. Re-running it is safe.
+"""
+
+import os
+import sys
+
+# Make the app package importable when run as scripts/setup_mongo.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.pipeline.outbound.agent_state import create_states_collection, create_states_indexes
+
+
+def setup_mongo() -> None:
+    """Create the collections and indexes the service expects to exist."""
+    if create_states_collection():
+        print("✅ Created compressed states collection")
+    else:
+        print("ℹ️  States collection already exists")
+    create_states_indexes()
+    print("✅ States indexes ensured")
+
+
+if __name__ == "__main__":
+    try:
+        setup_mongo()
+    except Exception as e:
+        print(f"❌ MongoDB setup failed: {e}")
+        sys.exit(1)